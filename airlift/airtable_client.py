@@ -5,24 +5,194 @@ This module handles Airtable table access, schema checks, optional field
 creation, record upload, and bulk delete operations.
 """
 
+import concurrent.futures
+import itertools
 import logging
 import json
 import threading
-from typing import Dict
+import time
+from typing import Callable, Dict, Generator, Iterable, Iterator, List, Optional, Tuple
+import requests
 from pyairtable import Api
 from airlift.utils_exceptions import CriticalError, AirtableError
+from airlift.rate_limiter import (
+    AIRTABLE_RATE_BURST,
+    AIRTABLE_RATE_LIMIT,
+    RateLimitedSession,
+    get_rate_limiter,
+    is_congestion_error,
+)
 from tqdm import tqdm
 
 ATDATATYPE = Dict[str, Dict[str, str]]
 
+# Airtable accepts at most 10 records per create/update/delete request.
+AIRTABLE_BATCH_SIZE = 10
+# Threads sending delete requests; they share the base's rate limiter
+AIRTABLE_DELETE_WORKERS = 5
+# A delete request that failed with 429/5xx or a dropped connection is sent
+# again up to this many times, waiting DELETE_RETRY_WAIT * 2**attempt between
+DELETE_MAX_RETRIES = 4
+DELETE_RETRY_WAIT = 1.0
+# performUpsert.fieldsToMergeOn accepts between one and this many fields
+AIRTABLE_MAX_MERGE_FIELDS = 3
+# Error types Airtable answers with when a record id no longer exists
+MISSING_RECORD_ERRORS = ("ROW_DOES_NOT_EXIST", "MODEL_ID_NOT_FOUND")
+
 logger = logging.getLogger(__name__)
 
+
+def upsert_fields(args) -> List[str]:
+    """Resolve --upsert-on into the Airtable field names to merge records on.
+
+    Fields renamed with --rename-key-column are mapped to their Airtable name,
+    and a bare --upsert-on merges on the renamed key column.
+    """
+    rename = args.rename_key_column
+    fields = list(args.upsert_on or [])
+    if not fields:
+        if not rename:
+            raise CriticalError("upsert-on needs at least one column or --rename-key-column!")
+        return [rename[1]]
+    if rename:
+        fields = [rename[1] if field == rename[0] else field for field in fields]
+    if len(fields) > AIRTABLE_MAX_MERGE_FIELDS:
+        raise CriticalError(
+            f"upsert-on accepts at most {AIRTABLE_MAX_MERGE_FIELDS} columns, got {len(fields)}!"
+        )
+    return fields
+
+
+def is_missing_record(exc: BaseException) -> bool:
+    """Return True if Airtable refused a write because a record was deleted."""
+    response = getattr(exc, "response", None)
+    return (
+        response is not None
+        and response.status_code in (404, 422)
+        and any(error in response.text for error in MISSING_RECORD_ERRORS)
+    )
+
+
+def is_invalid_request(exc: BaseException) -> bool:
+    """Return True if Airtable refused a write because of the records in it."""
+    response = getattr(exc, "response", None)
+    if response is not None and response.status_code == 422:
+        return True
+    return is_missing_record(exc)
+
+
+def record_fields(data: ATDATATYPE) -> Dict:
+    """The fields of a row, given with or without the "fields" wrapper."""
+    return data["fields"] if "fields" in data else data
+
+
+def split_mergeable(
+    records: List[ATDATATYPE], key_fields: List[str]
+) -> Tuple[List[ATDATATYPE], List[Tuple[ATDATATYPE, Exception]]]:
+    """Separate the records that have every merge field from those that don't.
+
+    A merge field that is None, empty or only whitespace counts as missing.
+    """
+    failed = []
+    mergeable = []
+    for data in records:
+        fields = record_fields(data)
+        missing = [
+            key
+            for key in key_fields
+            if fields.get(key) is None or not str(fields[key]).strip()
+        ]
+        if missing:
+            failed.append(
+                (data, ValueError(f"missing merge field(s) {missing}"))
+            )
+        else:
+            mergeable.append(data)
+    return mergeable, failed
+
+
+def assign_ids(records: List[ATDATATYPE], written) -> None:
+    """Store the id of the record each row became under "id"."""
+    # Airtable answers in request order
+    for data, record in zip(records, written or []):
+        if "fields" in data:
+            data["id"] = record["id"]
+
+
+def isolate_invalid_rows(
+    records: List[ATDATATYPE],
+) -> Generator[List[ATDATATYPE], object, List[Tuple[ATDATATYPE, Exception]]]:
+    """Send records, isolating the rows Airtable refuses.
+
+    Airtable rejects the whole request when one record in it is invalid
+    or was deleted, so a batch refused with HTTP 422 or a missing record
+    is sent again row by row to find the records at fault. Any other
+    error aborts the upload.
+
+    Yields each list of records to send and is resumed with the records
+    Airtable wrote, or with the exception the request raised, so the
+    threaded and async engines share it (see send_isolated).
+
+    Returns:
+        list: (record, error) pairs for the rows Airtable refused
+    """
+    outcome = yield records
+    if not isinstance(outcome, Exception):
+        assign_ids(records, outcome)
+        return []
+    _raise_unless_invalid(outcome)
+    if len(records) == 1:
+        return [(records[0], outcome)]
+
+    failed = []
+    for data in records:
+        outcome = yield [data]
+        if isinstance(outcome, Exception):
+            _raise_unless_invalid(outcome)
+            failed.append((data, outcome))
+        else:
+            assign_ids([data], outcome)
+    return failed
+
+
+def _raise_unless_invalid(exc: Exception) -> None:
+    if not is_invalid_request(exc):
+        logger.warning(f"Error writing records: {str(exc)}")
+        raise AirtableError("Unable to upload data!") from exc
+
+
+def send_isolated(
+    records: List[ATDATATYPE], send: Callable[[List[ATDATATYPE]], List[Dict]]
+) -> List[Tuple[ATDATATYPE, Exception]]:
+    """Run isolate_invalid_rows, writing each list of records with `send`."""
+    steps = isolate_invalid_rows(records)
+    batch = next(steps)
+    while True:
+        try:
+            outcome = send(batch)
+        except Exception as e:
+            outcome = e
+        try:
+            batch = steps.send(outcome)
+        except StopIteration as done:
+            return done.value
+
+
 class new_client:
-    def __init__(self, token: str, base: str, table: str):
+    def __init__(
+        self,
+        token: str,
+        base: str,
+        table: str,
+        rate_limit: float = AIRTABLE_RATE_LIMIT,
+        rate_burst: int = AIRTABLE_RATE_BURST,
+    ):
         self.api = token
         self.base_id = base
         self.table_id = table
-        self.api_client = Api(self.api)
+        # Every request to this base, from any thread, draws from one bucket
+        self.limiter = get_rate_limiter(base, rate_limit, rate_burst)
+        self.api_client = self._new_api()
         self.table = self.api_client.table(self.base_id, self.table_id)
         self.base = self.api_client.base(self.base_id)
         # Store headers for direct API calls (same as original)
@@ -31,107 +201,316 @@ class new_client:
             "Content-Type": "application/json"
         }
         logger.debug("Airtable Client Created")
-        self._upload_lock = threading.Lock()
+        self._local = threading.local()
+        self._field_names = None
+        self._schema_stale = False
+
+    def _new_api(self) -> Api:
+        api = Api(self.api)
+        # Replace pyairtable's retrying session so 429s are handled by the
+        # shared limiter instead of per-session backoff.
+        api.session = RateLimitedSession(self.limiter)
+        api.api_key = self.api
+        return api
+
+    def _thread_table(self):
+        """Return a table handle whose HTTP session belongs to the calling thread.
+
+        A requests session must not be shared between threads, so every upload
+        worker gets its own Api instance and writes without a global lock.
+        """
+        table = getattr(self._local, "table", None)
+        if table is None:
+            table = self._new_api().table(self.base_id, self.table_id)
+            self._local.table = table
+        return table
 
     def single_upload(self, data: ATDATATYPE) -> None:
         # pyairtable expects just the fields dict
         record_data = data["fields"] if "fields" in data else data
         try:
-            with self._upload_lock:
-                self.table.create(record_data, typecast=True)
+            self._thread_table().create(record_data, typecast=True)
         except Exception as e:
             logger.warning(f"Error creating records: {str(e)}")
             raise AirtableError("Unable to upload data!") from e
 
-    def delete_all_records(self) -> int:
+    def batch_upload(
+        self, records: List[ATDATATYPE]
+    ) -> List[Tuple[ATDATATYPE, Exception]]:
+        """Create up to AIRTABLE_BATCH_SIZE records with a single request.
+
+        Created rows get their new record id under "id".
+
+        Returns:
+            list: (record, error) pairs for the rows that could not be created
+        """
+        table = self._thread_table()
+        return send_isolated(
+            records,
+            lambda batch: table.batch_create(
+                [record_fields(data) for data in batch], typecast=True
+            ),
+        )
+
+    def batch_upsert(
+        self, records: List[ATDATATYPE], key_fields: List[str]
+    ) -> List[Tuple[ATDATATYPE, Exception]]:
+        """Create or update up to AIRTABLE_BATCH_SIZE records with one request.
+
+        Records are matched on `key_fields` through performUpsert, so uploading
+        the same file twice updates rows instead of duplicating them. Written
+        rows get the id of the record they became under "id".
+
+        Returns:
+            list: (record, error) pairs for the rows that could not be merged
+        """
+        mergeable, failed = split_mergeable(records, key_fields)
+        if not mergeable:
+            return failed
+        table = self._thread_table()
+        return failed + send_isolated(
+            mergeable,
+            lambda batch: table.batch_upsert(
+                [{"fields": record_fields(data)} for data in batch],
+                key_fields=key_fields,
+                typecast=True,
+            )["records"],
+        )
+
+    def batch_update(
+        self, records: List[ATDATATYPE]
+    ) -> List[Tuple[ATDATATYPE, Exception]]:
+        """Update up to AIRTABLE_BATCH_SIZE existing records, addressed by "id".
+
+        Returns:
+            list: (record, error) pairs for the rows that could not be updated
+        """
+        table = self._thread_table()
+        return send_isolated(
+            records,
+            lambda batch: table.batch_update(
+                [
+                    {"id": data["id"], "fields": record_fields(data)}
+                    for data in batch
+                ],
+                typecast=True,
+            ),
+        )
+
+    def delete_all_records(self, workers: int = AIRTABLE_DELETE_WORKERS) -> int:
         """Delete all records from the Airtable table.
-        
+
+        Returns:
+            int: Number of records Airtable confirmed as deleted
+        """
+        logger.info("Deleting records as they are read from the table...")
+        deleted_count = self.delete_record_pages(self.iter_record_ids, workers)
+        if not deleted_count:
+            logger.info("No records found in the table.")
+        return deleted_count
+
+    def delete_by_formula(
+        self, formula: str, workers: int = AIRTABLE_DELETE_WORKERS
+    ) -> int:
+        """Delete the records for which an Airtable formula is true.
+
         Returns:
-            int: Number of records deleted
+            int: Number of records Airtable confirmed as deleted
         """
+        logger.info(f"Deleting records matching {formula}...")
+        deleted_count = self.delete_record_pages(
+            lambda: self.iter_record_ids(formula=formula), workers
+        )
+        if not deleted_count:
+            logger.info("No records match the formula.")
+        return deleted_count
+
+    def delete_record_pages(
+        self,
+        scan: Callable[[], Iterator[List[str]]],
+        workers: int = AIRTABLE_DELETE_WORKERS,
+    ) -> int:
+        """Delete the record ids that `scan` yields, one page at a time.
+
+        Each page is handed to a pool of `workers` threads as soon as it
+        arrives, so memory stays flat and deletion starts after the first
+        request. `scan` is called again until it finds nothing, and also when
+        Airtable drops a listing that was paged through for too long; the
+        records already deleted are gone from the new scan.
+
+        Returns:
+            int: Number of records Airtable confirmed as deleted
+        """
+        workers = max(1, workers)
+        deleted_count = 0
+        progress_bar = tqdm(desc="Deleting records", leave=False)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        pending = set()
+
+        def collect(return_when) -> None:
+            nonlocal deleted_count, pending
+            done, pending = concurrent.futures.wait(pending, return_when=return_when)
+            errors = []
+            for future in done:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                deleted_count += future.result()
+                progress_bar.update(future.result())
+            if errors:
+                raise errors[0]
+
         try:
-            # Get all record IDs from the table
-            logger.info("Fetching all records from the table...")
-            all_records = self.table.all()
-            
-            if not all_records:
-                logger.info("No records found in the table.")
-                return 0
-            
-            total_records = len(all_records)
-            logger.info(f"Found {total_records} records to delete.")
-            
-            # Extract record IDs
-            record_ids = [record["id"] for record in all_records]
-            
-            # Delete records in batches (Airtable API limit is 10 per request)
-            deleted_count = 0
-            batch_size = 10
-            
-            # Create progress bar
-            progress_bar = tqdm(total=total_records, desc="Deleting records", leave=False)
-            
-            for i in range(0, len(record_ids), batch_size):
-                batch = record_ids[i:i + batch_size]
-                self.table.batch_delete(batch)
-                deleted_count += len(batch)
-                progress_bar.update(len(batch))
-            
-            progress_bar.close()
-            logger.info(f"Successfully deleted {deleted_count} records from the table.")
+            while True:
+                found = 0
+                try:
+                    for record_ids in scan():
+                        found += len(record_ids)
+                        for i in range(0, len(record_ids), AIRTABLE_BATCH_SIZE):
+                            batch = record_ids[i:i + AIRTABLE_BATCH_SIZE]
+                            pending.add(executor.submit(self._delete_batch, batch))
+                        # Keep only a few requests queued ahead of the workers
+                        while len(pending) >= workers * 2:
+                            collect(concurrent.futures.FIRST_COMPLETED)
+                    expired = False
+                except Exception as e:
+                    if not self._is_expired_listing(e):
+                        raise
+                    logger.debug("Record listing expired, scanning the table again")
+                    expired = True
+                # Finish this pass so the next one doesn't see records in flight
+                collect(concurrent.futures.ALL_COMPLETED)
+                if not found and not expired:
+                    break
+
+            if deleted_count:
+                logger.info(f"Successfully deleted {deleted_count} records from the table.")
             return deleted_count
             
         except Exception as e:
+            for future in pending:
+                future.cancel()
+            concurrent.futures.wait(pending)
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    deleted_count += future.result()
             logger.error(f"Error deleting records: {str(e)}")
+            logger.error(f"Deleted {deleted_count} records before the error.")
             raise AirtableError(f"Failed to delete records: {str(e)}") from e
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            progress_bar.close()
 
-    def missing_field_single(self, field: str):
-        airtable_table_fields = []
-        tables = self._retreive_table()
+    def _delete_batch(self, record_ids: List[str]) -> int:
+        """Delete up to AIRTABLE_BATCH_SIZE records, retrying transient failures.
+
+        Returns:
+            int: Number of records Airtable reports as deleted
+        """
+        table = self._thread_table()
+        attempt = 0
+        while True:
+            try:
+                deleted = table.batch_delete(record_ids)
+                return sum(1 for record in deleted or [] if record.get("deleted"))
+            except Exception as e:
+                transient = is_congestion_error(e) or isinstance(
+                    e, (requests.ConnectionError, requests.Timeout)
+                )
+                if not transient or attempt >= DELETE_MAX_RETRIES:
+                    raise
+                wait = DELETE_RETRY_WAIT * 2 ** attempt
+                attempt += 1
+                logger.warning(
+                    f"Deleting records failed ({e}), retrying in {wait:.1f}s "
+                    f"(attempt {attempt}/{DELETE_MAX_RETRIES})"
+                )
+                time.sleep(wait)
+
+    def iter_record_ids(self, formula: Optional[str] = None) -> Iterator[List[str]]:
+        """Yield the record ids of the table, one page of up to 100 at a time.
+
+        Airtable returns every field when none are named, so only the primary
+        field is requested to keep the pages small.
+        """
+        primary_field = self._primary_field_id()
+        options = {"fields": [primary_field]} if primary_field else {}
+        if formula:
+            options["formula"] = formula
+        for page in self.table.iterate(**options):
+            yield [record["id"] for record in page]
+
+    def _primary_field_id(self) -> Optional[str]:
+        """Id of the table's primary field, or None if the schema can't be read."""
+        try:
+            tables = self._retreive_table()
+        except AirtableError:
+            return None
         for x in tables:
             if x.id == self.table_id or x.name == self.table_id:
-                for f in x.fields:
-                    airtable_table_fields.append(f.name)
-        return field in airtable_table_fields
+                return x.primary_field_id
+        return None
+
+    @staticmethod
+    def _is_expired_listing(exc: BaseException) -> bool:
+        response = getattr(exc, "response", None)
+        return (
+            response is not None
+            and response.status_code == 422
+            and "LIST_RECORDS_ITERATOR_NOT_AVAILABLE" in response.text
+        )
 
-    def _missing_fields_check(self, data: ATDATATYPE, args: dict):
+    def missing_field_single(self, field: str):
+        return field in self._table_field_names()
+
+    def _table_field_names(self) -> set:
+        """Field names of the target table, fetched once per run.
+
+        The cache is dropped by _create_new_field so the next lookup sees the
+        new column.
+        """
+        if self._field_names is None:
+            field_names = set()
+            for x in self._retreive_table(force=self._schema_stale):
+                if x.id == self.table_id or x.name == self.table_id:
+                    for f in x.fields:
+                        field_names.add(f.name)
+            self._field_names = field_names
+            self._schema_stale = False
+        return self._field_names
+
+    def _missing_fields_check(self, header: List[str], args: dict) -> List[str]:
+        """Create or skip file columns that are missing in Airtable.
+
+        Returns:
+            list: columns to drop from every row
+        """
         disable_bypass = args.disable_bypass_column_creation
         if args.rename_key_column:
             ignore_columns = [args.rename_key_column[0]]
         else:
             ignore_columns = None
-        airtable_table_fields = []
-        user_csv_fields = []
-        tables = self._retreive_table()
-        for x in tables:
-            if x.id == self.table_id or x.name == self.table_id:
-                for f in x.fields:
-                    airtable_table_fields.append(f.name)
+        airtable_table_fields = list(self._table_field_names())
         if ignore_columns:
             for column in ignore_columns:
                 airtable_table_fields.append(column)
-        for csv_key in data[0]["fields"].keys():
-            user_csv_fields.append(csv_key)
-        missing_columns = list(set(user_csv_fields) - set(airtable_table_fields))
+        missing_columns = list(set(header) - set(airtable_table_fields))
+        skipped_columns = []
         if missing_columns:
             for column in missing_columns:
                 if disable_bypass:
                     self._create_new_field(column)
                 else:
                     logger.warning(f"Column {column} would be skipped!")
-                    for datas in data:
-                        try:
-                            del datas["fields"][column]
-                        except Exception:
-                            logger.warning(f"{column} not present in this row")
+                    skipped_columns.append(column)
         else:
             logger.info("All the columns are verified and present in both the file and Airtable!")
-        return data
+        return skipped_columns
 
-    def _retreive_table(self):
+    def _retreive_table(self, force: bool = False):
         try:
             # Get the base schema which contains all tables
-            schema = self.base.schema()
+            schema = self.base.schema(force=force)
             return schema.tables
         except Exception as e:
             logger.warning(f"Error retrieving tables: {str(e)}")
@@ -148,6 +527,9 @@ class new_client:
             
             if response.status_code == 200:
                 logger.info(f"Created new column {field_name} in Airtable")
+                # pyairtable caches the schema too, so force a fresh read
+                self._field_names = None
+                self._schema_stale = True
             elif response.status_code == 422:
                 logger.warning("Encountered an 422 error in creating a new column in Airtable!")
             else:
@@ -159,31 +541,89 @@ class new_client:
         if args.rename_key_column[1] == args.rename_key_column[0]:
             raise CriticalError("rename-key-column argument has same column name!")
 
-    def create_uploadable_data(self, data: ATDATATYPE, args: dict):
-        data = self._missing_fields_check(data, args)
-        all_data = data
+    def compile_transform_plan(
+        self, args: dict, skipped_columns: Optional[List[str]] = None
+    ) -> "TransformPlan":
+        """Validate the column options once and build the per-row transform."""
+        if args.rename_key_column:
+            self._rename_key_column_check(args=args)
+            if not self.missing_field_single(args.rename_key_column[1]):
+                raise CriticalError(f"The Key Column {args.rename_key_column[1]} is not present in airtable! Please create it and try again")
+        if args.columns_copy:
+            for column in args.columns_copy[1::]:
+                if not self.missing_field_single(column):
+                    raise CriticalError(f"The Column {column} is not present in airtable! Please create it and try again")
+        return TransformPlan(
+            copy_source=args.columns_copy[0] if args.columns_copy else None,
+            copy_targets=args.columns_copy[1::] if args.columns_copy else [],
+            rename=args.rename_key_column,
+            attachment_targets=[
+                attachment[1] for attachment in args.attachment_columns_map or []
+            ],
+            skipped_columns=skipped_columns or [],
+        )
+
+    def stream_uploadable_data(
+        self, data: Iterable[ATDATATYPE], args: dict
+    ) -> Iterator[ATDATATYPE]:
+        """Validate the file header against Airtable and transform rows lazily.
+
+        Only the first row is read up front; the rest are transformed as the
+        upload pulls them, so the file never has to be held in memory.
+        """
+        rows = iter(data)
+        first = next(rows, None)
+        if first is None:
+            raise CriticalError("File is empty!")
+        skipped_columns = self._missing_fields_check(list(first["fields"]), args)
+        if args.upsert_on is not None:
+            for key in upsert_fields(args):
+                if not self.missing_field_single(key):
+                    raise CriticalError(f"The merge column {key} is not present in airtable! Please create it and try again")
+        plan = self.compile_transform_plan(args, skipped_columns)
         logger.info("Creating airtable compatible data! Please wait")
-        for data in all_data:
-            # validation and creating new data fields
-            if args.rename_key_column:
-                self._rename_key_column_check(args=args)
-            if args.attachment_columns_map:
-                for attachment in args.attachment_columns_map:
-                    data["fields"][attachment[1]] = []
-            if args.columns_copy:
-                for column in args.columns_copy[1::]:
-                    if self.missing_field_single(column):
-                        data["fields"][column] = data["fields"][args.columns_copy[0]]
-                    else:
-                        raise CriticalError(f"The Column {column} is not present in airtable! Please create it and try again")
-            if args.rename_key_column:
-                if self.missing_field_single(args.rename_key_column[1]):
-                    data["fields"][args.rename_key_column[1]] = data["fields"][args.rename_key_column[0]]
-                    del data["fields"][args.rename_key_column[0]]
-                else:
-                    raise CriticalError(f"The Key Column {args.rename_key_column[1]} is not present in airtable! Please create it and try again")
-        return all_data
+        return plan.apply_all(itertools.chain([first], rows))
 
-        
- 
-            
+    def create_uploadable_data(self, data: ATDATATYPE, args: dict):
+        return list(self.stream_uploadable_data(data, args))
+
+
+class TransformPlan:
+    """Skipped columns, copies, key rename and attachment placeholders for a row.
+
+    Built once by new_client.compile_transform_plan after the options have
+    been checked against the schema, so applying it is plain dict work.
+    """
+
+    def __init__(
+        self,
+        copy_source: Optional[str],
+        copy_targets: List[str],
+        rename: Optional[List[str]],
+        attachment_targets: List[str],
+        skipped_columns: Optional[List[str]] = None,
+    ):
+        self.copy_source = copy_source
+        self.copy_targets = tuple(copy_targets)
+        self.rename = tuple(rename) if rename else None
+        self.attachment_targets = tuple(attachment_targets)
+        self.skipped_columns = tuple(skipped_columns or [])
+
+    def apply(self, data: ATDATATYPE) -> ATDATATYPE:
+        fields = data["fields"]
+        for column in self.skipped_columns:
+            fields.pop(column, None)
+        for target in self.attachment_targets:
+            fields[target] = []
+        if self.copy_source is not None:
+            value = fields[self.copy_source]
+            for target in self.copy_targets:
+                fields[target] = value
+        if self.rename:
+            fields[self.rename[1]] = fields.pop(self.rename[0])
+        return data
+
+    def apply_all(self, rows: Iterable[ATDATATYPE]) -> Iterator[ATDATATYPE]:
+        """Transform rows lazily as they stream through."""
+        for data in rows:
+            yield self.apply(data)
@@ -2,27 +2,49 @@
 Concurrent upload worker pipeline for Airlift.
 
 This module coordinates threaded row uploads and attachment handling between
-Dropbox and Airtable clients.
+Dropbox and Airtable clients. Rows are parsed and transformed as they are
+pulled from the input, pass through a pool of attachment workers and are
+handed over a bounded queue to a separate pool of Airtable batch writers.
 """
 
 import logging
 import concurrent.futures
+import queue
 import threading
-from airlift.airtable_client import new_client
-from typing import Dict, List
-from queue import Queue
+from airlift.airtable_client import new_client, upsert_fields, is_missing_record, AIRTABLE_BATCH_SIZE
+from typing import Dict, Iterable, List, Tuple
 from airlift.dropbox_client import dropbox_client
 import os
 from tqdm import tqdm
 from airlift.utils_exceptions import CriticalError
+from airlift.rate_limiter import AdaptiveConcurrency
+from contextlib import nullcontext
 
 logger = logging.getLogger(__name__)
-ATDATA = List[Dict[str, Dict[str, str]]]
+ATDATA = Iterable[Dict[str, Dict[str, str]]]
+ADAPTIVE_MAX_WORKERS = 16
+# Rows buffered per batch writer between the attachment and write stages
+WRITE_QUEUE_BATCHES = 2
+# How often a stage blocked on the queue checks whether the upload stopped
+QUEUE_POLL_INTERVAL = 0.1
+# Marks the end of the rows for a batch writer
+_END = object()
+
+
+class _SharedUpload:
+    """Result of one attachment upload that other workers may wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.url = None
+        self.error = None
 
 
 class Upload:
-    def __init__(self,client: new_client, new_data:ATDATA,dbx:dropbox_client,args:dict):
+    def __init__(self,client: new_client, new_data:ATDATA,dbx:dropbox_client,args:dict,sync_state=None,file_keys=None):
         self.dbx = dbx
+        self.sync_state = sync_state
+        self.file_keys = file_keys
         self.new_data = new_data
         self.client = client
         self.dirname = os.path.dirname(args.csv_file)
@@ -31,9 +53,47 @@ class Upload:
         self.attachment_columns_map=args.attachment_columns_map
         self.columns_copy=args.columns_copy
         self.rename_key_column=args.rename_key_column
-        self.workers = args.workers if args.workers else 5
+        self.upsert_on = upsert_fields(args) if args.upsert_on is not None else None
+        if args.adaptive_concurrency:
+            # --workers is the ceiling the controller may grow to
+            self.workers = args.workers if args.workers else ADAPTIVE_MAX_WORKERS
+            # Dropbox and Airtable congest independently, so each gets its own
+            self.dropbox_concurrency = AdaptiveConcurrency(
+                maximum=self.workers, throttle_count=self._dropbox_retries
+            )
+            self.airtable_concurrency = AdaptiveConcurrency(
+                maximum=self.workers,
+                throttle_count=lambda: self.client.limiter.throttle_count,
+                wait_time=self.client.limiter.waited,
+            )
+        else:
+            self.workers = args.workers if args.workers else 5
+            self.dropbox_concurrency = None
+            self.airtable_concurrency = None
+        self.attachment_workers = (
+            args.attachment_workers if args.attachment_workers else self.workers
+        )
+        self.writer_workers = args.writer_workers if args.writer_workers else self.workers
         self.log = args.log
         self.stop_event = threading.Event()
+        # Bounded, so slow writers hold back the attachment stage and the input
+        self._write_queue = queue.Queue(
+            maxsize=self.writer_workers * AIRTABLE_BATCH_SIZE * WRITE_QUEUE_BATCHES
+        )
+        self._rows = None
+        self._rows_lock = threading.Lock()
+        # normalized local path -> upload of that file during this run
+        self._attachment_uploads: Dict[str, _SharedUpload] = {}
+        self._attachment_lock = threading.Lock()
+
+    def _dropbox_retries(self) -> int:
+        return self.dbx.retry_count if self.dbx else 0
+
+    @staticmethod
+    def _request_slot(concurrency):
+        if concurrency:
+            return concurrency.slot()
+        return nullcontext()
 
     def write_log(self, file_path, line: str) -> None:
         if not file_path:
@@ -58,9 +118,7 @@ class Upload:
             }
         ]
 
-    def _upload_attachment_for_field(
-        self, data: Dict, field_name: str, value: str
-    ) -> None:
+    def _attachment_file(self, value: str) -> str:
         if value is None or (isinstance(value, str) and not value.strip()):
             raise FileNotFoundError("Attachment filename is empty")
         file_path = self._attachment_local_path(value)
@@ -68,32 +126,198 @@ class Upload:
             raise FileNotFoundError(
                 f"Attachment file not found: {file_path}"
             )
-        download_url = self.dbx.upload_to_dropbox(file_path)
+        return file_path
+
+    def _upload_attachment_for_field(
+        self, data: Dict, field_name: str, value: str
+    ) -> None:
+        file_path = self._attachment_file(value)
+        download_url = self._attachment_url(file_path)
         data["fields"][field_name] = self._attachment_payload(
             file_path, download_url
         )
 
+    def _attachment_url(self, file_path: str) -> str:
+        """Upload a file once per run; concurrent callers wait for the same upload.
+
+        Failed uploads are not remembered, so a later row tries again.
+        """
+        with self._attachment_lock:
+            shared = self._attachment_uploads.get(file_path)
+            owner = shared is None
+            if owner:
+                shared = _SharedUpload()
+                self._attachment_uploads[file_path] = shared
+        if not owner:
+            shared.done.wait()
+            if shared.error is not None:
+                raise shared.error
+            return shared.url
+        try:
+            # Unchanged files with a live link from an earlier run cost no request
+            download_url = self.dbx.cached_download_url(file_path)
+            if download_url is None:
+                with self._request_slot(self.dropbox_concurrency):
+                    download_url = self.dbx.upload_to_dropbox(file_path)
+        except Exception as e:
+            with self._attachment_lock:
+                del self._attachment_uploads[file_path]
+            shared.error = e
+            shared.done.set()
+            raise
+        shared.url = download_url
+        shared.done.set()
+        return download_url
+
+    @staticmethod
+    def _row_label(data: Dict) -> str:
+        fields = data.get("fields") or {}
+        label = next(iter(fields.values()), "") if fields else ""
+        return str(label)[:80]
+
+    def _flush_batch(self, batch: List[Dict], progress_bar) -> None:
+        """Create a batch of finished rows and report failures per row."""
+        try:
+            updates = [data for data in batch if "id" in data]
+            creates = [data for data in batch if "id" not in data]
+            failed = []
+            if updates:
+                with self._request_slot(self.airtable_concurrency):
+                    failed_updates = self.client.batch_update(updates)
+                deleted, failed_updates = self._deleted_records(failed_updates)
+                failed += failed_updates
+                creates += deleted
+            if creates:
+                with self._request_slot(self.airtable_concurrency):
+                    if self.upsert_on:
+                        failed += self.client.batch_upsert(creates, self.upsert_on)
+                    else:
+                        failed += self.client.batch_upload(creates)
+        except Exception as e:
+            logger.error(e)
+            raise CriticalError("Unable to upload data to Airtable") from e
+        self._report_batch(batch, failed, progress_bar)
+
+    def _deleted_records(self, failed) -> Tuple[List[Dict], list]:
+        """Take the updates whose record was deleted in Airtable out of `failed`.
+
+        The rows lose the stale record id, in the sync state too, so they
+        can be sent again as new records.
+
+        Returns:
+            tuple: rows to create instead, and the remaining failures
+        """
+        deleted = [data for data, error in failed if is_missing_record(error)]
+        if not deleted:
+            return [], failed
+        logger.warning(
+            f"{len(deleted)} records were deleted in Airtable since the last sync, creating them again"
+        )
+        for data in deleted:
+            del data["id"]
+        if self.sync_state:
+            self.sync_state.forget_rows(deleted)
+        return deleted, [(data, error) for data, error in failed if not is_missing_record(error)]
+
+    def _report_batch(self, batch: List[Dict], failed, progress_bar) -> None:
+        """Log the rows Airtable refused and record the written ones."""
+        for data, error in failed:
+            label = self._row_label(data)
+            logger.error("Row upload failed [%s]: %s", label, error)
+            self.write_log(self.log, f"{label} upload failed: {error}")
+            tqdm.write(f"{label} upload failed: {error}")
+        if self.sync_state:
+            failed_rows = {id(data) for data, _error in failed}
+            self.sync_state.record_rows(
+                data for data in batch if id(data) not in failed_rows
+            )
+        if self.file_keys:
+            # Failed updates still carry the id of the record they belong to
+            self.file_keys.record_rows(batch)
+        progress_bar.update(len(batch))
+
+    def _next_row(self):
+        """Hand the next row to a worker; rows may still be parsed lazily."""
+        with self._rows_lock:
+            return next(self._rows, None)
+
+    def _put_row(self, data) -> bool:
+        """Queue a row for the writers; give up once the upload has stopped."""
+        while not self.stop_event.is_set():
+            try:
+                self._write_queue.put(data, timeout=QUEUE_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _log_discarded(count: int) -> None:
+        if count:
+            logger.warning(
+                "Upload stopped, discarded %s prepared rows that were not written", count
+            )
+
+    def _discard_queued_rows(self) -> None:
+        """Empty the write queue after a stop and log the rows left in it."""
+        count = 0
+        while True:
+            try:
+                data = self._write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if data is not _END:
+                count += 1
+        self._log_discarded(count)
+
+    def _run_stage(self, stage, *args) -> None:
+        """Run one stage worker; a failure stops every stage."""
+        try:
+            stage(*args)
+        except BaseException:
+            self.stop_event.set()
+            raise
+
     def upload_data(self) -> None:
         logger.info("Uploding data now!")
-        progress_bar = tqdm(total=len(self.new_data),leave=False)
+        # A streamed file has no known length; tqdm then shows a running count
+        total = len(self.new_data) if hasattr(self.new_data, "__len__") else None
+        progress_bar = tqdm(total=total,leave=False)
         
         try:
-            data_queue = Queue()
-            for data in self.new_data:
-                data_queue.put(data)
-
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
-                futures = [executor.submit(self._worker,data_queue, progress_bar) for _ in
-                            range(self.workers)]    
-                
-                for future in concurrent.futures.as_completed(futures):
+            self._rows = iter(self.new_data)
+
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.attachment_workers + self.writer_workers
+            ) as executor:
+                writers = [
+                    executor.submit(self._run_stage, self._writer, progress_bar)
+                    for _ in range(self.writer_workers)
+                ]
+                preparers = [
+                    executor.submit(self._run_stage, self._worker)
+                    for _ in range(self.attachment_workers)
+                ]
+                concurrent.futures.wait(preparers)
+                for _ in writers:
+                    if not self._put_row(_END):
+                        break
+                concurrent.futures.wait(writers)
+                if self.stop_event.is_set():
+                    self._discard_queued_rows()
+
+                for future in preparers + writers:
                     try:
                         future.result()  # This will re-raise any exception caught in the worker
                     except CriticalError as e:
                         logger.error('A critical error occurred in one of the worker threads: %s', str(e))
-                        self.stop_event.set()  # Signal other workers to stop
                         break
-                #concurrent.futures.wait(futures, timeout=None)
+            if self.airtable_concurrency:
+                logger.debug(
+                    "Finished with %s Dropbox and %s Airtable requests in flight",
+                    self.dropbox_concurrency.limit,
+                    self.airtable_concurrency.limit,
+                )
 
         except Exception as e:
             #logger.error('Something went wrong while uploading the data: %s', str(e))
@@ -101,86 +325,92 @@ class Upload:
         
 
 
-    def _worker(self,data_queue: Queue, progress_bar) -> None:
+    def _writer(self, progress_bar) -> None:
+        """Batch prepared rows from the queue and write them to Airtable."""
+        batch = []
         while True:
             if self.stop_event.is_set():
-                break
+                self._log_discarded(len(batch))
+                return
             try:
-                data = data_queue.get_nowait()
-                for key, value in data['fields'].items():
-                    if self.attachment_columns:
-                        if self.dbx:
-                            if key in self.attachment_columns:
-                                try:
-                                    self._upload_attachment_for_field(
-                                        data, key, value
-                                    )
-                                except Exception as e:
-                                    logger.error(
-                                        "Attachment upload failed [%s] %s: "
-                                        "%s: %s",
-                                        key,
-                                        value,
-                                        type(e).__name__,
-                                        e,
-                                    )
-                                    self.write_log(
-                                        self.log,
-                                        f"{value} attachment failed: {e}",
-                                    )
-                                    tqdm.write(
-                                        f"{value} attachment failed: {e}"
-                                    )
-                                    data["fields"][key] = []
-
-                    if self.attachment_columns_map:
-                        if self.dbx:
-                            for attachments in self.attachment_columns_map:
-                                if key == attachments[0]:
-                                    try:
-                                        self._upload_attachment_for_field(
-                                            data, attachments[1], value
-                                        )
-                                    except Exception as e:
-                                        logger.error(
-                                            "Attachment upload failed "
-                                            "[%s -> %s] %s: %s: %s",
-                                            attachments[0],
-                                            attachments[1],
-                                            value,
-                                            type(e).__name__,
-                                            e,
-                                        )
-                                        self.write_log(
-                                            self.log,
-                                            f"{value} attachment failed: {e}",
-                                        )
-                                        tqdm.write(
-                                            f"{value} attachment failed: {e}"
-                                        )
-                                        data["fields"][attachments[1]] = []
-                                #ic(data['fields'])
-
-                        else:
-                            logger.error("Dropbox token not provided! Aborting the upload!")
-
-                if self.attachment_columns_map:
-                    for _source, target in self.attachment_columns_map:
-                        attachment_value = data["fields"].get(target)
-                        if attachment_value == []:
-                            logger.warning(
-                                "%s has no attachment (upload failed or "
-                                "file missing)",
-                                target,
+                data = self._write_queue.get(timeout=QUEUE_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if data is _END:
+                break
+            batch.append(data)
+            if len(batch) >= AIRTABLE_BATCH_SIZE:
+                self._flush_batch(batch, progress_bar)
+                batch = []
+
+        if batch:
+            self._flush_batch(batch, progress_bar)
+
+    def _attachment_jobs(self, data: Dict) -> List[Tuple[str, str, str]]:
+        """(log label, target field, file name) of each attachment of a row."""
+        jobs = []
+        for key, value in data['fields'].items():
+            if self.attachment_columns:
+                if self.dbx:
+                    if key in self.attachment_columns:
+                        jobs.append((key, key, value))
+
+            if self.attachment_columns_map:
+                if self.dbx:
+                    for attachments in self.attachment_columns_map:
+                        if key == attachments[0]:
+                            jobs.append(
+                                (f"{attachments[0]} -> {attachments[1]}", attachments[1], value)
                             )
-                self.client.single_upload(data)
-                progress_bar.update(1)
-            except Exception as e:
-                if data_queue.empty():
-                    break
                 else:
-                    logger.error(e)
-                    raise CriticalError
+                    logger.error("Dropbox token not provided! Aborting the upload!")
+        return jobs
+
+    def _attachment_failed(
+        self, data: Dict, label: str, target: str, value: str, error: Exception
+    ) -> None:
+        logger.error(
+            "Attachment upload failed [%s] %s: %s: %s",
+            label,
+            value,
+            type(error).__name__,
+            error,
+        )
+        self.write_log(self.log, f"{value} attachment failed: {error}")
+        tqdm.write(f"{value} attachment failed: {error}")
+        data["fields"][target] = []
 
-                
+    def _warn_missing_attachments(self, data: Dict) -> None:
+        if self.attachment_columns_map:
+            for _source, target in self.attachment_columns_map:
+                attachment_value = data["fields"].get(target)
+                if attachment_value == []:
+                    logger.warning(
+                        "%s has no attachment (upload failed or "
+                        "file missing)",
+                        target,
+                    )
+
+    def _worker(self) -> None:
+        """Upload the attachments of each row and hand it to the writers."""
+        while True:
+            if self.stop_event.is_set():
+                return
+            data = self._next_row()
+            if data is None:
+                break
+            try:
+                for label, target, value in self._attachment_jobs(data):
+                    try:
+                        self._upload_attachment_for_field(data, target, value)
+                    except Exception as e:
+                        self._attachment_failed(data, label, target, value, e)
+                self._warn_missing_attachments(data)
+                if not self._put_row(data):
+                    return
+            except CriticalError:
+                raise
+            except Exception as e:
+                logger.error(e)
+                raise CriticalError
 
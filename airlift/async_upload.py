@@ -0,0 +1,515 @@
+"""
+asyncio upload engine for Airlift.
+
+This module is the --engine async alternative to the thread pools in
+airtable_upload. Rows are written to the Airtable REST API and attachments are
+sent to the Dropbox HTTP endpoints through one pooled httpx client, so hundreds
+of attachment uploads can be in flight on a single event loop. Requests draw
+from the same per-base rate limiter and use the same attachment cache as the
+threaded engine.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+from tqdm import tqdm
+
+from airlift.airtable_client import (
+    AIRTABLE_BATCH_SIZE,
+    isolate_invalid_rows,
+    new_client,
+    record_fields,
+    split_mergeable,
+)
+from airlift.airtable_upload import Upload, WRITE_QUEUE_BATCHES
+from airlift.attachment_cache import LINK_TEMPORARY
+from airlift.dropbox_client import DROPBOX_COMMIT_BATCH_SIZE, DROPBOX_SESSION_THRESHOLD
+from airlift.rate_limiter import (
+    AIRTABLE_THROTTLE_WAIT,
+    MAX_THROTTLE_RETRIES,
+    TRANSPORT_RETRIES,
+    retry_after_seconds,
+    transport_backoff,
+)
+from airlift.utils_exceptions import CriticalError
+
+logger = logging.getLogger(__name__)
+
+AIRTABLE_API_URL = "https://api.airtable.com/v0"
+DROPBOX_API_URL = "https://api.dropboxapi.com/2"
+DROPBOX_CONTENT_URL = "https://content.dropboxapi.com/2"
+# Attachment uploads in flight when --attachment-workers is not given
+ASYNC_ATTACHMENT_TASKS = 64
+# Rows parsed per hop to the reader thread
+ROW_PULL_SIZE = 100
+# Bytes of an attachment read from disk at a time while it is sent
+ASYNC_READ_SIZE = 1 << 20
+ASYNC_TIMEOUT = 60.0
+DROPBOX_MAX_ATTEMPTS = 5
+
+_END = object()
+
+
+class _DropboxCommitError(RuntimeError):
+    """A file in a finish_batch_v2 call that Dropbox did not commit."""
+
+    def __init__(self, failure: Dict):
+        super().__init__(f"Dropbox upload commit failed: {failure}")
+        self.retryable = "too_many_write_operations" in json.dumps(failure)
+
+
+class _AsyncCommitBatcher:
+    """Group commits of closed upload sessions into finish_batch_v2 calls.
+
+    The event loop counterpart of the Dropbox client's batcher: the first
+    upload to arrive commits everything queued so far, and uploads arriving
+    while that call runs are committed together once it returns.
+    """
+
+    def __init__(self, finish_batch, max_entries: int = DROPBOX_COMMIT_BATCH_SIZE):
+        self._finish_batch = finish_batch
+        self.max_entries = max_entries
+        self._pending: List[Tuple[Dict, asyncio.Future]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def commit(self, entry: Dict) -> Dict:
+        """Commit `entry` with whatever else is queued and return its result."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((entry, future))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._commit_pending())
+        return await future
+
+    async def _commit_pending(self) -> None:
+        try:
+            while self._pending:
+                batch = self._pending[:self.max_entries]
+                del self._pending[:self.max_entries]
+                try:
+                    outcomes = await self._finish_batch([entry for entry, _future in batch])
+                except Exception as exc:
+                    outcomes = [exc] * len(batch)
+                for (_entry, future), outcome in zip(batch, outcomes):
+                    if future.done():
+                        continue
+                    if isinstance(outcome, Exception):
+                        future.set_exception(outcome)
+                    else:
+                        future.set_result(outcome)
+        finally:
+            self._task = None
+
+
+def _import_httpx():
+    """httpx is only needed for --engine async, so it is imported on demand."""
+    try:
+        import httpx
+    except ImportError as e:
+        raise CriticalError(
+            "--engine async needs the httpx package, install it with the async extra: poetry install --extras async"
+        ) from e
+    return httpx
+
+
+class AsyncUpload(Upload):
+    """Upload rows and attachments as tasks on one event loop."""
+
+    def __init__(self, client: new_client, new_data, dbx, args, sync_state=None, file_keys=None):
+        self.httpx = _import_httpx()
+        super().__init__(client, new_data, dbx, args, sync_state, file_keys)
+        if self.airtable_concurrency:
+            logger.warning("--adaptive-concurrency does not apply to the async engine")
+            self.dropbox_concurrency = None
+            self.airtable_concurrency = None
+        # Tasks are cheap, so many more uploads can wait on Dropbox than threads
+        self.attachment_workers = (
+            args.attachment_workers if args.attachment_workers else ASYNC_ATTACHMENT_TASKS
+        )
+        self._http = None
+        self._commit_batcher = _AsyncCommitBatcher(self._finish_batch)
+        # normalized local path -> upload of that file during this run
+        self._attachment_tasks: Dict[str, asyncio.Future] = {}
+
+    def upload_data(self) -> None:
+        logger.info("Uploding data now!")
+        # A streamed file has no known length; tqdm then shows a running count
+        total = len(self.new_data) if hasattr(self.new_data, "__len__") else None
+        progress_bar = tqdm(total=total,leave=False)
+
+        try:
+            asyncio.run(self._upload(progress_bar))
+        except CriticalError as e:
+            logger.error('A critical error occurred in one of the upload tasks: %s', str(e))
+        except Exception as e:
+            raise CriticalError('Something went wrong while uploading the data') from e
+
+    async def _upload(self, progress_bar) -> None:
+        httpx = self.httpx
+        limits = httpx.Limits(max_connections=self.attachment_workers + self.writer_workers)
+        async with httpx.AsyncClient(
+            limits=limits, timeout=httpx.Timeout(ASYNC_TIMEOUT)
+        ) as http:
+            self._http = http
+            # Bounded like the threaded pipeline, so slow writers hold back parsing
+            rows = asyncio.Queue(maxsize=self.attachment_workers * 2)
+            prepared = asyncio.Queue(
+                maxsize=self.writer_workers * AIRTABLE_BATCH_SIZE * WRITE_QUEUE_BATCHES
+            )
+            reader = asyncio.create_task(self._read(rows))
+            preparers = [
+                asyncio.create_task(self._prepare(rows, prepared))
+                for _ in range(self.attachment_workers)
+            ]
+            writers = [
+                asyncio.create_task(self._write(prepared, progress_bar))
+                for _ in range(self.writer_workers)
+            ]
+            tasks = [reader, *preparers, *writers]
+            tasks.append(asyncio.create_task(
+                self._finish_stages(reader, preparers, writers, rows, prepared)
+            ))
+            # Stop every stage as soon as one of them fails
+            done, _pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION
+            )
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for task in tasks:
+                if task in done and not task.cancelled() and task.exception():
+                    self.stop_event.set()
+                    discarded = 0
+                    while not prepared.empty():
+                        if prepared.get_nowait() is not _END:
+                            discarded += 1
+                    self._log_discarded(discarded)
+                    raise task.exception()
+
+    async def _finish_stages(self, reader, preparers, writers, rows, prepared) -> None:
+        await reader
+        for _ in preparers:
+            await rows.put(_END)
+        await asyncio.gather(*preparers)
+        for _ in writers:
+            await prepared.put(_END)
+        await asyncio.gather(*writers)
+
+    async def _read(self, rows: asyncio.Queue) -> None:
+        """Parse and transform rows in a thread, a slice at a time."""
+        source = iter(self.new_data)
+        while True:
+            chunk = await asyncio.to_thread(
+                lambda: list(itertools.islice(source, ROW_PULL_SIZE))
+            )
+            if not chunk:
+                return
+            for data in chunk:
+                await rows.put(data)
+
+    async def _prepare(self, rows: asyncio.Queue, prepared: asyncio.Queue) -> None:
+        """Upload the attachments of each row and hand it to the writers."""
+        while True:
+            data = await rows.get()
+            if data is _END:
+                return
+            for label, target, value in self._attachment_jobs(data):
+                try:
+                    await self._upload_attachment_for_field_async(data, target, value)
+                except Exception as e:
+                    self._attachment_failed(data, label, target, value, e)
+            self._warn_missing_attachments(data)
+            await prepared.put(data)
+
+    async def _write(self, prepared: asyncio.Queue, progress_bar) -> None:
+        """Batch prepared rows and write them to Airtable."""
+        batch = []
+        while True:
+            try:
+                data = await prepared.get()
+            except asyncio.CancelledError:
+                self._log_discarded(len(batch))
+                raise
+            if data is _END:
+                break
+            batch.append(data)
+            if len(batch) >= AIRTABLE_BATCH_SIZE:
+                await self._flush_batch_async(batch, progress_bar)
+                batch = []
+
+        if batch:
+            await self._flush_batch_async(batch, progress_bar)
+
+    async def _upload_attachment_for_field_async(
+        self, data: Dict, field_name: str, value: str
+    ) -> None:
+        file_path = self._attachment_file(value)
+        download_url = await self._attachment_url_async(file_path)
+        data["fields"][field_name] = self._attachment_payload(
+            file_path, download_url
+        )
+
+    async def _attachment_url_async(self, file_path: str) -> str:
+        """Upload a file once per run; concurrent rows await the same upload.
+
+        Failed uploads are not remembered, so a later row tries again.
+        """
+        upload = self._attachment_tasks.get(file_path)
+        if upload is None:
+            upload = asyncio.ensure_future(self._upload_attachment(file_path))
+            self._attachment_tasks[file_path] = upload
+        try:
+            # Shielded so one row being cancelled doesn't cancel the shared upload
+            return await asyncio.shield(upload)
+        except Exception:
+            if self._attachment_tasks.get(file_path) is upload:
+                del self._attachment_tasks[file_path]
+            raise
+
+    async def _upload_attachment(self, file_path: str) -> str:
+        # Hashing and the manifest lookups touch the disk, so they run in threads
+        download_url = await asyncio.to_thread(self.dbx.cached_download_url, file_path)
+        if download_url is not None:
+            return download_url
+        local_path, content_hash, download_url = await asyncio.to_thread(
+            self.dbx.prepare_upload, file_path
+        )
+        if download_url is not None:
+            return download_url
+        if os.path.getsize(local_path) > DROPBOX_SESSION_THRESHOLD:
+            # Large files need upload sessions, which the Dropbox SDK handles
+            return await asyncio.to_thread(self.dbx.upload_to_dropbox, file_path)
+        dropbox_path = self.dbx.run_path(local_path)
+        name = os.path.basename(local_path)
+        size = os.path.getsize(local_path)
+        # Contents go to a closed session; the commit is shared with other uploads
+        session = await self._dropbox_request(
+            f"{DROPBOX_CONTENT_URL}/files/upload_session/start",
+            f"upload of {name}",
+            headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Length": str(size),
+                "Dropbox-API-Arg": json.dumps({"close": True}),
+            },
+            content=lambda: _file_chunks(local_path),
+        )
+        await self._commit_upload({
+            "cursor": {"session_id": session["session_id"], "offset": size},
+            "commit": {"path": dropbox_path, "mode": "overwrite", "mute": True},
+        }, name)
+        url, link_kind, link_expires = await self._download_link(dropbox_path)
+        return self.dbx.finish_upload(
+            content_hash, dropbox_path, url, link_kind, link_expires
+        )
+
+    async def _commit_upload(self, entry: Dict, name: str) -> Dict:
+        """Commit an upload session, retrying if Dropbox was too busy to write."""
+        delay_seconds = 2.0
+        for attempt in range(1, DROPBOX_MAX_ATTEMPTS + 1):
+            try:
+                return await self._commit_batcher.commit(entry)
+            except _DropboxCommitError as exc:
+                if not exc.retryable or attempt == DROPBOX_MAX_ATTEMPTS:
+                    raise
+                self.dbx.count_retry()
+                logger.warning(
+                    "Retrying Dropbox upload commit for %s after %s (attempt %s/%s)",
+                    name,
+                    exc,
+                    attempt,
+                    DROPBOX_MAX_ATTEMPTS,
+                )
+            await asyncio.sleep(delay_seconds)
+            delay_seconds = min(delay_seconds * 2, 60.0)
+
+    async def _finish_batch(self, entries: List[Dict]) -> list:
+        """Commit closed upload sessions in one finish_batch_v2 call.
+
+        Returns:
+            list: per entry, the committed file metadata or a _DropboxCommitError
+        """
+        result = await self._dropbox_request(
+            f"{DROPBOX_API_URL}/files/upload_session/finish_batch_v2",
+            f"commit of {len(entries)} uploads",
+            json_body={"entries": entries},
+        )
+        outcomes = result["entries"]
+        if len(outcomes) != len(entries):
+            raise RuntimeError("Dropbox returned a result for a different number of uploads")
+        return [
+            outcome if outcome[".tag"] == "success"
+            else _DropboxCommitError(outcome.get("failure", outcome))
+            for outcome in outcomes
+        ]
+
+    async def _download_link(self, dropbox_path: str) -> Tuple[str, str, Optional[float]]:
+        if self.dbx.temporary_links:
+            try:
+                temporary = await self._dropbox_request(
+                    f"{DROPBOX_API_URL}/files/get_temporary_link",
+                    f"link for {os.path.basename(dropbox_path)}",
+                    json_body={"path": dropbox_path},
+                )
+                return (
+                    temporary["link"],
+                    LINK_TEMPORARY,
+                    self.dbx.temporary_link_expiry(),
+                )
+            except self.httpx.HTTPStatusError as exc:
+                logger.debug(
+                    "Temporary Dropbox link failed for %s, using the Dropbox client: %s",
+                    dropbox_path,
+                    exc,
+                )
+        # Scope checks and shared links are handled by the Dropbox client
+        return await asyncio.to_thread(self.dbx.download_link, dropbox_path)
+
+    async def _dropbox_request(
+        self,
+        url: str,
+        description: str,
+        headers: Optional[Dict[str, str]] = None,
+        content=None,
+        json_body: Optional[Dict] = None,
+    ) -> Dict:
+        """POST to a Dropbox endpoint, retrying 429/5xx and dropped connections."""
+        delay_seconds = 2.0
+        for attempt in range(1, DROPBOX_MAX_ATTEMPTS + 1):
+            # Refreshing an expired token is a blocking HTTP call
+            access_token = await asyncio.to_thread(self.dbx.access_token)
+            request_headers = {"Authorization": f"Bearer {access_token}"}
+            request_headers.update(headers or {})
+            response = None
+            try:
+                response = await self._http.post(
+                    url,
+                    headers=request_headers,
+                    content=content() if content else None,
+                    json=json_body,
+                )
+            except self.httpx.TransportError as exc:
+                if attempt == DROPBOX_MAX_ATTEMPTS:
+                    raise
+                error = exc
+                wait = delay_seconds
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json()
+                if attempt == DROPBOX_MAX_ATTEMPTS:
+                    response.raise_for_status()
+                error = f"HTTP {response.status_code}"
+                wait = retry_after_seconds(response) or delay_seconds
+            self.dbx.count_retry()
+            logger.warning(
+                "Retrying Dropbox %s after %s (attempt %s/%s)",
+                description,
+                error,
+                attempt,
+                DROPBOX_MAX_ATTEMPTS,
+            )
+            await asyncio.sleep(wait)
+            delay_seconds = min(delay_seconds * 2, 60.0)
+
+    async def _flush_batch_async(self, batch: List[Dict], progress_bar) -> None:
+        """Create a batch of finished rows and report failures per row."""
+        try:
+            updates = [data for data in batch if "id" in data]
+            creates = [data for data in batch if "id" not in data]
+            failed = []
+            if updates:
+                failed_updates = await self._send_batch(updates, "PATCH", lambda rows: {
+                    "records": [{"id": data["id"], "fields": record_fields(data)} for data in rows],
+                    "typecast": True,
+                })
+                deleted, failed_updates = self._deleted_records(failed_updates)
+                failed += failed_updates
+                creates += deleted
+            if creates and self.upsert_on:
+                mergeable, failed_merge = split_mergeable(creates, self.upsert_on)
+                failed += failed_merge
+                if mergeable:
+                    failed += await self._send_batch(mergeable, "PATCH", lambda rows: {
+                        "performUpsert": {"fieldsToMergeOn": self.upsert_on},
+                        "records": [{"fields": record_fields(data)} for data in rows],
+                        "typecast": True,
+                    })
+            elif creates:
+                failed += await self._send_batch(creates, "POST", lambda rows: {
+                    "records": [{"fields": record_fields(data)} for data in rows],
+                    "typecast": True,
+                })
+        except Exception as e:
+            logger.error(e)
+            raise CriticalError("Unable to upload data to Airtable") from e
+        self._report_batch(batch, failed, progress_bar)
+
+    async def _send_batch(self, records: List[Dict], method: str, body):
+        """Send records through isolate_invalid_rows, like new_client does."""
+        steps = isolate_invalid_rows(records)
+        batch = next(steps)
+        while True:
+            try:
+                outcome = await self._airtable_request(method, body(batch))
+            except Exception as e:
+                outcome = e
+            try:
+                batch = steps.send(outcome)
+            except StopIteration as done:
+                return done.value
+
+    async def _airtable_request(self, method: str, body: Dict) -> List[Dict]:
+        """Send one request through the base's rate limiter, waiting out 429s.
+
+        Dropped connections and timeouts are sent again with the backoff the
+        threaded engine's session uses.
+        """
+        url = f"{AIRTABLE_API_URL}/{self.client.base_id}/{quote(self.client.table_id, safe='')}"
+        headers = {"Authorization": f"Bearer {self.client.api}"}
+        limiter = self.client.limiter
+        attempt = 0
+        transport_retries = 0
+        while True:
+            await limiter.acquire_async()
+            try:
+                response = await self._http.request(method, url, headers=headers, json=body)
+            except self.httpx.TransportError as exc:
+                if transport_retries >= TRANSPORT_RETRIES:
+                    raise
+                transport_retries += 1
+                logger.warning(
+                    "Retrying Airtable request after %s (attempt %s/%s)",
+                    exc,
+                    transport_retries,
+                    TRANSPORT_RETRIES,
+                )
+                await asyncio.sleep(transport_backoff(transport_retries))
+                continue
+            if response.status_code != 429 or attempt >= MAX_THROTTLE_RETRIES:
+                response.raise_for_status()
+                return response.json()["records"]
+            attempt += 1
+            wait = retry_after_seconds(response)
+            if wait is None:
+                wait = AIRTABLE_THROTTLE_WAIT
+            logger.warning(
+                "Airtable rate limit hit, waiting %.1fs (attempt %s/%s)",
+                wait,
+                attempt,
+                MAX_THROTTLE_RETRIES,
+            )
+            limiter.pause(wait)
+
+
+async def _file_chunks(local_path: str):
+    """Read a file for upload without blocking the event loop."""
+    with open(local_path, "rb") as local_file:
+        while True:
+            chunk = await asyncio.to_thread(local_file.read, ASYNC_READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
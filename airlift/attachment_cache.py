@@ -0,0 +1,140 @@
+"""
+Persistent attachment cache for Airlift.
+
+This module remembers where files with a given Dropbox content hash were
+uploaded by earlier runs, together with the last download link handed out
+for them, and keeps a manifest of local files by path, size and modification
+time so unchanged files are neither hashed nor uploaded again.
+"""
+
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+from pathlib import Path
+from typing import Optional
+
+from airlift.utils_cache import safe_name, state_file
+
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_CACHE_FILE = "airlift-attachments-{app_key}-{folder}.sqlite"
+
+LINK_TEMPORARY = "temporary"
+LINK_SHARED = "shared"
+
+CachedUpload = namedtuple(
+    "CachedUpload", ["dropbox_path", "link", "link_kind", "link_expires"]
+)
+
+
+class AttachmentCache:
+    """SQLite-backed maps of local file -> content hash -> Dropbox upload."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "content_hash TEXT PRIMARY KEY, dropbox_path TEXT NOT NULL, "
+                "link TEXT, link_kind TEXT, link_expires REAL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "local_path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, content_hash TEXT NOT NULL)"
+            )
+        logger.debug(f"Using attachment cache {self.path}")
+
+    @classmethod
+    def open_default(
+        cls, app_key: str, main_folder: str, log_file: Optional[Path] = None
+    ) -> "AttachmentCache":
+        """Open the cache of a Dropbox app and main folder, next to --log or in the cache dir.
+
+        Each app key and folder (/Airlift or /Marker Data) gets its own file,
+        so uploads and deleted folders of one never touch the other.
+        """
+        name = ATTACHMENT_CACHE_FILE.format(
+            app_key=safe_name(app_key), folder=safe_name(main_folder.strip("/"))
+        )
+        return cls(state_file(name, log_file))
+
+    def file_hash(self, local_path: str, size: int, mtime_ns: int) -> Optional[str]:
+        """Return the content hash of a local file if it has not changed since."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content_hash FROM files "
+                "WHERE local_path = ? AND size = ? AND mtime_ns = ?",
+                (local_path, size, mtime_ns),
+            ).fetchone()
+        return row[0] if row else None
+
+    def remember_file(
+        self, local_path: str, size: int, mtime_ns: int, content_hash: str
+    ) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (local_path, size, mtime_ns, content_hash) "
+                "VALUES (?, ?, ?, ?)",
+                (local_path, size, mtime_ns, content_hash),
+            )
+
+    def lookup(self, content_hash: str) -> Optional[CachedUpload]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT dropbox_path, link, link_kind, link_expires FROM uploads "
+                "WHERE content_hash = ?",
+                (content_hash,),
+            ).fetchone()
+        return CachedUpload(*row) if row else None
+
+    def valid_link(self, content_hash: str, now: float) -> Optional[str]:
+        """Return the stored link if it is a temporary link that has not expired.
+
+        A shared link serves whatever is at its path now, so it is only reused
+        after Dropbox confirmed the file there still has this content hash.
+        """
+        cached = self.lookup(content_hash)
+        if cached is None or not cached.link or cached.link_kind != LINK_TEMPORARY:
+            return None
+        if cached.link_expires is None or cached.link_expires <= now:
+            return None
+        return cached.link
+
+    def remember(
+        self,
+        content_hash: str,
+        dropbox_path: str,
+        link: Optional[str] = None,
+        link_kind: Optional[str] = None,
+        link_expires: Optional[float] = None,
+    ) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads "
+                "(content_hash, dropbox_path, link, link_kind, link_expires) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (content_hash, dropbox_path, link, link_kind, link_expires),
+            )
+
+    def forget(self, content_hash: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM uploads WHERE content_hash = ?", (content_hash,)
+            )
+
+    def forget_folder(self, folder: str) -> None:
+        """Drop every upload stored under a Dropbox folder that was deleted."""
+        prefix = folder.rstrip("/") + "/"
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM uploads WHERE substr(lower(dropbox_path), 1, ?) = ?",
+                (len(prefix), prefix.lower()),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -5,6 +5,7 @@ This module validates required arguments, dispatches operation modes, configures
 logging, and coordinates the end-to-end upload/delete flows.
 """
 
+import itertools
 import logging
 import os
 import signal
@@ -12,15 +13,21 @@ import sys
 import pathlib
 from pathlib import Path
 from typing import Any, Optional
+from datetime import datetime, timezone
 
 from airlift.version import __version__
 from airlift.utils_exceptions import CriticalError,AirtableError 
 from airlift.cli_args import parse_args
-from airlift.csv_data import csv_read
+from airlift.csv_data import csv_stream
 from airlift.airtable_upload import Upload
-from airlift.json_data import json_read
-from airlift.airtable_client import new_client
-from airlift.dropbox_client import dropbox_client, change_refresh_access_token, empty_dropbox_folder
+from airlift.async_upload import AsyncUpload
+from airlift.json_data import NDJSON_SUFFIXES, json_stream, ndjson_stream
+from airlift.airtable_client import AIRTABLE_DELETE_WORKERS, new_client, upsert_fields
+from airlift.incremental_sync import FileKeys, delete_missing_records, incremental_rows
+from airlift.sync_state import SyncState
+from airlift.attachment_cache import AttachmentCache
+from airlift.rate_limiter import AIRTABLE_RATE_BURST, AIRTABLE_RATE_LIMIT
+from airlift.dropbox_client import dropbox_client, change_refresh_access_token, dropbox_app_key, dropbox_main_folder, empty_dropbox_folder, prune_dropbox_folder
 from icecream import ic
 
 logger = logging.getLogger(__name__)
@@ -49,6 +56,14 @@ def _validate_required_args(args) -> None:
             _print_missing_args_error(missing_args)
         return
     
+    # Pruning old Dropbox run folders without a file only needs dropbox-token
+    if _retention_requested(args) and not args.csv_file:
+        if not args.dropbox_token:
+            missing_args.append("--dropbox-token")
+        if missing_args:
+            _print_missing_args_error(missing_args)
+        return
+    
     # All other modes require token, base, and table
     if not args.token:
         missing_args.append("--token")
@@ -57,8 +72,8 @@ def _validate_required_args(args) -> None:
     if not args.table:
         missing_args.append("--table")
     
-    # Delete all database entries mode doesn't need a file
-    if args.delete_all_database_entries:
+    # Delete all or matching database entries mode doesn't need a file
+    if args.delete_all_database_entries or args.delete_by_formula:
         if missing_args:
             _print_missing_args_error(missing_args)
         return
@@ -70,16 +85,68 @@ def _validate_required_args(args) -> None:
     if missing_args:
         _print_missing_args_error(missing_args)
 
+    # Checked before anything is created in Dropbox or Airtable
+    if args.upsert_on is None:
+        for option, requested in (
+            ("--incremental", args.incremental),
+            ("--delete-missing", args.delete_missing),
+        ):
+            if requested:
+                _print_args_error(f"{option} needs --upsert-on to match rows to records")
+    else:
+        try:
+            upsert_fields(args)
+        except CriticalError as e:
+            _print_args_error(str(e))
+
+
+def _retention_requested(args) -> bool:
+    return args.dropbox_retain_days is not None or args.dropbox_retain_runs is not None
+
 
 def _print_missing_args_error(missing_args: list) -> None:
     """Print error message for missing arguments and exit."""
-    import sys
+    _print_args_error(f"the following arguments are required: {', '.join(missing_args)}")
+
+
+def _print_args_error(message: str) -> None:
+    """Print error message for invalid arguments and exit."""
     print("usage: airlift [-h] --token TOKEN --base BASE --table TABLE [OPTION]... FILE")
     print()
-    print(f"airlift: error: the following arguments are required: {', '.join(missing_args)}")
+    print(f"airlift: error: {message}")
     sys.exit(2)
 
 
+def _airtable_client(args) -> new_client:
+    """Create the Airtable client with the requested rate limits."""
+    return new_client(
+        token=args.token,
+        base=args.base,
+        table=args.table,
+        rate_limit=args.rate_limit if args.rate_limit else AIRTABLE_RATE_LIMIT,
+        rate_burst=args.rate_burst if args.rate_burst else AIRTABLE_RATE_BURST,
+    )
+
+
+def _attachment_cache(args: Any) -> AttachmentCache:
+    """Open the attachment cache of the Dropbox app and folder in use."""
+    return AttachmentCache.open_default(
+        dropbox_app_key(args.dropbox_token), dropbox_main_folder(args.md), args.log
+    )
+
+
+def _forget_run_folders(folders: list, args: Any) -> None:
+    """Drop cached uploads that lived in deleted run folders."""
+    if not folders:
+        return
+    attachment_cache = _attachment_cache(args)
+    try:
+        for folder in folders:
+            attachment_cache.forget_folder(folder)
+    finally:
+        attachment_cache.close()
+
+
 def cli(*argv: str) -> None:
     args = None
     try:
@@ -98,8 +165,20 @@ def cli(*argv: str) -> None:
             logger.info(f"Target: Base={args.base}, Table={args.table}")
             
             # Create Airtable client and delete all records
-            airtable_client = new_client(token=args.token, base=args.base, table=args.table)
-            deleted_count = airtable_client.delete_all_records()
+            airtable_client = _airtable_client(args)
+            deleted_count = airtable_client.delete_all_records(
+                workers=args.workers if args.workers else AIRTABLE_DELETE_WORKERS
+            )
+            logger.info(f"Operation complete. Deleted {deleted_count} records.")
+
+        # Handle deleting the entries that match a formula
+        elif args.delete_by_formula:
+            logger.info(f"Target: Base={args.base}, Table={args.table}")
+            airtable_client = _airtable_client(args)
+            deleted_count = airtable_client.delete_by_formula(
+                args.delete_by_formula,
+                workers=args.workers if args.workers else AIRTABLE_DELETE_WORKERS,
+            )
             logger.info(f"Operation complete. Deleted {deleted_count} records.")
 
         # Handle empty Dropbox folder operation
@@ -110,42 +189,107 @@ def cli(*argv: str) -> None:
             
             # Empty the Dropbox folder contents
             deleted_count = empty_dropbox_folder(args.dropbox_token, args.md)
+            attachment_cache = _attachment_cache(args)
+            try:
+                attachment_cache.forget_folder(f"/{folder_name}")
+            finally:
+                attachment_cache.close()
             logger.info(f"Operation complete. Deleted {deleted_count} items from '/{folder_name}'.")
 
+        # Handle pruning old Dropbox run folders without an upload
+        elif _retention_requested(args) and not args.csv_file and not args.dropbox_refresh_token:
+            deleted = prune_dropbox_folder(
+                args.dropbox_token, args.md, args.dropbox_retain_days, args.dropbox_retain_runs
+            )
+            _forget_run_folders(deleted, args)
+            logger.info(f"Operation complete. Deleted {len(deleted)} run folders.")
+
         elif not args.dropbox_refresh_token: #if dropbox-refresh-token flag is not present, continue normal procedure
 
             #creating drop box client
+            attachment_cache = None
             if args.dropbox_token:
-                dbx = dropbox_client(args.dropbox_token,args.md)
+                #remembers uploaded files by content hash across runs
+                attachment_cache = _attachment_cache(args)
+                dbx = dropbox_client(args.dropbox_token,args.md,attachment_cache=attachment_cache)
             else:
                 dbx = None
 
             #creating airtable client
-            airtable_client = new_client(token=args.token,base=args.base,table=args.table)
+            airtable_client = _airtable_client(args)
 
             logger.info(f"Validating {args.csv_file.name} and Airtable Schema")
 
             suffix = pathlib.Path(args.csv_file.name).suffix
 
             #converting data into airtable supported format
-            if "csv" in suffix:
-                data = csv_read(args.csv_file,args.fail_on_duplicate_csv_columns)
+            if suffix.lower() in NDJSON_SUFFIXES:
+                #one record per line, parsed across worker processes
+                data = itertools.chain.from_iterable(
+                    ndjson_stream(args.csv_file,args.fail_on_duplicate_csv_columns)
+                )
+            elif "csv" in suffix:
+                #rows are parsed in chunks as the upload consumes them
+                data = itertools.chain.from_iterable(
+                    csv_stream(args.csv_file,args.fail_on_duplicate_csv_columns)
+                )
             elif "json" in suffix:
-                data = json_read(args.csv_file,args.fail_on_duplicate_csv_columns)
+                data = itertools.chain.from_iterable(
+                    json_stream(args.csv_file,args.fail_on_duplicate_csv_columns)
+                )
             else:
                 raise CriticalError("File type not supported!")
 
             logger.info("Validation done!")
 
-            if not data:
-                raise CriticalError("File is empty!")
+            #validating data and transforming rows lazily (raises on an empty file)
+            data = airtable_client.stream_uploadable_data(data=data,args=args)
+
+            #remembering which records the file still has, to delete the rest afterwards
+            file_keys = None
+            if args.delete_missing:
+                file_keys = FileKeys(upsert_fields(args))
+                data = file_keys.track(data)
 
-            #validating data and creating an uploadable data
-            data = airtable_client.create_uploadable_data(data=data,args=args)
+            #only sending rows that are new or changed since the last upload
+            sync_state = None
+            if args.incremental:
+                if args.sync_state:
+                    sync_state = SyncState.for_table(args.base, args.table, args.log)
+                data = incremental_rows(airtable_client, data, args, sync_state, file_keys)
+            elif args.sync_state or args.verify_state:
+                logger.warning("--sync-state and --verify-state only apply with --incremental")
         
             #uploading the data
-            upload_instance = Upload(client=airtable_client, new_data=data,dbx=dbx,args=args)
-            upload_instance.upload_data()
+            upload_class = AsyncUpload if args.engine == "async" else Upload
+            upload_instance = upload_class(client=airtable_client, new_data=data,dbx=dbx,args=args,sync_state=sync_state,file_keys=file_keys)
+            try:
+                upload_instance.upload_data()
+                if file_keys:
+                    delete_missing_records(
+                        airtable_client,
+                        file_keys,
+                        workers=args.workers if args.workers else AIRTABLE_DELETE_WORKERS,
+                        state=sync_state,
+                    )
+                if sync_state and not upload_instance.stop_event.is_set():
+                    #later --verify-state runs skip the records this upload wrote
+                    sync_state.mark_synced(datetime.now(timezone.utc))
+                #removing run folders that fall outside the retention policy
+                if _retention_requested(args):
+                    if dbx:
+                        deleted = dbx.apply_retention(
+                            args.dropbox_retain_days, args.dropbox_retain_runs
+                        )
+                        for folder in deleted:
+                            attachment_cache.forget_folder(folder)
+                    else:
+                        logger.warning("--dropbox-retain-days and --dropbox-retain-runs need --dropbox-token")
+            finally:
+                if sync_state:
+                    sync_state.close()
+                if attachment_cache:
+                    attachment_cache.close()
         else:
             get_token = True
             while get_token:
@@ -36,7 +36,7 @@ def parse_args(argv: Sequence[str]) -> argparse.Namespace:
         "POSITIONAL": {
             "csv_file": {
                 "type": Path,
-                "help": "CSV or JSON file to upload",
+                "help": "CSV, JSON or NDJSON file to upload",
                 "metavar": "FILE",
                 "nargs":"?",
             }
@@ -69,7 +69,35 @@ def parse_args(argv: Sequence[str]) -> argparse.Namespace:
             },
             "--workers": {
                 "type": int,
-                "help": "total number of worker threads to upload your data (default: 5)"
+                "help": "worker threads per upload stage, attachments and Airtable writes (default: 5 each)"
+            },
+            "--attachment-workers": {
+                "type": int,
+                "metavar": "COUNT",
+                "help": "worker threads uploading attachments to Dropbox (default: --workers)",
+            },
+            "--writer-workers": {
+                "type": int,
+                "metavar": "COUNT",
+                "help": "worker threads writing batches to Airtable (default: --workers)",
+            },
+            "--engine": {
+                "choices": ["thread", "async"],
+                "help": "run uploads on worker threads or on one asyncio event loop, which needs httpx (default: thread)",
+            },
+            "--adaptive-concurrency": {
+                "action": "store_true",
+                "help": "tune the number of requests in flight automatically, up to --workers (default: 16)",
+            },
+            "--rate-limit": {
+                "type": float,
+                "metavar": "RATE",
+                "help": "maximum Airtable requests per second for the base (default: 5)",
+            },
+            "--rate-burst": {
+                "type": int,
+                "metavar": "COUNT",
+                "help": "Airtable requests allowed in a single burst (default: 1)",
             },
             ("-h", "--help"): {
                 "action": "help",
@@ -113,6 +141,23 @@ def parse_args(argv: Sequence[str]) -> argparse.Namespace:
                 "help":"rename the key column in the file to a different key column in Airtable",
                 "metavar":"column",
             },
+            "--upsert-on":{
+                "nargs":"*",
+                "help":"merge rows into existing records matched on these columns instead of creating duplicates",
+                "metavar":"column",
+            },
+            "--incremental":{
+                "action":"store_true",
+                "help":"only upload rows that are new or changed, matched on the --upsert-on columns",
+            },
+            "--sync-state":{
+                "action":"store_true",
+                "help":"remember uploaded rows locally so --incremental can skip reading the table",
+            },
+            "--verify-state":{
+                "action":"store_true",
+                "help":"refresh the local sync state with the records changed in Airtable since the last sync",
+            },
         },
         "custom application options": {
             "--md": {
@@ -131,10 +176,28 @@ def parse_args(argv: Sequence[str]) -> argparse.Namespace:
                 "action": "store_true",
                 "help": "delete all entries from the specified Airtable table",
             },
+            "--delete-by-formula": {
+                "help": "delete the entries for which an Airtable formula is true",
+                "metavar": "FORMULA",
+            },
+            "--delete-missing": {
+                "action": "store_true",
+                "help": "after uploading, delete entries whose --upsert-on columns match no row in the file",
+            },
             "--empty-dropbox-folder": {
                 "action": "store_true",
                 "help": "empty the contents of the Dropbox folder",
             },
+            "--dropbox-retain-days": {
+                "type": int,
+                "help": "delete Dropbox run folders older than this many days",
+                "metavar": "DAYS",
+            },
+            "--dropbox-retain-runs": {
+                "type": int,
+                "help": "keep only this many of the newest Dropbox run folders",
+                "metavar": "COUNT",
+            },
         },
     }
     
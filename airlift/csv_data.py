@@ -2,54 +2,94 @@
 CSV ingestion utilities for Airlift.
 
 This module reads CSV input into Airtable-compatible records and handles
-duplicate-column behavior based on CLI validation settings.
+duplicate-column behavior based on CLI validation settings. Records are
+streamed in bounded chunks so large files are never held in memory at once.
 """
 
 import csv
 import logging
 from collections import Counter
 from pathlib import Path
-from typing import Any, Dict, Iterable, List
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
 
 from airlift.utils_exceptions import CriticalError
 
 CSVRowType = Dict[str, Any]
 
+# Number of records handed to the upload pipeline per chunk
+CSV_CHUNK_SIZE = 1000
+
 logger = logging.getLogger(__name__)
 
 
 def csv_read(file_path: Path,fail_on_dup:bool) -> List[CSVRowType]:
+    return [
+        record
+        for chunk in csv_stream(file_path, fail_on_dup)
+        for record in chunk
+    ]
+
+def csv_stream(
+    file_path: Path, fail_on_dup: bool, chunk_size: int = CSV_CHUNK_SIZE
+) -> Iterator[List[CSVRowType]]:
+    """Validate the CSV header now and return a generator of record chunks.
+
+    Header errors are raised immediately; rows are parsed only as the
+    returned generator is consumed, which keeps the file open until then.
+    """
     try:
-        with open(file_path,"r",encoding="utf-8-sig") as csv_file:
-            return _csv_read_rows(csv_file,fail_on_dup)
+        csv_file = open(file_path,"r",encoding="utf-8-sig",newline="")
     except FileNotFoundError as e:
         logger.debug(f"error : {e}")
         raise CriticalError(f"File {file_path} not found") from e
-
-def _csv_read_rows(csv_file:Iterable[str],fail_on_dup:bool) -> List[CSVRowType]:
-
-
-    reader = csv.DictReader(csv_file,restval="")
-
-    if not reader.fieldnames:
+    try:
+        reader = csv.reader(csv_file)
+        columns = _csv_columns(next(reader, []), fail_on_dup)
+    except Exception:
+        csv_file.close()
+        raise
+    return _csv_chunks(csv_file, reader, columns, chunk_size)
+
+def _csv_columns(fieldnames: List[str], fail_on_dup: bool) -> List[Tuple[int, str]]:
+    """Resolve duplicate columns once, from the header.
+
+    Returns:
+        list: (position, name) of the columns every record is built from
+    """
+    if not fieldnames:
         raise CriticalError("CSV file has no columns")
-    
-    rows = list(reader)
-    #print(list(reader.fieldnames))
-    duplicate_columns = _list_duplicates(list(reader.fieldnames))
+
+    duplicate_columns = _list_duplicates(fieldnames)
 
     if duplicate_columns:
         if fail_on_dup:
             raise CriticalError(f"Duplicate columns found in CSV :{duplicate_columns}")
-        else:
-            rows = _remove_duplicates(rows)
-
-    records = []
-
-    for x in rows:
-        records.append({"fields":x})
-    
-    return records
+        # Like a dict built from the row, the last duplicate wins; unnamed
+        # columns are dropped.
+        positions = {name: index for index, name in enumerate(fieldnames) if name}
+        return [(index, name) for name, index in positions.items()]
+    return list(enumerate(fieldnames))
+
+def _csv_chunks(
+    csv_file, reader: Iterable[List[str]], columns: List[Tuple[int, str]], chunk_size: int
+) -> Iterator[List[CSVRowType]]:
+    with csv_file:
+        records = []
+        for values in reader:
+            if not values:
+                continue
+            width = len(values)
+            records.append({
+                "fields": {
+                    name: values[index] if index < width else ""
+                    for index, name in columns
+                }
+            })
+            if len(records) >= chunk_size:
+                yield records
+                records = []
+        if records:
+            yield records
 
 def _list_duplicates(lst: List[str]) -> List[str]:
     return [lst_item for lst_item, count in Counter(lst).items() if count > 1]
@@ -5,16 +5,21 @@ This module manages Dropbox authentication, file uploads for attachments,
 refresh-token updates, and folder cleanup operations.
 """
 
+import hashlib
 import os
+import posixpath
 import time
 import threading
 import dropbox
 import logging
 import json
+import re
 import certifi
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 
+from airlift.attachment_cache import LINK_SHARED, LINK_TEMPORARY
 from airlift.utils_exceptions import CriticalError
 from dropbox import DropboxOAuth2FlowNoRedirect
 from dropbox.sharing import RequestedVisibility, SharedLinkSettings
@@ -30,6 +35,95 @@ DROPBOX_OAUTH_SCOPES = [
     "sharing.write",
 ]
 
+# Files larger than this are sent through an upload session in chunks so
+# memory stays bounded and a failed chunk is retried on its own. Dropbox
+# rejects single-call uploads above 150 MB.
+DROPBOX_SESSION_THRESHOLD = 16 * 1024 * 1024
+DROPBOX_CHUNK_SIZE = 8 * 1024 * 1024
+# files_upload_session_finish_batch_v2 accepts at most 1000 entries
+DROPBOX_COMMIT_BATCH_SIZE = 1000
+# files_delete_batch accepts at most 1000 entries per job
+DROPBOX_DELETE_BATCH_SIZE = 1000
+DELETE_POLL_INITIAL_WAIT = 0.5
+DELETE_POLL_MAX_WAIT = 10.0
+# Block size of the Dropbox content hash
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+# Temporary links stop working after four hours; a cached one is only handed
+# out again while Airtable still has time to fetch it.
+DROPBOX_TEMPORARY_LINK_TTL = 4 * 60 * 60
+DROPBOX_LINK_EXPIRY_MARGIN = 30 * 60
+
+def dropbox_content_hash(file_path: str) -> str:
+    """Compute the Dropbox content hash of a local file.
+
+    SHA-256 over the concatenated SHA-256 digests of each 4 MB block, as
+    reported in FileMetadata.content_hash.
+    """
+    overall = hashlib.sha256()
+    with open(file_path, "rb") as file_handle:
+        while True:
+            block = file_handle.read(DROPBOX_HASH_BLOCK_SIZE)
+            if not block:
+                break
+            overall.update(hashlib.sha256(block).digest())
+    return overall.hexdigest()
+
+def delete_paths(dbx, paths, progress_bar=None) -> List[str]:
+    """Delete Dropbox paths through files_delete_batch, up to 1000 per job.
+
+    Returns:
+        list: The paths Dropbox confirmed as deleted
+    """
+    deleted = []
+    for start in range(0, len(paths), DROPBOX_DELETE_BATCH_SIZE):
+        chunk = paths[start:start + DROPBOX_DELETE_BATCH_SIZE]
+        result = _delete_batch(dbx, chunk)
+        for path, entry in zip(chunk, result.entries):
+            if entry.is_success():
+                deleted.append(path)
+            else:
+                logger.warning(f"Failed to delete {path}: {entry.get_failure()}")
+        if progress_bar is not None:
+            progress_bar.update(len(chunk))
+    return deleted
+
+def _delete_batch(dbx, paths):
+    """Run one delete job, starting it again if Dropbox was too busy."""
+    delay_seconds = DELETE_POLL_INITIAL_WAIT
+    for attempt in range(1, 6):
+        launch = dbx.files_delete_batch(
+            [dropbox.files.DeleteArg(path) for path in paths]
+        )
+        if launch.is_complete():
+            return launch.get_complete()
+        result = _wait_for_delete_batch(dbx, launch.get_async_job_id())
+        if result is not None:
+            return result
+        logger.warning(
+            f"Dropbox was busy deleting, retrying the batch (attempt {attempt}/5)"
+        )
+        time.sleep(delay_seconds)
+        delay_seconds = min(delay_seconds * 2, DELETE_POLL_MAX_WAIT)
+    raise CriticalError("Dropbox batch delete failed: too many write operations")
+
+def _wait_for_delete_batch(dbx, job_id: str):
+    """Poll files_delete_batch_check with backoff until the job is done.
+
+    Returns None if the job failed with too_many_write_operations.
+    """
+    delay_seconds = DELETE_POLL_INITIAL_WAIT
+    while True:
+        status = dbx.files_delete_batch_check(job_id)
+        if status.is_complete():
+            return status.get_complete()
+        if status.is_failed():
+            error = status.get_failed()
+            if error.is_too_many_write_operations():
+                return None
+            raise CriticalError(f"Dropbox batch delete failed: {error}")
+        time.sleep(delay_seconds)
+        delay_seconds = min(delay_seconds * 2, DELETE_POLL_MAX_WAIT)
+
 def _configure_ssl_environment():
     """Configure SSL environment for proper certificate handling in PyInstaller"""
     try:
@@ -46,8 +140,77 @@ def _configure_ssl_environment():
     except Exception as e:
         logger.warning(f"SSL environment configuration failed: {e}, using default")
 
+class _PendingCommit:
+    __slots__ = ("entry", "finished", "lead", "result", "error")
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.finished = False
+        self.lead = False
+        self.result = None
+        self.error = None
+
+
+class _CommitBatcher:
+    """Group commits of closed upload sessions into finish_batch calls.
+
+    The first thread to arrive commits everything queued so far; threads
+    arriving meanwhile queue up and the oldest of them commits the next
+    group once the current call returns. Dropbox takes one namespace write
+    lock per batch instead of one per file.
+    """
+
+    def __init__(self, finish_batch, max_entries: int = DROPBOX_COMMIT_BATCH_SIZE):
+        self._finish_batch = finish_batch
+        self.max_entries = max_entries
+        self._pending = []
+        self._leading = False
+        self._cond = threading.Condition()
+
+    def commit(self, entry):
+        """Commit `entry` with whatever else is queued and return its result."""
+        item = _PendingCommit(entry)
+        with self._cond:
+            self._pending.append(item)
+            if not self._leading:
+                self._leading = True
+                item.lead = True
+        while True:
+            if item.lead:
+                item.lead = False
+                self._commit_next_batch()
+            with self._cond:
+                self._cond.wait_for(lambda: item.finished or item.lead)
+                if item.finished:
+                    break
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _commit_next_batch(self) -> None:
+        with self._cond:
+            batch = self._pending[:self.max_entries]
+            del self._pending[:self.max_entries]
+        try:
+            outcomes = self._finish_batch([item.entry for item in batch])
+        except Exception as exc:
+            outcomes = [exc] * len(batch)
+        with self._cond:
+            for item, outcome in zip(batch, outcomes):
+                if isinstance(outcome, Exception):
+                    item.error = outcome
+                else:
+                    item.result = outcome
+                item.finished = True
+            if self._pending:
+                self._pending[0].lead = True
+            else:
+                self._leading = False
+            self._cond.notify_all()
+
+
 class dropbox_client:
-    def __init__(self, access_token, md: bool):
+    def __init__(self, access_token, md: bool, attachment_cache=None):
         # Configure SSL environment for proper certificate handling
         _configure_ssl_environment()
         
@@ -87,10 +250,34 @@ class dropbox_client:
         except Exception as e:
             raise CriticalError("Error during Dropbox client creation",e)
 
-        self._api_lock = threading.Lock()
+        self._local = threading.local()
+        self._retry_lock = threading.Lock()
+        self._commit_batcher = _CommitBatcher(self._finish_batch)
+        # content hash -> download URL of files uploaded during this run
+        self.attachment_cache = attachment_cache
+        self._uploaded = {}
+        self._uploaded_lock = threading.Lock()
+        # lower-cased Dropbox path -> local file uploaded to it during this run
+        self._run_paths: Dict[str, str] = {}
+        # lower-cased run folders holding files linked to during this run
+        self._linked_folders: Set[str] = set()
+        self.retry_count = 0
         self._use_temporary_links = True
         self._temporary_link_scope_logged = False
 
+    def _thread_dbx(self) -> dropbox.Dropbox:
+        """Return the Dropbox instance of the calling thread.
+
+        dropbox.Dropbox keeps its access token and HTTP session on the
+        instance, so each upload thread works on a clone with its own session
+        that shares the refresh token, and uploads run concurrently.
+        """
+        dbx = getattr(self._local, "dbx", None)
+        if dbx is None:
+            dbx = self.dbx.clone(session=dropbox.create_session())
+            self._local.dbx = dbx
+        return dbx
+
     @staticmethod
     def _auth_error_missing_read_scope(exc: BaseException) -> bool:
         text = str(exc).lower()
@@ -214,6 +401,7 @@ class dropbox_client:
                     or attempt == 5
                 ):
                     raise
+                self.count_retry()
                 logger.warning(
                     "Retrying Dropbox %s after %s (attempt %s/5): %s",
                     description,
@@ -227,13 +415,14 @@ class dropbox_client:
             raise last_error
         raise RuntimeError(f"Dropbox operation failed: {description}")
 
-    def _shared_link_url(self, dropbox_path: str) -> str:
+    def _shared_link_url(self, dropbox_path: str, dbx=None) -> str:
+        dbx = dbx or self.dbx
         link_settings = SharedLinkSettings(
             requested_visibility=RequestedVisibility.public
         )
         try:
             shared_link_metadata = (
-                self.dbx.sharing_create_shared_link_with_settings(
+                dbx.sharing_create_shared_link_with_settings(
                     path=dropbox_path,
                     settings=link_settings,
                 )
@@ -246,19 +435,26 @@ class dropbox_client:
             ):
                 existing = err.get_shared_link_already_exists()
                 return self._to_direct_download_url(existing.url)
-            links = self.dbx.sharing_list_shared_links(
+            links = dbx.sharing_list_shared_links(
                 path=dropbox_path, direct_only=True
             )
             if links.links:
                 return self._to_direct_download_url(links.links[0].url)
             raise
 
-    def _airtable_download_url(self, dropbox_path: str) -> str:
+    def _airtable_download_url(self, dropbox_path: str, dbx=None) -> str:
         """Return a direct download URL Airtable can fetch when creating attachments."""
+        return self._download_link(dropbox_path, dbx)[0]
+
+    def _download_link(
+        self, dropbox_path: str, dbx=None
+    ) -> Tuple[str, str, Optional[float]]:
+        """Return the download URL with its link kind and expiry time, if any."""
+        dbx = dbx or self.dbx
         if self._use_temporary_links:
             try:
-                temporary = self.dbx.files_get_temporary_link(dropbox_path)
-                return temporary.link
+                temporary = dbx.files_get_temporary_link(dropbox_path)
+                return temporary.link, LINK_TEMPORARY, self.temporary_link_expiry()
             except dropbox.exceptions.AuthError as exc:
                 if self._auth_error_missing_read_scope(exc):
                     self._use_temporary_links = False
@@ -280,30 +476,277 @@ class dropbox_client:
                     dropbox_path,
                     exc,
                 )
-        return self._shared_link_url(dropbox_path)
+        return self._shared_link_url(dropbox_path, dbx), LINK_SHARED, None
+
+    @staticmethod
+    def temporary_link_expiry() -> float:
+        """When a temporary link created now should no longer be handed out."""
+        return time.time() + DROPBOX_TEMPORARY_LINK_TTL - DROPBOX_LINK_EXPIRY_MARGIN
+
+    def _append_chunk(
+        self,
+        dbx,
+        chunk: bytes,
+        cursor: dropbox.files.UploadSessionCursor,
+        name: str,
+        close: bool,
+    ) -> int:
+        """Append one chunk to an upload session and return the new offset."""
+        def _append() -> int:
+            try:
+                dbx.files_upload_session_append_v2(chunk, cursor, close=close)
+            except dropbox.exceptions.ApiError as exc:
+                err = exc.error
+                if hasattr(err, "is_incorrect_offset") and err.is_incorrect_offset():
+                    # An earlier attempt reached Dropbox before the connection
+                    # failed; carry on from where the session really is.
+                    return err.get_incorrect_offset().correct_offset
+                raise
+            return cursor.offset + len(chunk)
+
+        return self._call_with_retry(_append, f"chunk upload for {name}")
+
+    def _upload_session(self, dbx, local_path: str) -> dropbox.files.UploadSessionCursor:
+        """Send the file contents to a closed upload session, ready to commit.
+
+        Files above DROPBOX_SESSION_THRESHOLD are read and appended in
+        DROPBOX_CHUNK_SIZE pieces; smaller ones go in the start call.
+        """
+        name = os.path.basename(local_path)
+        size = os.path.getsize(local_path)
+        with open(local_path, "rb") as file_handle:
+            if size > DROPBOX_SESSION_THRESHOLD:
+                first_chunk = file_handle.read(DROPBOX_CHUNK_SIZE)
+            else:
+                first_chunk = file_handle.read()
+            close = len(first_chunk) >= size
+            session = self._call_with_retry(
+                lambda: dbx.files_upload_session_start(first_chunk, close=close),
+                f"upload for {name}",
+            )
+            cursor = dropbox.files.UploadSessionCursor(
+                session_id=session.session_id, offset=len(first_chunk)
+            )
+            while cursor.offset < size:
+                file_handle.seek(cursor.offset)
+                chunk = file_handle.read(DROPBOX_CHUNK_SIZE)
+                close = cursor.offset + len(chunk) >= size
+                cursor.offset = self._append_chunk(dbx, chunk, cursor, name, close)
+        return cursor
+
+    def _finish_batch(self, entries) -> list:
+        """Commit (cursor, commit info) pairs in one finish_batch_v2 call.
+
+        Returns:
+            list: file metadata, or the ApiError of each entry that failed
+        """
+        # Not retried here: each upload retries its own commit, so a failed
+        # batch is queued again as part of the next one.
+        result = self._thread_dbx().files_upload_session_finish_batch_v2([
+            dropbox.files.UploadSessionFinishArg(cursor=cursor, commit=commit)
+            for cursor, commit in entries
+        ])
+        if len(result.entries) != len(entries):
+            raise RuntimeError("Dropbox returned a result for a different number of uploads")
+        return [
+            entry.get_success()
+            if entry.is_success()
+            else dropbox.exceptions.ApiError(None, entry.get_failure(), None, None)
+            for entry in result.entries
+        ]
+
+    def _content_hash(self, local_path: str) -> str:
+        """Return the content hash, from the manifest while the file is unchanged."""
+        if not self.attachment_cache:
+            return dropbox_content_hash(local_path)
+        absolute_path = os.path.abspath(local_path)
+        stat = os.stat(absolute_path)
+        content_hash = self.attachment_cache.file_hash(
+            absolute_path, stat.st_size, stat.st_mtime_ns
+        )
+        if content_hash is None:
+            content_hash = dropbox_content_hash(absolute_path)
+            self.attachment_cache.remember_file(
+                absolute_path, stat.st_size, stat.st_mtime_ns, content_hash
+            )
+        return content_hash
+
+    def cached_download_url(self, filename: str) -> Optional[str]:
+        """Return a still valid link for an unchanged file without calling Dropbox."""
+        content_hash = self._content_hash(os.path.normpath(filename))
+        with self._uploaded_lock:
+            url = self._uploaded.get(content_hash)
+        if url is None and self.attachment_cache:
+            url = self.attachment_cache.valid_link(content_hash, time.time())
+            cached = self.attachment_cache.lookup(content_hash) if url else None
+            if cached is None:
+                return None
+            self._link_handed_out(cached.dropbox_path)
+            with self._uploaded_lock:
+                self._uploaded[content_hash] = url
+        return url
+
+    def _link_handed_out(self, dropbox_path: str) -> None:
+        """Keep the run folder of a file that a link was handed out for."""
+        relative = dropbox_path[len(self.main_folder):].strip("/")
+        folder = f"{self.main_folder}/{relative.split('/', 1)[0]}"
+        with self._uploaded_lock:
+            self._linked_folders.add(folder.lower())
+
+    def _reuse_upload(self, dbx, content_hash: str) -> Optional[str]:
+        """Link a file an earlier run uploaded, if it is still in Dropbox unchanged."""
+        if not self.attachment_cache:
+            return None
+        cached = self.attachment_cache.lookup(content_hash)
+        if cached is None:
+            return None
+        dropbox_path = cached.dropbox_path
+        url = None
+        try:
+            if self._use_temporary_links:
+                # One call returns both a fresh link and the metadata to check
+                temporary = dbx.files_get_temporary_link(dropbox_path)
+                metadata, url = temporary.metadata, temporary.link
+            else:
+                metadata = dbx.files_get_metadata(dropbox_path)
+        except dropbox.exceptions.DropboxException as exc:
+            logger.debug(f"Cached upload {dropbox_path} is not usable: {exc}")
+            metadata = None
+        if getattr(metadata, "content_hash", None) != content_hash:
+            self.attachment_cache.forget(content_hash)
+            return None
+        logger.debug(f"Reusing {dropbox_path} uploaded by an earlier run")
+        self._link_handed_out(dropbox_path)
+        if url is None and cached.link_kind == LINK_SHARED and cached.link:
+            # The file behind the shared link was just checked
+            return cached.link
+        if url:
+            self.attachment_cache.remember(
+                content_hash, dropbox_path, url, LINK_TEMPORARY,
+                self.temporary_link_expiry(),
+            )
+            return url
+        url = self._call_with_retry(
+            lambda: self._shared_link_url(dropbox_path, dbx),
+            f"link for {dropbox_path}",
+        )
+        self.attachment_cache.remember(content_hash, dropbox_path, url, LINK_SHARED)
+        return url
 
     def upload_to_dropbox(self, filename: str) -> str:
+        local_path, content_hash, url = self.prepare_upload(filename)
+        if url:
+            return url
+        dropbox_path = self.run_path(local_path)
+        url, link_kind, link_expires = self._upload_file(
+            self._thread_dbx(), local_path, dropbox_path
+        )
+        return self.finish_upload(content_hash, dropbox_path, url, link_kind, link_expires)
+
+    def prepare_upload(self, filename: str) -> Tuple[str, str, Optional[str]]:
+        """Hash a file and find a link if this or an earlier run already uploaded it.
+
+        Returns:
+            tuple: normalized local path, content hash and the link, or None
+        """
         local_path = os.path.normpath(filename)
-        with open(local_path, "rb") as file_handle:
-            image_data = file_handle.read()
+        content_hash = self._content_hash(local_path)
+        with self._uploaded_lock:
+            url = self._uploaded.get(content_hash)
+        if url is None:
+            url = self._reuse_upload(self._thread_dbx(), content_hash)
+            if url:
+                with self._uploaded_lock:
+                    self._uploaded[content_hash] = url
+        return local_path, content_hash, url
 
-        final_path = self._dropbox_relative_path(local_path)
-        dropbox_path = f"{self.sub_folder}/{final_path}"
+    def run_path(self, local_path: str) -> str:
+        """Dropbox path a local file is uploaded to in this run's folder.
 
-        # Dropbox client is not thread-safe; serialize API calls across workers.
-        with self._api_lock:
-            def _upload_and_link() -> str:
-                self.dbx.files_upload(
-                    image_data,
-                    dropbox_path,
-                    mode=dropbox.files.WriteMode.overwrite,
-                )
-                return self._airtable_download_url(dropbox_path)
+        Files from different folders can share a parent folder name and
+        basename; later ones get a numbered name so an upload never replaces
+        a file whose link was already handed out.
+        """
+        relative = self._dropbox_relative_path(local_path)
+        stem, extension = posixpath.splitext(relative)
+        dropbox_path = f"{self.sub_folder}/{relative}"
+        number = 1
+        with self._uploaded_lock:
+            while self._run_paths.setdefault(dropbox_path.lower(), local_path) != local_path:
+                number += 1
+                dropbox_path = f"{self.sub_folder}/{stem} ({number}){extension}"
+        return dropbox_path
 
-            return self._call_with_retry(
-                _upload_and_link,
-                f"upload for {os.path.basename(local_path)}",
+    def finish_upload(
+        self,
+        content_hash: str,
+        dropbox_path: str,
+        url: str,
+        link_kind: str,
+        link_expires: Optional[float],
+    ) -> str:
+        """Remember a finished upload for this run and, with a cache, later ones."""
+        self._link_handed_out(dropbox_path)
+        if self.attachment_cache:
+            self.attachment_cache.remember(
+                content_hash, dropbox_path, url, link_kind, link_expires
             )
+        with self._uploaded_lock:
+            self._uploaded[content_hash] = url
+        return url
+
+    def download_link(self, dropbox_path: str) -> Tuple[str, str, Optional[float]]:
+        """Return the download URL of an uploaded file with its link kind and expiry."""
+        return self._call_with_retry(
+            lambda: self._download_link(dropbox_path, self._thread_dbx()),
+            f"link for {os.path.basename(dropbox_path)}",
+        )
+
+    @property
+    def temporary_links(self) -> bool:
+        """False once the token turned out to lack the scope temporary links need."""
+        return self._use_temporary_links
+
+    def count_retry(self) -> None:
+        with self._retry_lock:
+            self.retry_count += 1
+
+    def access_token(self) -> str:
+        """Current OAuth access token, refreshed first if it is about to expire."""
+        self.dbx.check_and_refresh_access_token()
+        return self.dbx._oauth2_access_token
+
+    def _upload_file(
+        self, dbx, local_path: str, dropbox_path: str
+    ) -> Tuple[str, str, Optional[float]]:
+        name = os.path.basename(local_path)
+
+        # Contents upload in parallel; the commit is shared with other workers
+        cursor = self._upload_session(dbx, local_path)
+        commit = dropbox.files.CommitInfo(
+            path=dropbox_path, mode=dropbox.files.WriteMode.overwrite
+        )
+        self._call_with_retry(
+            lambda: self._commit_batcher.commit((cursor, commit)),
+            f"upload commit for {name}",
+        )
+        return self._call_with_retry(
+            lambda: self._download_link(dropbox_path, dbx),
+            f"link for {name}",
+        )
+
+    def apply_retention(
+        self, retain_days: Optional[int], retain_runs: Optional[int]
+    ) -> List[str]:
+        """Remove old run folders, never one this run uploaded to or linked into.
+
+        Links handed out from the cache can point into earlier run folders.
+        """
+        with self._uploaded_lock:
+            keep = {self.sub_folder, *self._linked_folders}
+        return prune_run_folders(
+            self.dbx, self.main_folder, retain_days, retain_runs, keep=keep
+        )
 
     def empty_folder_contents(self) -> int:
         """Empty all contents from the main Dropbox folder without deleting the folder itself.
@@ -337,14 +780,10 @@ class dropbox_client:
             # Create progress bar
             progress_bar = tqdm(total=total_items, desc="Emptying folder", leave=False)
             
-            # Delete each entry (files and folders)
-            for entry in entries:
-                try:
-                    self.dbx.files_delete_v2(entry.path_display)
-                    deleted_count += 1
-                    progress_bar.update(1)
-                except dropbox.exceptions.ApiError as e:
-                    logger.warning(f"Failed to delete {entry.path_display}: {e}")
+            # Delete the entries (files and folders) in batch jobs
+            deleted_count = len(delete_paths(
+                self.dbx, [entry.path_display for entry in entries], progress_bar
+            ))
             
             progress_bar.close()
             logger.info(f"Successfully deleted {deleted_count} items from {self.main_folder}")
@@ -358,6 +797,153 @@ class dropbox_client:
             raise CriticalError(f"Failed to empty Dropbox folder: {e}")
 
 
+def _list_folder_entries(dbx, folder: str) -> list:
+    """List the direct children of a Dropbox folder, following the cursor."""
+    result = dbx.files_list_folder(folder)
+    entries = list(result.entries)
+    while result.has_more:
+        result = dbx.files_list_folder_continue(result.cursor)
+        entries.extend(result.entries)
+    return entries
+
+def _expired_run_folders(
+    entries,
+    main_folder: str,
+    retain_days: Optional[int],
+    retain_runs: Optional[int],
+    keep: Iterable[str] = (),
+    now: Optional[datetime] = None,
+) -> List[str]:
+    """Pick the run folders that fall outside the retention policy.
+
+    Run folders are named "<main folder> YYYY-MM-DD HH-MM-SS" by
+    dropbox_client; anything else in the main folder is left alone. A folder
+    expires if it is older than `retain_days` or not among the `retain_runs`
+    newest runs.
+    """
+    name = main_folder.strip("/")
+    pattern = re.compile(
+        rf"^{re.escape(name)} (\d{{4}}-\d{{2}}-\d{{2}} \d{{2}}-\d{{2}}-\d{{2}})$"
+    )
+    runs = []
+    for entry in entries:
+        if not isinstance(entry, dropbox.files.FolderMetadata):
+            continue
+        match = pattern.match(entry.name)
+        if not match:
+            continue
+        try:
+            started = datetime.strptime(match.group(1), "%Y-%m-%d %H-%M-%S")
+        except ValueError:
+            continue
+        runs.append((started, entry.path_display))
+    runs.sort(reverse=True)
+    cutoff = None
+    if retain_days is not None:
+        cutoff = (now or datetime.now()) - timedelta(days=retain_days)
+    keep = {path.lower() for path in keep}
+    expired = []
+    for index, (started, path) in enumerate(runs):
+        if path.lower() in keep:
+            continue
+        if (retain_runs is not None and index >= retain_runs) or (
+            cutoff is not None and started < cutoff
+        ):
+            expired.append(path)
+    return expired
+
+def prune_run_folders(
+    dbx,
+    main_folder: str,
+    retain_days: Optional[int],
+    retain_runs: Optional[int],
+    keep: Iterable[str] = (),
+) -> List[str]:
+    """Batch-delete run folders outside the retention policy, except `keep`.
+
+    Returns:
+        list: Dropbox paths of the run folders that were removed
+    """
+    if retain_days is not None and retain_days < 0:
+        raise CriticalError("dropbox-retain-days must be 0 or more!")
+    if retain_runs is not None and retain_runs < 0:
+        raise CriticalError("dropbox-retain-runs must be 0 or more!")
+    try:
+        entries = _list_folder_entries(dbx, main_folder)
+    except dropbox.exceptions.ApiError as e:
+        if "not_found" in str(e):
+            logger.info(f"Folder {main_folder} does not exist or is empty")
+            return []
+        raise
+    expired = _expired_run_folders(entries, main_folder, retain_days, retain_runs, keep)
+    if not expired:
+        logger.info(f"No run folders in {main_folder} are past the retention policy")
+        return []
+    logger.info(f"Deleting {len(expired)} expired run folders from {main_folder}")
+    deleted = delete_paths(dbx, expired)
+    logger.info(f"Deleted {len(deleted)} run folders from {main_folder}")
+    return deleted
+
+def dropbox_main_folder(md: bool) -> str:
+    """Dropbox folder Airlift uploads into."""
+    return "/Marker Data" if md else "/Airlift"
+
+def dropbox_app_key(access_token) -> str:
+    """Read the app key from a Dropbox token file."""
+    try:
+        with open(access_token, 'r') as file:
+            creds = json.load(file)
+    except FileNotFoundError:
+        raise CriticalError(f"Access token file not found: {access_token}")
+    except json.JSONDecodeError as e:
+        raise CriticalError(f"Invalid JSON in access token file: {e}")
+    app_key = creds.get('app_key') if isinstance(creds, dict) else None
+    if not app_key:
+        raise CriticalError("app_key not present in the json file")
+    return app_key
+
+def _dropbox_from_token_file(access_token) -> dropbox.Dropbox:
+    """Create a Dropbox client from a token file that already has a refresh token."""
+    with open(access_token, 'r') as file:
+        creds = json.load(file)
+
+    app_key = creds.get('app_key')
+    refresh_token = creds.get('refresh_token')
+
+    if not app_key:
+        raise CriticalError("app_key not present in the json file")
+    if not refresh_token:
+        raise CriticalError("refresh_token not present in the json file")
+
+    return dropbox.Dropbox(
+        oauth2_refresh_token=refresh_token,
+        app_key=app_key
+    )
+
+def prune_dropbox_folder(
+    access_token, md: bool, retain_days: Optional[int], retain_runs: Optional[int]
+) -> List[str]:
+    """Apply the run folder retention policy without starting an upload.
+
+    Returns:
+        list: Dropbox paths of the run folders that were removed
+    """
+    _configure_ssl_environment()
+
+    try:
+        dbx = _dropbox_from_token_file(access_token)
+        main_folder = dropbox_main_folder(md)
+        return prune_run_folders(dbx, main_folder, retain_days, retain_runs)
+    except FileNotFoundError:
+        raise CriticalError(f"Access token file not found: {access_token}")
+    except json.JSONDecodeError as e:
+        raise CriticalError(f"Invalid JSON in access token file: {e}")
+    except CriticalError:
+        raise
+    except Exception as e:
+        logger.error(f"Error pruning Dropbox folder: {e}")
+        raise CriticalError(f"Failed to prune Dropbox folder: {e}")
+
 def empty_dropbox_folder(access_token, md: bool) -> int:
     """Empty the contents of the Dropbox folder without creating subfolders.
     
@@ -374,26 +960,11 @@ def empty_dropbox_folder(access_token, md: bool) -> int:
     _configure_ssl_environment()
     
     try:
-        # Load credentials
-        with open(access_token, 'r') as file:
-            creds = json.load(file)
-        
-        app_key = creds.get('app_key')
-        refresh_token = creds.get('refresh_token')
-        
-        if not app_key:
-            raise CriticalError("app_key not present in the json file")
-        if not refresh_token:
-            raise CriticalError("refresh_token not present in the json file")
-        
-        # Create Dropbox client
-        dbx = dropbox.Dropbox(
-            oauth2_refresh_token=refresh_token,
-            app_key=app_key
-        )
+        # Load credentials and create Dropbox client
+        dbx = _dropbox_from_token_file(access_token)
         
         # Determine folder path
-        main_folder = "/Marker Data" if md else "/Airlift"
+        main_folder = dropbox_main_folder(md)
         
         logger.info(f"Fetching contents of folder: {main_folder}")
         
@@ -423,16 +994,10 @@ def empty_dropbox_folder(access_token, md: bool) -> int:
         # Create progress bar
         progress_bar = tqdm(total=total_items, desc="Emptying folder", leave=False)
         
-        deleted_count = 0
-        
-        # Delete each entry (files and folders)
-        for entry in entries:
-            try:
-                dbx.files_delete_v2(entry.path_display)
-                deleted_count += 1
-                progress_bar.update(1)
-            except dropbox.exceptions.ApiError as e:
-                logger.warning(f"Failed to delete {entry.path_display}: {e}")
+        # Delete the entries (files and folders) in batch jobs
+        deleted_count = len(delete_paths(
+            dbx, [entry.path_display for entry in entries], progress_bar
+        ))
         
         progress_bar.close()
         logger.info(f"Successfully deleted {deleted_count} items from {main_folder}")
@@ -0,0 +1,359 @@
+"""
+Incremental sync helpers for Airlift.
+
+This module indexes the records already in an Airtable table by merge key and
+content hash, then compares the parsed file against that index so only new or
+changed rows are sent to Airtable. It can also remove the records that no row
+of the file was written to or matched with.
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from airlift.airtable_client import AIRTABLE_DELETE_WORKERS, new_client, upsert_fields
+from airlift.utils_exceptions import CriticalError
+
+logger = logging.getLogger(__name__)
+
+RecordKey = Tuple[str, ...]
+RemoteIndex = Dict[RecordKey, Tuple[str, str]]
+# Look this much further back than the last sync for modified records, in
+# case the local clock is ahead of Airtable's
+SYNC_CLOCK_MARGIN = timedelta(minutes=1)
+
+
+def _normalize(value: Any) -> Optional[str]:
+    """Reduce a cell value to text that compares equal across CSV/JSON/Airtable.
+
+    Airtable omits empty and unchecked cells and returns typed values, while
+    CSV cells are always strings. Values that still differ after this only
+    cost an unnecessary update, never a skipped change.
+    """
+    if value is None or value is False or value == "" or value == [] or value == {}:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, list):
+        items = [_normalize(item) for item in value]
+        return ", ".join(item for item in items if item is not None)
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True, default=str)
+    return str(value).strip() or None
+
+
+def record_key(fields: Dict[str, Any], key_fields: List[str]) -> Optional[RecordKey]:
+    """Return the merge key of a record, or None if any key field is empty."""
+    key = tuple(_normalize(fields.get(field)) for field in key_fields)
+    if any(part is None for part in key):
+        return None
+    return key
+
+
+def content_hash(fields: Dict[str, Any], compare_fields: Iterable[str]) -> str:
+    """Hash the normalized values of `compare_fields` in a record."""
+    content = {field: _normalize(fields.get(field)) for field in compare_fields}
+    payload = json.dumps(content, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def compare_fields_for(header: Iterable[str], args) -> List[str]:
+    """Return the file columns whose content decides if a row has changed.
+
+    Attachment targets are left out: their local values are file names while
+    Airtable holds attachment objects, and unchanged rows skip the upload.
+    """
+    ignore = set(args.attachment_columns or [])
+    ignore.update(target for _source, target in args.attachment_columns_map or [])
+    return sorted(field for field in header if field not in ignore)
+
+
+def build_remote_index(
+    client: new_client, key_fields: List[str], compare_fields: List[str]
+) -> RemoteIndex:
+    """Read the table once and map merge key -> (record id, content hash)."""
+    fields = list(dict.fromkeys(key_fields + compare_fields))
+    index: RemoteIndex = {}
+    logger.info("Reading existing records from Airtable for incremental sync...")
+    for page in client.table.iterate(fields=fields):
+        for record in page:
+            key = record_key(record["fields"], key_fields)
+            if key is None:
+                continue
+            if key in index:
+                logger.warning(f"Duplicate key {key} in Airtable, using the first record")
+                continue
+            index[key] = (record["id"], content_hash(record["fields"], compare_fields))
+    logger.info(f"Indexed {len(index)} existing records")
+    return index
+
+
+def iter_changes(
+    data: Iterable[Dict],
+    index: RemoteIndex,
+    key_fields: List[str],
+    compare_fields: List[str],
+    counts: Dict[str, int],
+    file_keys: Optional["FileKeys"] = None,
+) -> Iterator[Dict]:
+    """Yield only rows that are new or differ from the indexed record.
+
+    Changed rows get the matching record id under "id" so they are sent as
+    updates; new rows are left as creates. Both carry their (key, hash) under
+    "sync" so the written state can be remembered. `counts` is updated with
+    the number of new/changed/unchanged rows as the rows stream through, and
+    unchanged rows are matched to their record in `file_keys`. Rows without
+    a key, and repeats of a key, are left out and counted as skipped.
+    """
+    planned = set()
+    for row in data:
+        key = record_key(row["fields"], key_fields)
+        if key is None:
+            # Upserts can't merge on an empty key, so Airtable would refuse it
+            logger.warning(f"Row without a value in {key_fields} is skipped")
+            counts["skipped"] += 1
+            continue
+        if key in planned:
+            logger.warning(f"Duplicate key {key} in the file, skipping the repeated row")
+            counts["skipped"] += 1
+            continue
+        planned.add(key)
+        existing = index.get(key)
+        row_hash = content_hash(row["fields"], compare_fields)
+        if existing is None:
+            counts["new"] += 1
+            row["sync"] = (key, row_hash)
+            yield row
+        elif existing[1] != row_hash:
+            counts["changed"] += 1
+            row["id"] = existing[0]
+            row["sync"] = (key, row_hash)
+            yield row
+        else:
+            counts["unchanged"] += 1
+            if file_keys is not None:
+                file_keys.keep_record(key, existing[0])
+
+
+def plan_changes(
+    data: Iterable[Dict],
+    index: RemoteIndex,
+    key_fields: List[str],
+    compare_fields: List[str],
+) -> Tuple[List[Dict], Dict[str, int]]:
+    """Collect the rows iter_changes would send.
+
+    Returns:
+        tuple: rows to upload, and counts of new/changed/unchanged/skipped rows
+    """
+    counts = {"new": 0, "changed": 0, "unchanged": 0, "skipped": 0}
+    changes = list(iter_changes(data, index, key_fields, compare_fields, counts))
+    return changes, counts
+
+
+def modified_since_formula(since: datetime) -> str:
+    """Airtable formula matching records created or modified after `since`."""
+    since = (since - SYNC_CLOCK_MARGIN).astimezone(timezone.utc)
+    return (
+        "IS_AFTER(LAST_MODIFIED_TIME(), "
+        f"DATETIME_PARSE('{since.strftime('%Y-%m-%dT%H:%M:%S.000Z')}'))"
+    )
+
+
+def verify_index(
+    client: new_client,
+    index: RemoteIndex,
+    key_fields: List[str],
+    compare_fields: List[str],
+    synced_at: Optional[datetime],
+) -> RemoteIndex:
+    """Reconcile a cached index with the records modified in the table since.
+
+    Records modified since `synced_at` are read again and replace their
+    cached entry, so edits made in Airtable are not hidden by an old hash.
+    Records deleted in Airtable are not looked for: updating one fails and
+    the upload sends the row as a new record instead. Without a sync time
+    the index is rebuilt from the whole table.
+    """
+    if synced_at is None:
+        return build_remote_index(client, key_fields, compare_fields)
+    logger.info("Verifying sync state against Airtable...")
+    verified: RemoteIndex = dict(index)
+    keys_by_id = {record_id: key for key, (record_id, _hash) in index.items()}
+    fields = list(dict.fromkeys(key_fields + compare_fields))
+    modified = 0
+    for page in client.table.iterate(
+        fields=fields, formula=modified_since_formula(synced_at)
+    ):
+        for record in page:
+            old_key = keys_by_id.pop(record["id"], None)
+            old_entry = verified.pop(old_key) if old_key is not None else None
+            key = record_key(record["fields"], key_fields)
+            if key is None:
+                if old_entry is not None:
+                    modified += 1
+                continue
+            if key in verified:
+                logger.warning(f"Duplicate key {key} in Airtable, using the modified record")
+                keys_by_id.pop(verified[key][0], None)
+            entry = (record["id"], content_hash(record["fields"], compare_fields))
+            # Records only Airlift wrote since still match their cached entry
+            if key != old_key or entry != old_entry:
+                modified += 1
+            verified[key] = entry
+            keys_by_id[record["id"]] = key
+    if modified:
+        logger.warning(
+            f"Sync state was out of date: {modified} records modified "
+            "in Airtable since the last sync"
+        )
+    return verified
+
+
+def incremental_rows(
+    client: new_client, data: Iterable[Dict], args, state=None, file_keys=None
+) -> Iterator[Dict]:
+    """Return only the rows of `data` that need to be written to Airtable.
+
+    With a SyncState from an earlier run for the same columns, the remote
+    table is not read at all (or only the records modified since the last
+    sync, with --verify-state). Rows are compared lazily, so the input can
+    be a stream.
+    """
+    if args.upsert_on is None:
+        raise CriticalError("incremental needs --upsert-on to identify existing records!")
+    rows = iter(data)
+    first = next(rows, None)
+    if first is None:
+        return iter([])
+    key_fields = upsert_fields(args)
+    compare_fields = compare_fields_for(first["fields"], args)
+    # Taken before reading, so changes made while the table is read are
+    # picked up by the next --verify-state
+    started = datetime.now(timezone.utc)
+    if state is not None and state.matches(key_fields, compare_fields):
+        logger.info(f"Using sync state from {state.path}")
+        index = state.load_index()
+        if args.verify_state:
+            index = verify_index(
+                client, index, key_fields, compare_fields, state.synced_at()
+            )
+            state.reset(key_fields, compare_fields, index, started)
+    else:
+        index = build_remote_index(client, key_fields, compare_fields)
+        if state is not None:
+            state.reset(key_fields, compare_fields, index, started)
+    return _logged_changes(
+        itertools.chain([first], rows), index, key_fields, compare_fields, file_keys
+    )
+
+
+def _logged_changes(
+    rows: Iterable[Dict],
+    index: RemoteIndex,
+    key_fields: List[str],
+    compare_fields: List[str],
+    file_keys: Optional["FileKeys"] = None,
+) -> Iterator[Dict]:
+    counts = {"new": 0, "changed": 0, "unchanged": 0, "skipped": 0}
+    yield from iter_changes(rows, index, key_fields, compare_fields, counts, file_keys)
+    logger.info(
+        f"Incremental sync: {counts['new']} new, {counts['changed']} changed, "
+        f"{counts['unchanged']} unchanged, {counts['skipped']} skipped rows"
+    )
+
+
+class FileKeys:
+    """The records the rows of the input file became, gathered as the rows go by.
+
+    Rows are matched to records by the id Airtable returned when they were
+    written, or by the indexed id when --incremental skipped them as
+    unchanged. Only rows that never got an id, e.g. because Airtable refused
+    them, fall back to their merge key: comparing keys as text can't tell
+    "007" from 7, so it is used to keep records, never to decide that a row
+    is gone.
+    """
+
+    def __init__(self, key_fields: List[str]):
+        self.key_fields = key_fields
+        self.record_ids: Set[str] = set()
+        # Keys of rows that have no record id yet
+        self.unmatched_keys: Set[RecordKey] = set()
+        self.keyed_rows = 0
+        # Set once every row of the file went past, so a failed upload
+        # never deletes records on the strength of half a file
+        self.complete = False
+        self._lock = threading.Lock()
+
+    def track(self, rows: Iterable[Dict]) -> Iterator[Dict]:
+        for row in rows:
+            key = record_key(row["fields"], self.key_fields)
+            if key is not None:
+                self.keyed_rows += 1
+                with self._lock:
+                    self.unmatched_keys.add(key)
+            yield row
+        self.complete = True
+
+    def keep_record(self, key: RecordKey, record_id: str) -> None:
+        """Match the row with merge key `key` to an existing record."""
+        with self._lock:
+            self.record_ids.add(record_id)
+            self.unmatched_keys.discard(key)
+
+    def record_rows(self, rows: Iterable[Dict]) -> None:
+        """Match the rows of a written batch that have a record id."""
+        for row in rows:
+            if row.get("id"):
+                self.keep_record(record_key(row["fields"], self.key_fields), row["id"])
+
+
+def missing_record_ids(client: new_client, file_keys: FileKeys) -> Iterator[List[str]]:
+    """Yield, page by page, the ids of records no row of the file was matched to.
+
+    Records with an empty key field can't be matched to a row and are kept.
+    """
+    for page in client.table.iterate(fields=file_keys.key_fields):
+        record_ids = []
+        for record in page:
+            if record["id"] in file_keys.record_ids:
+                continue
+            key = record_key(record["fields"], file_keys.key_fields)
+            if key is not None and key not in file_keys.unmatched_keys:
+                record_ids.append(record["id"])
+        if record_ids:
+            yield record_ids
+
+
+def delete_missing_records(
+    client: new_client,
+    file_keys: FileKeys,
+    workers: int = AIRTABLE_DELETE_WORKERS,
+    state=None,
+) -> int:
+    """Delete the records that no row of the uploaded file was matched to.
+
+    Returns:
+        int: Number of records Airtable confirmed as deleted
+    """
+    if not file_keys.complete:
+        raise CriticalError("The file was not read to the end, not deleting missing records!")
+    if not file_keys.keyed_rows:
+        raise CriticalError("No rows have values in the --upsert-on columns, not deleting missing records!")
+    if file_keys.unmatched_keys:
+        logger.warning(
+            f"{len(file_keys.unmatched_keys)} rows were not written, "
+            "keeping the records that match their --upsert-on values"
+        )
+    logger.info("Deleting records that are no longer in the file...")
+    deleted_count = client.delete_record_pages(
+        lambda: missing_record_ids(client, file_keys), workers
+    )
+    if state is not None:
+        state.retain_records(file_keys.record_ids, file_keys.unmatched_keys)
+    logger.info(f"Deleted {deleted_count} records that are not in the file")
+    return deleted_count
@@ -2,39 +2,242 @@
 JSON ingestion utilities for Airlift.
 
 This module reads JSON array payloads and converts each object into
-Airtable-compatible record dictionaries.
+Airtable-compatible record dictionaries. The array is decoded one element at
+a time from a buffered file so large exports are never held in memory at once.
+NDJSON/JSON Lines files are split at line boundaries and parsed in parallel
+worker processes.
 """
 
+import codecs
+import concurrent.futures
 import json
 import logging
+import mmap
+import multiprocessing
+import os
+import re
+from collections import deque
 from pathlib import Path
-from typing import Any, Dict, Iterable, List
+from typing import Any, Dict, Iterator, List, TextIO, Tuple
 
 from airlift.utils_exceptions import CriticalError
 
 CSVRowType = Dict[str, Any]
 
+# Number of records handed to the upload pipeline per chunk
+JSON_CHUNK_SIZE = 1000
+# Characters read from the file at a time while decoding
+JSON_READ_SIZE = 1 << 16
+# Bytes of an NDJSON file parsed by one worker process at a time
+NDJSON_SPLIT_SIZE = 4 << 20
+NDJSON_SUFFIXES = (".ndjson", ".jsonl")
+
 logger = logging.getLogger(__name__)
 
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
 
 def json_read(file_path: Path,fail_on_dup:bool) -> List[CSVRowType]:
+    return [
+        record
+        for chunk in json_stream(file_path, fail_on_dup)
+        for record in chunk
+    ]
+
+def json_stream(
+    file_path: Path, fail_on_dup: bool, chunk_size: int = JSON_CHUNK_SIZE
+) -> Iterator[List[CSVRowType]]:
+    """Check the JSON array opens with a record now and return a generator of chunks.
+
+    An empty or invalid file raises before anything is returned; an error
+    further into the array is raised when the generator reaches it.
+    """
     try:
-        with open(file_path,"r",encoding="utf-8-sig") as json_file:
-            return _json_read_rows(json_file,fail_on_dup)
+        json_file = open(file_path,"r",encoding="utf-8-sig")
     except FileNotFoundError as e:
         logger.debug(f"error : {e}")
         raise CriticalError(f"File {file_path} not found") from e
+    try:
+        objects = _JSONArrayReader(json_file, file_path, JSON_READ_SIZE).objects()
+        first = next(objects, None)
+        if first is None:
+            raise CriticalError("JSON file has no data")
+    except Exception:
+        json_file.close()
+        raise
+    return _json_chunks(json_file, first, objects, chunk_size)
+
+def _json_chunks(
+    json_file: TextIO, first: Any, objects: Iterator[Any], chunk_size: int
+) -> Iterator[List[CSVRowType]]:
+    with json_file:
+        records = [{"fields":first}]
+        for each_data in objects:
+            if len(records) >= chunk_size:
+                yield records
+                records = []
+            records.append({"fields":each_data})
+        yield records
+
+
+class _JSONArrayReader:
+    """Decode the elements of a top-level JSON array from a text stream."""
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, json_file: TextIO, file_path: Path, read_size: int):
+        self.json_file = json_file
+        self.file_path = file_path
+        self.read_size = read_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size: int) -> bool:
+        """Append at least `size` more characters to the buffer, if there are any."""
+        if self.eof:
+            return False
+        # Drop what was already decoded so the buffer stays bounded
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        chunk = self.json_file.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer += chunk
+        return True
+
+    def _next_char(self) -> str:
+        """Skip whitespace and return the next character without consuming it."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill(self.read_size):
+                return ""
+
+    def _invalid(self, message: str) -> CriticalError:
+        return CriticalError(f"Invalid JSON in {self.file_path}: {message}")
 
-def _json_read_rows(json_file:Iterable[str],fail_on_dup:bool) -> List[CSVRowType]:
-    reader = json.load(json_file)
-    
-    if not reader:
-        raise CriticalError("JSON file has no data")
-    
+    def _decode_value(self) -> Any:
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # The value may just continue past the buffer; read as much
+                # again as is buffered so long values are not re-parsed often
+                if self._fill(max(self.read_size, len(self.buffer) - self.pos)):
+                    continue
+                raise self._invalid(e.msg) from e
+            # A number could continue in the next read
+            if end == len(self.buffer) and self._fill(self.read_size):
+                continue
+            self.pos = end
+            return value
+
+    def objects(self) -> Iterator[Any]:
+        char = self._next_char()
+        if not char:
+            raise CriticalError("JSON file has no data")
+        if char != "[":
+            raise self._invalid("expected an array of records")
+        self.pos += 1
+        if self._next_char() == "]":
+            return
+        while True:
+            yield self._decode_value()
+            char = self._next_char()
+            self.pos += 1
+            if char == "]":
+                break
+            if not char:
+                raise self._invalid("unexpected end of file")
+            if char != ",":
+                raise self._invalid(f"expected ',' or ']' but found {char!r}")
+            # raw_decode does not skip whitespace before a value
+            self._next_char()
+        if self._next_char():
+            raise self._invalid("extra data after the array")
+
+
+def ndjson_stream(
+    file_path: Path, fail_on_dup: bool, split_size: int = NDJSON_SPLIT_SIZE
+) -> Iterator[List[CSVRowType]]:
+    """Parse an NDJSON/JSON Lines file, one chunk of records per line-aligned split.
+
+    The first split is parsed here so an empty or invalid file fails before
+    anything is returned; the rest are parsed across a process pool while the
+    returned generator is consumed, in file order.
+    """
+    try:
+        spans = _ndjson_spans(file_path, split_size)
+    except FileNotFoundError as e:
+        logger.debug(f"error : {e}")
+        raise CriticalError(f"File {file_path} not found") from e
+    while spans:
+        first = _parse_ndjson_span(file_path, *spans.pop(0))
+        if first:
+            return _ndjson_chunks(file_path, first, spans)
+    raise CriticalError("JSON file has no data")
+
+def _ndjson_spans(file_path: Path, split_size: int) -> List[Tuple[int, int]]:
+    """Split the file into (start, end) byte ranges that end on a newline."""
+    with open(file_path, "rb") as ndjson_file:
+        size = os.fstat(ndjson_file.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(ndjson_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            spans = []
+            start = 0
+            while start < size:
+                end = data.find(b"\n", min(start + split_size, size) - 1)
+                end = size if end == -1 else end + 1
+                spans.append((start, end))
+                start = end
+    return spans
+
+def _parse_ndjson_span(file_path: Path, start: int, end: int) -> List[CSVRowType]:
+    """Parse the lines in one byte range. Runs in a worker process."""
+    with open(file_path, "rb") as ndjson_file:
+        with mmap.mmap(ndjson_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            lines = data[start:end]
+    offset = start
+    if start == 0 and lines.startswith(codecs.BOM_UTF8):
+        lines = lines[len(codecs.BOM_UTF8):]
+        offset += len(codecs.BOM_UTF8)
     records = []
-    for each_data in reader:
-        
-        records.append({"fields":each_data})
-    
+    for line in lines.split(b"\n"):
+        if line.strip():
+            try:
+                records.append({"fields":json.loads(line)})
+            except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                raise CriticalError(
+                    f"Invalid JSON in {file_path} at byte {offset}: {e}"
+                ) from None
+        offset += len(line) + 1
     return records
-    
+
+def _ndjson_chunks(
+    file_path: Path, first: List[CSVRowType], spans: List[Tuple[int, int]]
+) -> Iterator[List[CSVRowType]]:
+    yield first
+    processes = min(len(spans), os.cpu_count() or 1)
+    if processes <= 1:
+        for span in spans:
+            yield _parse_ndjson_span(file_path, *span)
+        return
+    # spawn: the pool is started from an upload thread, where fork is unsafe
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+    )
+    try:
+        pending = deque()
+        for span in spans:
+            pending.append(executor.submit(_parse_ndjson_span, file_path, *span))
+            # Keep only a couple of parsed splits ahead of the upload
+            if len(pending) >= processes * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
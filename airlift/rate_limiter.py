@@ -0,0 +1,285 @@
+"""
+Request pacing utilities for Airlift.
+
+This module provides the token-bucket limiter shared by every Airtable request
+made against a base, a requests session that waits on it and honours
+Retry-After when Airtable answers with HTTP 429, and the AIMD controller that
+sizes how many upload requests are in flight.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterator, Optional
+
+import dropbox
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from airlift.utils_exceptions import CriticalError
+
+logger = logging.getLogger(__name__)
+
+# Airtable allows 5 requests per second per base and asks clients that were
+# throttled to wait 30 seconds before sending anything else.
+AIRTABLE_RATE_LIMIT = 5.0
+AIRTABLE_RATE_BURST = 1
+AIRTABLE_THROTTLE_WAIT = 30.0
+MAX_THROTTLE_RETRIES = 5
+# Dropped connections and read errors are retried by urllib3, as pyairtable's
+# own session does; 429s are left to the token bucket.
+TRANSPORT_RETRIES = 5
+TRANSPORT_BACKOFF = 0.1
+
+
+def transport_backoff(retry: int) -> float:
+    """Seconds to wait before transport retry number `retry`, as urllib3's Retry does."""
+    if retry <= 1:
+        return 0.0
+    return TRANSPORT_BACKOFF * 2 ** (retry - 1)
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second."""
+
+    def __init__(self, rate: float, burst: int):
+        if rate <= 0:
+            raise CriticalError("rate-limit must be greater than 0!")
+        if burst < 1:
+            raise CriticalError("rate-burst must be at least 1!")
+        self.rate = float(rate)
+        self.burst = int(burst)
+        self.throttle_count = 0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self._waits = threading.local()
+
+    def _take(self) -> float:
+        """Take a token if one is available; otherwise return how long to wait."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated) * self.rate,
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        """Block until a token is available, then take it."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            start = time.monotonic()
+            time.sleep(wait)
+            self._waits.seconds = self.waited() + time.monotonic() - start
+
+    def waited(self) -> float:
+        """Seconds the calling thread has spent waiting for tokens."""
+        return getattr(self._waits, "seconds", 0.0)
+
+    async def acquire_async(self) -> None:
+        """Wait on the event loop until a token is available, then take it."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no tokens for `seconds`, e.g. after being throttled."""
+        with self._lock:
+            self.throttle_count += 1
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+            self._blocked_until = max(self._blocked_until, self._updated + seconds)
+
+
+_limiters: Dict[str, TokenBucket] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str, rate: float, burst: int) -> TokenBucket:
+    """Return the limiter shared by every client of `key` (an Airtable base).
+
+    The first caller for a key decides its rate and burst.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = TokenBucket(rate, burst)
+            _limiters[key] = limiter
+        return limiter
+
+
+def retry_after_seconds(response: requests.Response) -> Optional[float]:
+    """Seconds a Retry-After header asks to wait, given as seconds or a date."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimitedSession(requests.Session):
+    """requests session that paces every request through a TokenBucket.
+
+    A 429 response pauses the shared bucket for the Retry-After period (or
+    Airtable's 30 second penalty) and the request is sent again. Connection
+    and read errors are retried by the mounted adapter, like pyairtable's
+    retrying session that this one replaces.
+    """
+
+    def __init__(self, limiter: TokenBucket, max_retries: int = MAX_THROTTLE_RETRIES):
+        super().__init__()
+        self.limiter = limiter
+        self.max_retries = max_retries
+        adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=TRANSPORT_RETRIES,
+                backoff_factor=TRANSPORT_BACKOFF,
+                status_forcelist=(),
+                allowed_methods=None,
+            )
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code != 429 or attempt >= self.max_retries:
+                return response
+            attempt += 1
+            response.close()
+            wait = retry_after_seconds(response)
+            if wait is None:
+                wait = AIRTABLE_THROTTLE_WAIT
+            logger.warning(
+                "Airtable rate limit hit, waiting %.1fs (attempt %s/%s)",
+                wait,
+                attempt,
+                self.max_retries,
+            )
+            self.limiter.pause(wait)
+
+
+def is_congestion_error(exc: BaseException) -> bool:
+    """Return True for errors that mean the remote side is overloaded (429/5xx)."""
+    while exc is not None:
+        if isinstance(exc, dropbox.exceptions.RateLimitError):
+            return True
+        status = getattr(exc, "status_code", None)
+        response = getattr(exc, "response", None)
+        if status is None and response is not None:
+            status = getattr(response, "status_code", None)
+        if isinstance(status, int) and (status == 429 or status >= 500):
+            return True
+        if isinstance(exc, dropbox.exceptions.ApiError):
+            tag = getattr(exc.error, "_tag", None)
+            if tag in {"too_many_requests", "too_many_write_operations"}:
+                return True
+        exc = exc.__cause__
+    return False
+
+
+class AdaptiveConcurrency:
+    """Additive-increase/multiplicative-decrease limit on requests in flight.
+
+    The limit grows by one after a full window of healthy requests and is
+    halved when a request fails with 429/5xx or was throttled on the way.
+    Requests slower than `latency_tolerance` times the observed baseline hold
+    the limit where it is instead of growing it. Time the request spent in
+    `wait_time` (e.g. a token bucket) is not counted as latency.
+    """
+
+    def __init__(
+        self,
+        maximum: int,
+        minimum: int = 1,
+        initial: Optional[int] = None,
+        latency_tolerance: float = 2.0,
+        throttle_count: Optional[Callable[[], int]] = None,
+        wait_time: Optional[Callable[[], float]] = None,
+    ):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = initial if initial else max(self.minimum, self.maximum // 2)
+        self.latency_tolerance = latency_tolerance
+        self._throttle_count = throttle_count or (lambda: 0)
+        self._wait_time = wait_time or (lambda: 0.0)
+        self._in_flight = 0
+        self._healthy = 0
+        self._epoch = 0
+        self._baseline: Optional[float] = None
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Hold one in-flight slot for the duration of a request."""
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+            epoch = self._epoch
+        throttles = self._throttle_count()
+        waited = self._wait_time()
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as exc:
+            self._release(epoch, None, is_congestion_error(exc))
+            raise
+        else:
+            throttled = self._throttle_count() > throttles
+            latency = time.monotonic() - start - (self._wait_time() - waited)
+            self._release(epoch, max(0.0, latency), throttled)
+
+    def _release(self, epoch: int, latency: Optional[float], congested: bool) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            if congested:
+                # Only the first failure of a window cuts the limit; requests
+                # already in flight at that point report the same congestion.
+                if epoch == self._epoch:
+                    self._epoch += 1
+                    self._healthy = 0
+                    self.limit = max(self.minimum, self.limit // 2)
+                    logger.debug("Concurrency decreased to %s", self.limit)
+            elif latency is not None:
+                if self._baseline is None or latency < self._baseline:
+                    self._baseline = latency
+                else:
+                    # Let the baseline drift upwards slowly with the network
+                    self._baseline += (latency - self._baseline) * 0.05
+                if latency <= self._baseline * self.latency_tolerance:
+                    self._healthy += 1
+                    if self._healthy >= self.limit and self.limit < self.maximum:
+                        self._healthy = 0
+                        self.limit += 1
+                        logger.debug("Concurrency increased to %s", self.limit)
+            self._cond.notify_all()
@@ -0,0 +1,155 @@
+"""
+Persistent incremental sync state for Airlift.
+
+This module keeps one SQLite file per Airtable base/table that maps each merge
+key to the record id and content hash written by earlier runs, so repeated
+--incremental uploads can work out the delta without reading the table again.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from airlift.incremental_sync import RecordKey, RemoteIndex
+from airlift.utils_cache import safe_name, state_file
+
+logger = logging.getLogger(__name__)
+
+
+class SyncState:
+    """SQLite-backed map of merge key -> (record id, content hash)."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "key TEXT PRIMARY KEY, record_id TEXT NOT NULL, hash TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)"
+            )
+        logger.debug(f"Using sync state {self.path}")
+
+    @classmethod
+    def for_table(cls, base: str, table: str, log_file: Optional[Path] = None) -> "SyncState":
+        """Open the state file of a base/table, next to --log or in the cache dir."""
+        name = f"airlift-sync-{safe_name(base)}-{safe_name(table)}.sqlite"
+        return cls(state_file(name, log_file))
+
+    @staticmethod
+    def _signature(key_fields: List[str], compare_fields: List[str]) -> str:
+        return json.dumps({"keys": key_fields, "fields": sorted(compare_fields)})
+
+    def matches(self, key_fields: List[str], compare_fields: List[str]) -> bool:
+        """Return True if the stored hashes were made for the same columns."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE name = 'signature'"
+            ).fetchone()
+        return row is not None and row[0] == self._signature(key_fields, compare_fields)
+
+    def load_index(self) -> RemoteIndex:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, record_id, hash FROM records"
+            ).fetchall()
+        return {tuple(json.loads(key)): (record_id, hash_) for key, record_id, hash_ in rows}
+
+    def synced_at(self) -> Optional[datetime]:
+        """Return when the stored index was last read from Airtable, if known."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE name = 'synced_at'"
+            ).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def mark_synced(self, synced_at: datetime) -> None:
+        """Record that the stored index matches Airtable as of `synced_at`."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('synced_at', ?)",
+                (synced_at.isoformat(),),
+            )
+
+    def reset(
+        self,
+        key_fields: List[str],
+        compare_fields: List[str],
+        index: RemoteIndex,
+        synced_at: Optional[datetime] = None,
+    ) -> None:
+        """Replace the stored state with `index`, read from Airtable at `synced_at`."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM records")
+            self._conn.executemany(
+                "INSERT INTO records (key, record_id, hash) VALUES (?, ?, ?)",
+                (
+                    (json.dumps(list(key)), record_id, hash_)
+                    for key, (record_id, hash_) in index.items()
+                ),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('signature', ?)",
+                (self._signature(key_fields, compare_fields),),
+            )
+            if synced_at is None:
+                self._conn.execute("DELETE FROM meta WHERE name = 'synced_at'")
+            else:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (name, value) VALUES ('synced_at', ?)",
+                    (synced_at.isoformat(),),
+                )
+
+    def record_rows(self, rows: Iterable[Dict]) -> None:
+        """Remember rows that were written, using their "sync" key/hash and "id"."""
+        values = [
+            (json.dumps(list(row["sync"][0])), row["id"], row["sync"][1])
+            for row in rows
+            if row.get("sync") and row.get("id")
+        ]
+        if not values:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO records (key, record_id, hash) VALUES (?, ?, ?)",
+                values,
+            )
+
+    def forget_rows(self, rows: Iterable[Dict]) -> None:
+        """Drop the entries of rows whose record no longer exists in Airtable."""
+        keys = [(json.dumps(list(row["sync"][0])),) for row in rows if row.get("sync")]
+        if not keys:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM records WHERE key = ?", keys)
+
+    def retain_records(
+        self, record_ids: Iterable[str], keys: Iterable[RecordKey] = ()
+    ) -> None:
+        """Forget the records that are neither in `record_ids` nor keyed by `keys`.
+
+        Used after deleting the records no row of the file was matched to.
+        """
+        keep_ids = set(record_ids)
+        keep_keys = {json.dumps(list(key)) for key in keys}
+        with self._lock, self._conn:
+            stored = self._conn.execute("SELECT key, record_id FROM records").fetchall()
+            self._conn.executemany(
+                "DELETE FROM records WHERE key = ?",
+                (
+                    (key,)
+                    for key, record_id in stored
+                    if record_id not in keep_ids and key not in keep_keys
+                ),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,43 @@
+"""
+Local cache locations for Airlift.
+
+This module resolves where Airlift keeps state that outlives a single run,
+such as incremental sync state.
+"""
+
+import os
+import re
+from pathlib import Path
+from typing import Optional
+
+
+def cache_dir() -> Path:
+    """Return (and create) the per-user Airlift cache directory.
+
+    AIRLIFT_CACHE_DIR overrides the default of $XDG_CACHE_HOME/airlift or
+    ~/.cache/airlift.
+    """
+    override = os.environ.get("AIRLIFT_CACHE_DIR")
+    if override:
+        path = Path(override)
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+            os.path.expanduser("~"), ".cache"
+        )
+        path = Path(base) / "airlift"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def safe_name(value: str) -> str:
+    """Reduce a value such as a table id to characters safe in a file name."""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", value or "")
+
+
+def state_file(name: str, log_file: Optional[Path] = None) -> Path:
+    """Return the path of a state file, next to --log when one is given."""
+    if log_file:
+        folder = Path(log_file).resolve().parent
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder / name
+    return cache_dir() / name
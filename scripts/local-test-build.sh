@@ -322,7 +322,7 @@ install_dependencies() {
         print_success "Selected dependencies updated"
     else
         # Standard install from existing lock file
-        if ! "$poetry_bin" install; then
+        if ! "$poetry_bin" install --extras async; then
             print_error "Failed to install dependencies"
             exit 1
         fi
@@ -399,7 +399,7 @@ show_outdated() {
     configure_poetry
     
     # Install current dependencies first
-    if ! "$poetry_bin" install; then
+    if ! "$poetry_bin" install --extras async; then
         print_error "Failed to install dependencies for outdated check"
         exit 1
     fi
@@ -31,6 +31,18 @@ class AirliftArgs:
     attachment_columns_map: Optional[List]
     columns_copy: Optional[List]
     log: Optional[str]
+    adaptive_concurrency: bool = False
+    attachment_workers: Optional[int] = None
+    writer_workers: Optional[int] = None
+    engine: Optional[str] = None
+    upsert_on: Optional[List] = None
+    incremental: bool = False
+    sync_state: bool = False
+    verify_state: bool = False
+    dropbox_retain_days: Optional[int] = None
+    dropbox_retain_runs: Optional[int] = None
+    delete_by_formula: Optional[str] = None
+    delete_missing: bool = False
 
 
 ARGS_DICT = {
@@ -82,6 +82,7 @@ import csv
 import json
 import os
 import tempfile
+import time
 import warnings
 from pathlib import Path
 from unittest.mock import MagicMock, patch
@@ -92,8 +93,8 @@ import pytest
 from airlift.cli_args import parse_args
 from airlift.utils_exceptions import CriticalError, AirtableError, TypeConversionError
 from airlift.version import __version__
-from airlift.csv_data import csv_read, _list_duplicates, _remove_duplicates
-from airlift.json_data import json_read
+from airlift.csv_data import csv_read, csv_stream, _list_duplicates, _remove_duplicates
+from airlift.json_data import json_read, json_stream, ndjson_stream
 
 # Suppress warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -200,6 +201,22 @@ class TestCLIArgumentParsing:
         assert args.columns_copy == ["Source", "Dest1", "Dest2"]
         assert args.rename_key_column == ["OldKey", "NewKey"]
     
+    def test_upsert_on_option(self):
+        """Test --upsert-on accepts zero or more columns."""
+        base_args = [
+            "--token", "pat_test_token_12345",
+            "--base", "appTestBaseId123",
+            "--table", "tblTestTableId456",
+        ]
+        args = parse_args(base_args + ["--upsert-on", "Cat ID", "Name", "--", "data.csv"])
+        assert args.upsert_on == ["Cat ID", "Name"]
+
+        args = parse_args(base_args + ["--upsert-on", "--", "data.csv"])
+        assert args.upsert_on == []
+
+        args = parse_args(base_args + ["data.csv"])
+        assert args.upsert_on is None
+
     def test_validation_options(self):
         """Test validation CLI options."""
         args = parse_args([
@@ -287,6 +304,39 @@ class TestCLIArgumentParsing:
         
         assert args.empty_dropbox_folder is False
 
+    def test_filtered_delete_args(self):
+        """Test --delete-by-formula takes a formula and --delete-missing is a flag."""
+        args = parse_args([
+            "--token", "pat_test_token_12345",
+            "--base", "appTestBaseId123",
+            "--table", "tblTestTableId456",
+            "--delete-by-formula", "{Status} = 'Stale'",
+        ])
+        assert args.delete_by_formula == "{Status} = 'Stale'"
+        assert args.delete_missing is False
+
+        args = parse_args([
+            "--token", "pat_test_token_12345",
+            "--base", "appTestBaseId123",
+            "--table", "tblTestTableId456",
+            "--upsert-on", "ID",
+            "--delete-missing",
+            "test.csv",
+        ])
+        assert args.delete_missing is True
+
+    def test_dropbox_retention_args(self):
+        """Test --dropbox-retain-days and --dropbox-retain-runs parse as integers."""
+        args = parse_args([
+            "--dropbox-token", "dropbox-token.json",
+            "--dropbox-retain-days", "30",
+            "--dropbox-retain-runs", "5",
+        ])
+
+        assert args.dropbox_retain_days == 30
+        assert args.dropbox_retain_runs == 5
+        assert args.csv_file is None
+
 
 # ============================================================================
 # 2. TestCSVDataProcessing - CSV File Processing
@@ -357,6 +407,38 @@ class TestCSVDataProcessing:
         finally:
             os.unlink(temp_path)
     
+    def test_csv_stream_yields_bounded_chunks(self):
+        """Test CSV rows are parsed lazily into chunks of at most chunk_size."""
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, encoding='utf-8') as f:
+            f.write("Name,Age\n")
+            for i in range(5):
+                f.write(f"Cat{i},{i}\n")
+            f.write("Short\n")
+            temp_path = f.name
+
+        try:
+            chunks = list(csv_stream(Path(temp_path), fail_on_dup=False, chunk_size=2))
+            assert [len(chunk) for chunk in chunks] == [2, 2, 2]
+            assert chunks[0][1]["fields"] == {"Name": "Cat1", "Age": "1"}
+            assert chunks[2][1]["fields"] == {"Name": "Short", "Age": ""}
+        finally:
+            os.unlink(temp_path)
+
+    def test_csv_stream_checks_header_before_iterating(self):
+        """Test duplicate header errors are raised before any row is read."""
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False, encoding='utf-8') as f:
+            f.write("Name,Age,Name\n")
+            f.write("Alice,30,Alice2\n")
+            temp_path = f.name
+
+        try:
+            with pytest.raises(CriticalError, match="Duplicate columns"):
+                csv_stream(Path(temp_path), fail_on_dup=True)
+            chunks = list(csv_stream(Path(temp_path), fail_on_dup=False))
+            assert chunks[0][0]["fields"] == {"Name": "Alice2", "Age": "30"}
+        finally:
+            os.unlink(temp_path)
+
     def test_list_duplicates(self):
         """Test duplicate detection utility."""
         assert _list_duplicates(["a", "b", "c"]) == []
@@ -413,6 +495,65 @@ class TestJSONDataProcessing:
         finally:
             os.unlink(temp_path)
     
+    def test_json_stream_yields_bounded_chunks(self):
+        """Test JSON array elements are decoded lazily into chunks."""
+        test_data = [{"Name": f"Cat{i}", "Notes": "x" * i} for i in range(5)]
+
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False, encoding='utf-8') as f:
+            json.dump(test_data, f, indent=2)
+            temp_path = f.name
+
+        try:
+            with patch("airlift.json_data.JSON_READ_SIZE", 8):
+                chunks = list(json_stream(Path(temp_path), fail_on_dup=False, chunk_size=2))
+            assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+            assert [row["fields"] for chunk in chunks for row in chunk] == test_data
+        finally:
+            os.unlink(temp_path)
+
+    def test_json_invalid_file(self):
+        """Test invalid or non-array JSON raises CriticalError."""
+        for content, message in [("", "no data"), ('{"Name": "Alice"}', "array"), ('[{"Name": 1} {"Name": 2}]', "Invalid JSON")]:
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False, encoding='utf-8') as f:
+                f.write(content)
+                temp_path = f.name
+
+            try:
+                with pytest.raises(CriticalError, match=message):
+                    json_read(Path(temp_path), fail_on_dup=False)
+            finally:
+                os.unlink(temp_path)
+
+    def test_ndjson_stream_splits_on_lines(self, tmp_path):
+        """Test NDJSON splits end on line boundaries and keep file order."""
+        test_data = [{"Name": f"Cat{i}", "Tags": ["a"] * (i % 3)} for i in range(40)]
+        path = tmp_path / "records.ndjson"
+        path.write_bytes(
+            b"\xef\xbb\xbf"
+            + "\n\n".join(json.dumps(row) for row in test_data).encode("utf-8")
+        )
+
+        with patch("airlift.json_data.os.cpu_count", return_value=2):
+            chunks = list(ndjson_stream(path, fail_on_dup=False, split_size=200))
+
+        assert len(chunks) > 2
+        assert [row["fields"] for chunk in chunks for row in chunk] == test_data
+
+    def test_ndjson_invalid_and_empty_files(self, tmp_path):
+        """Test NDJSON input keeps the JSON CriticalError messages."""
+        empty = tmp_path / "empty.jsonl"
+        empty.write_text("\n\n", encoding="utf-8")
+        with pytest.raises(CriticalError, match="no data"):
+            ndjson_stream(empty, fail_on_dup=False)
+
+        invalid = tmp_path / "invalid.jsonl"
+        invalid.write_text('{"Name": "Alice"}\n{"Name": \n', encoding="utf-8")
+        with pytest.raises(CriticalError, match="Invalid JSON .* at byte 18"):
+            ndjson_stream(invalid, fail_on_dup=False)
+
+        with pytest.raises(CriticalError, match="not found"):
+            ndjson_stream(tmp_path / "missing.ndjson", fail_on_dup=False)
+
     def test_json_complex_data(self):
         """Test reading JSON with complex nested data."""
         test_data = [
@@ -492,6 +633,135 @@ class TestAirtableClient:
         assert client.missing_field_single("ExistingField") is True
         assert client.missing_field_single("NonExistentField") is False
     
+    @patch('airlift.airtable_client.Api')
+    def test_schema_fetched_once_and_refreshed_after_field_creation(self, mock_api):
+        """Test field lookups reuse one schema read until a field is created."""
+        from airlift.airtable_client import new_client
+
+        def _schema(names):
+            fields = []
+            for name in names:
+                field = MagicMock()
+                field.name = name
+                fields.append(field)
+            table = MagicMock(id="tblTestTable", fields=fields)
+            return MagicMock(tables=[table])
+
+        mock_base = mock_api.return_value.base.return_value
+        mock_base.schema.side_effect = [_schema(["Name"]), _schema(["Name", "New"])]
+
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+        for _ in range(100):
+            assert client.missing_field_single("Name") is True
+        assert client.missing_field_single("New") is False
+        assert mock_base.schema.call_count == 1
+
+        with patch.object(
+            client.api_client.session, "post",
+            return_value=MagicMock(status_code=200),
+        ):
+            client._create_new_field("New")
+        assert client.missing_field_single("New") is True
+        assert mock_base.schema.call_count == 2
+        assert mock_base.schema.call_args.kwargs == {"force": True}
+
+    @patch('airlift.airtable_client.Api')
+    def test_transform_plan_validates_once(self, mock_api):
+        """Test column options are checked once and then applied per row."""
+        from airlift.airtable_client import new_client
+
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+        args = MagicMock()
+        args.columns_copy = ["Location", "Location-01", "Location-02"]
+        args.rename_key_column = ["Cat ID", "Animal ID"]
+        args.attachment_columns_map = [["Image Filename", "Attachments"]]
+
+        with patch.object(client, "missing_field_single", return_value=True) as check:
+            plan = client.compile_transform_plan(args)
+            rows = [
+                {"fields": {"Cat ID": str(i), "Location": "Den"}} for i in range(50)
+            ]
+            transformed = list(plan.apply_all(rows))
+
+        assert check.call_count == 3
+        assert transformed[7]["fields"] == {
+            "Animal ID": "7",
+            "Location": "Den",
+            "Location-01": "Den",
+            "Location-02": "Den",
+            "Attachments": [],
+        }
+
+    @patch('airlift.airtable_client.Api')
+    def test_transform_plan_rejects_missing_copy_target(self, mock_api):
+        """Test a --columns-copy target missing in Airtable fails up front."""
+        from airlift.airtable_client import new_client
+
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+        args = MagicMock()
+        args.columns_copy = ["Location", "Missing"]
+        args.rename_key_column = None
+        args.attachment_columns_map = None
+
+        with patch.object(client, "missing_field_single", return_value=False):
+            with pytest.raises(CriticalError, match="Missing"):
+                client.compile_transform_plan(args)
+
+    @patch('airlift.airtable_client.Api')
+    def test_stream_uploadable_data_is_lazy(self, mock_api):
+        """Test only the first row is read before the upload pulls the rest."""
+        from airlift.airtable_client import new_client
+
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+        args = MagicMock()
+        args.columns_copy = None
+        args.rename_key_column = None
+        args.attachment_columns_map = None
+        args.upsert_on = None
+        pulled = []
+
+        def rows():
+            for i in range(3):
+                pulled.append(i)
+                yield {"fields": {"Name": f"Cat{i}", "Extra": "x"}}
+
+        with patch.object(client, "_missing_fields_check", return_value=["Extra"]):
+            stream = client.stream_uploadable_data(rows(), args)
+            assert pulled == [0]
+            transformed = list(stream)
+
+        assert pulled == [0, 1, 2]
+        assert transformed[2]["fields"] == {"Name": "Cat2"}
+
+    @patch('airlift.airtable_client.Api')
+    def test_stream_uploadable_data_empty_file(self, mock_api):
+        """Test an empty stream fails before anything is uploaded."""
+        from airlift.airtable_client import new_client
+
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+        with pytest.raises(CriticalError, match="File is empty"):
+            client.stream_uploadable_data(iter([]), MagicMock())
+
     def test_rename_key_column_validation(self):
         """Test rename key column validation logic."""
         from airlift.airtable_client import new_client
@@ -516,7 +786,7 @@ class TestAirtableClient:
         from airlift.airtable_client import new_client
         
         mock_table = MagicMock()
-        mock_table.all.return_value = []
+        mock_table.iterate.return_value = iter([])
         
         mock_api_instance = MagicMock()
         mock_api_instance.table.return_value = mock_table
@@ -545,8 +815,11 @@ class TestAirtableClient:
         ]
         
         mock_table = MagicMock()
-        mock_table.all.return_value = mock_records
-        mock_table.batch_delete.return_value = None
+        # Pages are deleted as they arrive; the second scan finds the table empty
+        mock_table.iterate.side_effect = [iter([mock_records]), iter([])]
+        mock_table.batch_delete.return_value = [
+            {"id": record["id"], "deleted": True} for record in mock_records
+        ]
         
         mock_api_instance = MagicMock()
         mock_api_instance.table.return_value = mock_table
@@ -562,6 +835,259 @@ class TestAirtableClient:
         deleted_count = client.delete_all_records()
         assert deleted_count == 3
         mock_table.batch_delete.assert_called_once_with(["rec1", "rec2", "rec3"])
+        mock_table.all.assert_not_called()
+
+    @patch('airlift.airtable_client.Api')
+    def test_delete_all_records_pipelined_ids_only(self, mock_api):
+        """Test deletes start per page, request only the primary field and survive an expired listing."""
+        import requests
+        from airlift.airtable_client import new_client
+
+        import threading
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+        # Worker threads and the scan share the mocked Api's table
+        mock_table = mock_api.return_value.table.return_value
+        schema_table = MagicMock(id="tblTestTable", primary_field_id="fldPrimary")
+        client.base = MagicMock()
+        client.base.schema.return_value = MagicMock(tables=[schema_table])
+
+        expired = requests.HTTPError(
+            response=MagicMock(status_code=422, text='{"error": "LIST_RECORDS_ITERATOR_NOT_AVAILABLE"}')
+        )
+        first_page = [{"id": f"rec{i}", "fields": {}} for i in range(15)]
+        started = threading.Event()
+
+        def first_scan():
+            yield first_page
+            # Deleting the first page began before the second one was requested
+            assert started.wait(5)
+            raise expired
+
+        def batch_delete(record_ids):
+            started.set()
+            return [{"id": record_id, "deleted": True} for record_id in record_ids]
+
+        mock_table.iterate.side_effect = [
+            first_scan(),
+            iter([[{"id": "rec15", "fields": {}}]]),
+            iter([]),
+        ]
+        mock_table.batch_delete.side_effect = batch_delete
+
+        assert client.delete_all_records() == 16
+        assert sorted(len(c.args[0]) for c in mock_table.batch_delete.call_args_list) == [1, 5, 10]
+        for call in mock_table.iterate.call_args_list:
+            assert call.kwargs == {"fields": ["fldPrimary"]}
+
+    @patch('airlift.airtable_client.Api')
+    def test_delete_by_formula_filters_the_scan(self, mock_api):
+        """Test --delete-by-formula only lists and deletes matching records."""
+        from airlift.airtable_client import new_client
+
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+        mock_table = mock_api.return_value.table.return_value
+        client.base = MagicMock()
+        client.base.schema.return_value = MagicMock(
+            tables=[MagicMock(id="tblTestTable", primary_field_id="fldPrimary")]
+        )
+        mock_table.iterate.side_effect = [iter([[{"id": "rec1", "fields": {}}]]), iter([])]
+        mock_table.batch_delete.return_value = [{"id": "rec1", "deleted": True}]
+
+        assert client.delete_by_formula("{Status} = 'Stale'") == 1
+        mock_table.iterate.assert_called_with(
+            fields=["fldPrimary"], formula="{Status} = 'Stale'"
+        )
+        mock_table.batch_delete.assert_called_once_with(["rec1"])
+
+    @patch('airlift.airtable_client.time.sleep')
+    @patch('airlift.airtable_client.Api')
+    def test_delete_all_records_retries_and_counts(self, mock_api, mock_sleep):
+        """Test failed delete chunks are retried with backoff and only confirmed deletes count."""
+        import requests
+        from airlift.airtable_client import new_client
+
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+        mock_table = mock_api.return_value.table.return_value
+        records = [{"id": f"rec{i}", "fields": {}} for i in range(30)]
+        mock_table.iterate.side_effect = [iter([records]), iter([])]
+        unavailable = requests.HTTPError(response=MagicMock(status_code=503))
+        attempts = {}
+
+        def batch_delete(record_ids):
+            attempts[record_ids[0]] = attempts.get(record_ids[0], 0) + 1
+            if record_ids[0] == "rec10" and attempts["rec10"] < 3:
+                raise unavailable
+            # Airtable reports one record of the last chunk as not deleted
+            return [
+                {"id": record_id, "deleted": record_id != "rec29"} for record_id in record_ids
+            ]
+
+        mock_table.batch_delete.side_effect = batch_delete
+
+        assert client.delete_all_records(workers=3) == 29
+        assert attempts["rec10"] == 3
+        assert [c.args[0] for c in mock_sleep.call_args_list] == [1.0, 2.0]
+
+        # An error that retrying cannot fix stops the run
+        mock_table.iterate.side_effect = [iter([records])]
+        mock_table.batch_delete.side_effect = requests.HTTPError(
+            response=MagicMock(status_code=403)
+        )
+        with pytest.raises(AirtableError):
+            client.delete_all_records(workers=3)
+
+    @patch('airlift.airtable_client.Api')
+    def test_delete_all_records_clamps_worker_count(self, mock_api):
+        """Test a worker count below one still deletes with a single worker."""
+        from airlift.airtable_client import new_client
+
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+        mock_table = mock_api.return_value.table.return_value
+        records = [{"id": f"rec{i}", "fields": {}} for i in range(25)]
+        mock_table.iterate.side_effect = [iter([records]), iter([])]
+        mock_table.batch_delete.side_effect = lambda record_ids: [
+            {"id": record_id, "deleted": True} for record_id in record_ids
+        ]
+
+        assert client.delete_all_records(workers=-1) == 25
+
+    @patch('airlift.airtable_client.Api')
+    def test_batch_upload_single_request(self, mock_api):
+        """Test batch_upload creates a whole batch with one request."""
+        from airlift.airtable_client import new_client
+
+        mock_table = mock_api.return_value.table.return_value
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+
+        records = [{"fields": {"Name": f"Test{i}"}} for i in range(10)]
+        failed = client.batch_upload(records)
+
+        assert failed == []
+        mock_table.batch_create.assert_called_once_with(
+            [record["fields"] for record in records], typecast=True
+        )
+        mock_table.create.assert_not_called()
+
+    @patch('airlift.airtable_client.Api')
+    def test_batch_upload_isolates_invalid_rows(self, mock_api):
+        """Test a batch rejected with 422 is retried per row to find bad records."""
+        import requests
+        from airlift.airtable_client import new_client
+
+        def _http_error(status):
+            response = MagicMock()
+            response.status_code = status
+            return requests.exceptions.HTTPError("error", response=response)
+
+        mock_table = mock_api.return_value.table.return_value
+
+        def _create(fields, typecast):
+            if any(record["Name"] == "Bad" for record in fields):
+                raise _http_error(422)
+
+        mock_table.batch_create.side_effect = _create
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+
+        records = [
+            {"fields": {"Name": "Good1"}},
+            {"fields": {"Name": "Bad"}},
+            {"fields": {"Name": "Good2"}},
+        ]
+        failed = client.batch_upload(records)
+
+        assert [data for data, _error in failed] == [records[1]]
+        # One rejected batch, then one request per row
+        assert mock_table.batch_create.call_count == 4
+
+    @patch('airlift.airtable_client.Api')
+    def test_batch_upsert_merges_on_key_fields(self, mock_api):
+        """Test batch_upsert sends performUpsert batches and flags rows without keys."""
+        from airlift.airtable_client import new_client
+
+        mock_table = mock_api.return_value.table.return_value
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+
+        records = [
+            {"fields": {"Animal ID": "1", "Name": "Lion"}},
+            {"fields": {"Name": "No key"}},
+            {"fields": {"Animal ID": "", "Name": "Empty key"}},
+            {"fields": {"Animal ID": "  ", "Name": "Blank key"}},
+            {"fields": {"Animal ID": None, "Name": "Null key"}},
+        ]
+        failed = client.batch_upsert(records, ["Animal ID"])
+
+        assert [data for data, _error in failed] == records[1:]
+        assert all("Animal ID" in str(error) for _data, error in failed)
+        mock_table.batch_upsert.assert_called_once_with(
+            [{"fields": {"Animal ID": "1", "Name": "Lion"}}],
+            key_fields=["Animal ID"],
+            typecast=True,
+        )
+
+    def test_upsert_fields_follow_rename_key_column(self):
+        """Test --upsert-on names are mapped through --rename-key-column."""
+        from airlift.airtable_client import upsert_fields
+
+        args = MagicMock()
+        args.rename_key_column = ["Cat ID", "Animal ID"]
+        args.upsert_on = ["Cat ID", "Name"]
+        assert upsert_fields(args) == ["Animal ID", "Name"]
+
+        args.upsert_on = []
+        assert upsert_fields(args) == ["Animal ID"]
+
+        args.rename_key_column = None
+        with pytest.raises(CriticalError, match="upsert-on"):
+            upsert_fields(args)
+
+        args.upsert_on = ["A", "B", "C", "D"]
+        with pytest.raises(CriticalError, match="at most 3"):
+            upsert_fields(args)
+
+    @patch('airlift.airtable_client.Api')
+    def test_batch_upload_other_errors_abort(self, mock_api):
+        """Test non-422 batch errors are raised instead of retried per row."""
+        from airlift.airtable_client import new_client
+
+        mock_table = mock_api.return_value.table.return_value
+        mock_table.batch_create.side_effect = ConnectionError("offline")
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
+        )
+
+        with pytest.raises(AirtableError):
+            client.batch_upload([{"fields": {"Name": "Test"}}])
+        mock_table.create.assert_not_called()
 
 
 # ============================================================================
@@ -582,7 +1108,11 @@ class TestUploadFunctionality:
         mock_args.attachment_columns_map = None
         mock_args.columns_copy = None
         mock_args.rename_key_column = None
+        mock_args.upsert_on = None
         mock_args.workers = 5
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
         mock_args.log = None
         
         upload = Upload(
@@ -607,7 +1137,11 @@ class TestUploadFunctionality:
         mock_args.attachment_columns_map = None
         mock_args.columns_copy = None
         mock_args.rename_key_column = None
+        mock_args.upsert_on = None
         mock_args.workers = None  # Not specified
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
         mock_args.log = None
         
         upload = Upload(
@@ -625,47 +1159,384 @@ class TestUploadFunctionality:
         
         mock_client = MagicMock()
         mock_args = MagicMock()
-        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = None
+        mock_args.workers = 10
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+        
+        upload = Upload(
+            client=mock_client,
+            new_data=[],
+            dbx=None,
+            args=mock_args
+        )
+        
+        assert upload.workers == 10
+
+    def test_upload_has_stop_event(self):
+        """Test Upload has stop_event for worker coordination (regression for CriticalError stop)."""
+        from airlift.airtable_upload import Upload
+        import threading
+
+        mock_client = MagicMock()
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = None
+        mock_args.workers = 5
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+
+        upload = Upload(
+            client=mock_client,
+            new_data=[],
+            dbx=None,
+            args=mock_args
+        )
+        assert hasattr(upload, "stop_event")
+        assert isinstance(upload.stop_event, threading.Event)
+        assert upload.stop_event.is_set() is False
+
+    def test_upload_data_sends_batches_of_ten(self):
+        """Test rows are grouped into Airtable batches of at most 10 records."""
+        from airlift.airtable_upload import Upload
+
+        mock_client = MagicMock()
+        mock_client.batch_upload.return_value = []
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = None
+        mock_args.workers = 1
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+
+        rows = [{"fields": {"Name": f"Test{i}"}} for i in range(23)]
+        upload = Upload(
+            client=mock_client,
+            new_data=rows,
+            dbx=None,
+            args=mock_args
+        )
+        upload.upload_data()
+
+        sizes = [len(c.args[0]) for c in mock_client.batch_upload.call_args_list]
+        assert sizes == [10, 10, 3]
+        mock_client.single_upload.assert_not_called()
+
+    def test_upload_data_consumes_generator(self):
+        """Test rows streamed from a generator are all uploaded."""
+        from airlift.airtable_upload import Upload
+
+        mock_client = MagicMock()
+        mock_client.batch_upload.return_value = []
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = None
+        mock_args.workers = 3
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+
+        rows = ({"fields": {"Name": f"Test{i}"}} for i in range(25))
+        upload = Upload(
+            client=mock_client,
+            new_data=rows,
+            dbx=None,
+            args=mock_args
+        )
+        upload.upload_data()
+
+        sent = [
+            data["fields"]["Name"]
+            for c in mock_client.batch_upload.call_args_list
+            for data in c.args[0]
+        ]
+        assert sorted(sent) == sorted(f"Test{i}" for i in range(25))
+
+    @staticmethod
+    def _pipeline_args(attachment_workers, writer_workers):
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = None
+        mock_args.workers = 5
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = attachment_workers
+        mock_args.writer_workers = writer_workers
+        mock_args.log = None
+        return mock_args
+
+    def test_slow_writers_hold_back_the_input(self):
+        """Test the bounded write queue stops rows being read far ahead of Airtable."""
+        import threading
+        from airlift.airtable_upload import Upload
+
+        release = threading.Event()
+        writer_threads = set()
+        written = []
+
+        def batch_upload(batch):
+            writer_threads.add(threading.get_ident())
+            release.wait(5)
+            written.extend(batch)
+            return []
+
+        mock_client = MagicMock()
+        mock_client.batch_upload.side_effect = batch_upload
+        pulled = []
+
+        def rows():
+            for i in range(100):
+                pulled.append(i)
+                yield {"fields": {"Name": f"Test{i}"}}
+
+        upload = Upload(
+            client=mock_client, new_data=rows(), dbx=None,
+            args=self._pipeline_args(attachment_workers=2, writer_workers=1),
+        )
+        assert (upload.attachment_workers, upload.writer_workers) == (2, 1)
+        thread = threading.Thread(target=upload.upload_data)
+        thread.start()
+        time.sleep(0.3)
+        # One batch in the writer, a full queue and one row per attachment worker
+        assert len(pulled) <= 10 + 20 + 2
+        release.set()
+        thread.join(5)
+
+        assert not thread.is_alive()
+        assert len(written) == 100
+        assert len(writer_threads) == 1
+
+    def test_writer_failure_stops_the_pipeline(self):
+        """Test a failed Airtable write stops the attachment stage instead of hanging."""
+        from airlift.airtable_upload import Upload
+
+        mock_client = MagicMock()
+        mock_client.batch_upload.side_effect = RuntimeError("Airtable is down")
+        pulled = []
+
+        def rows():
+            for i in range(1000):
+                pulled.append(i)
+                yield {"fields": {"Name": f"Test{i}"}}
+
+        upload = Upload(
+            client=mock_client, new_data=rows(), dbx=None,
+            args=self._pipeline_args(attachment_workers=3, writer_workers=2),
+        )
+        upload.upload_data()
+
+        assert upload.stop_event.is_set()
+        assert len(pulled) < 1000
+
+    def test_stopped_writers_log_discarded_rows(self, caplog):
+        """Test prepared rows dropped by a stop are counted in the log."""
+        import logging
+        import threading
+        import time
+        from airlift.airtable_upload import Upload, _END
+
+        upload = Upload(
+            client=MagicMock(), new_data=[], dbx=None,
+            args=self._pipeline_args(attachment_workers=1, writer_workers=1),
+        )
+        for i in range(3):
+            upload._write_queue.put({"fields": {"Name": f"Test{i}"}})
+        writer = threading.Thread(target=upload._writer, args=(MagicMock(),), daemon=True)
+        writer.start()
+        while not upload._write_queue.empty():
+            time.sleep(0.01)
+        with caplog.at_level(logging.WARNING, logger="airlift.airtable_upload"):
+            upload.stop_event.set()
+            writer.join(5)
+            upload._write_queue.put({"fields": {"Name": "queued"}})
+            upload._write_queue.put(_END)
+            upload._discard_queued_rows()
+
+        assert not writer.is_alive()
+        messages = [record.getMessage() for record in caplog.records]
+        assert "Upload stopped, discarded 3 prepared rows that were not written" in messages
+        assert "Upload stopped, discarded 1 prepared rows that were not written" in messages
+        upload.client.batch_upload.assert_not_called()
+
+    def test_upload_data_upserts_when_merge_keys_set(self):
+        """Test --upsert-on routes batches through batch_upsert."""
+        from airlift.airtable_upload import Upload
+
+        mock_client = MagicMock()
+        mock_client.batch_upsert.return_value = []
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = ["Name"]
+        mock_args.workers = 1
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+
+        rows = [{"fields": {"Name": f"Test{i}"}} for i in range(12)]
+        upload = Upload(
+            client=mock_client,
+            new_data=rows,
+            dbx=None,
+            args=mock_args
+        )
+        upload.upload_data()
+
+        assert mock_client.batch_upsert.call_count == 2
+        assert mock_client.batch_upsert.call_args.args[1] == ["Name"]
+        mock_client.batch_upload.assert_not_called()
+
+    def test_attachment_manifest_checked_before_upload(self):
+        """Test a cached link is used without calling upload_to_dropbox."""
+        from airlift.airtable_upload import Upload
+
+        mock_dbx = MagicMock()
+        mock_dbx.cached_download_url.return_value = "https://cached"
+        mock_args = MagicMock()
+        mock_args.csv_file = ASSETS_JSON.resolve()
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = None
+        mock_args.workers = 1
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+
+        upload = Upload(client=MagicMock(), new_data=[], dbx=mock_dbx, args=mock_args)
+        data = {"fields": {"Image Filename": ASSETS_IMAGE}}
+        upload._upload_attachment_for_field(data, "Attachments", ASSETS_IMAGE)
+
+        assert data["fields"]["Attachments"][0]["url"] == "https://cached"
+        mock_dbx.upload_to_dropbox.assert_not_called()
+
+    def test_attachment_uploaded_once_per_path(self):
+        """Test concurrent references to one file share a single upload."""
+        import threading
+        from airlift.airtable_upload import Upload
+
+        release = threading.Event()
+        mock_dbx = MagicMock()
+        mock_dbx.cached_download_url.return_value = None
+        mock_dbx.upload_to_dropbox.side_effect = lambda path: release.wait(5) and "https://link"
+        mock_args = MagicMock()
+        mock_args.csv_file = ASSETS_JSON.resolve()
         mock_args.attachment_columns = None
         mock_args.attachment_columns_map = None
         mock_args.columns_copy = None
         mock_args.rename_key_column = None
-        mock_args.workers = 10
+        mock_args.upsert_on = None
+        mock_args.workers = 4
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
         mock_args.log = None
-        
-        upload = Upload(
-            client=mock_client,
-            new_data=[],
-            dbx=None,
-            args=mock_args
-        )
-        
-        assert upload.workers == 10
 
-    def test_upload_has_stop_event(self):
-        """Test Upload has stop_event for worker coordination (regression for CriticalError stop)."""
+        upload = Upload(client=MagicMock(), new_data=[], dbx=mock_dbx, args=mock_args)
+        rows = [{"fields": {}} for _ in range(4)]
+        threads = [
+            threading.Thread(
+                target=upload._upload_attachment_for_field,
+                args=(row, "Attachments", f" {ASSETS_IMAGE}"),
+            )
+            for row in rows
+        ]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert mock_dbx.upload_to_dropbox.call_count == 1
+        assert all(row["fields"]["Attachments"][0]["url"] == "https://link" for row in rows)
+
+    def test_failed_attachment_upload_is_retried(self):
+        """Test a failed upload is not remembered for later rows."""
         from airlift.airtable_upload import Upload
-        import threading
 
-        mock_client = MagicMock()
+        mock_dbx = MagicMock()
+        mock_dbx.cached_download_url.return_value = None
+        mock_dbx.upload_to_dropbox.side_effect = [OSError("network"), "https://link"]
         mock_args = MagicMock()
-        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.csv_file = ASSETS_JSON.resolve()
         mock_args.attachment_columns = None
         mock_args.attachment_columns_map = None
         mock_args.columns_copy = None
         mock_args.rename_key_column = None
-        mock_args.workers = 5
+        mock_args.upsert_on = None
+        mock_args.workers = 1
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
         mock_args.log = None
 
-        upload = Upload(
-            client=mock_client,
-            new_data=[],
-            dbx=None,
-            args=mock_args
+        upload = Upload(client=MagicMock(), new_data=[], dbx=mock_dbx, args=mock_args)
+        with pytest.raises(OSError):
+            upload._upload_attachment_for_field({"fields": {}}, "Attachments", ASSETS_IMAGE)
+        data = {"fields": {}}
+        upload._upload_attachment_for_field(data, "Attachments", ASSETS_IMAGE)
+
+        assert data["fields"]["Attachments"][0]["url"] == "https://link"
+        assert mock_dbx.upload_to_dropbox.call_count == 2
+
+    @patch('airlift.airtable_client.Api')
+    def test_each_thread_gets_own_airtable_session(self, mock_api):
+        """Test upload threads write through separate Api sessions without a lock."""
+        import threading
+        from airlift.airtable_client import new_client
+
+        client = new_client(
+            token="pat_test_token",
+            base="appTestBase",
+            table="tblTestTable"
         )
-        assert hasattr(upload, "stop_event")
-        assert isinstance(upload.stop_event, threading.Event)
-        assert upload.stop_event.is_set() is False
+        tables = []
+        threads = [
+            threading.Thread(target=lambda: tables.append(client._thread_table()))
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # One Api for the client itself plus one per worker thread
+        assert mock_api.call_count == 4
+        assert not hasattr(client, "_upload_lock")
+        assert client._thread_table() is client._thread_table()
 
 
 # ============================================================================
@@ -793,6 +1664,364 @@ class TestDropboxClient:
         assert "dl.dropboxusercontent.com" in direct
         client.dbx.sharing_list_shared_links.assert_not_called()
 
+    @staticmethod
+    def _upload_client():
+        """dropbox_client with a mocked Dropbox whose clones commit in batches."""
+        import threading
+        from airlift.dropbox_client import _CommitBatcher, dropbox_client
+
+        client = dropbox_client.__new__(dropbox_client)
+        client._local = threading.local()
+        client._retry_lock = threading.Lock()
+        client.retry_count = 0
+        client._use_temporary_links = True
+        client._temporary_link_scope_logged = False
+        client.sub_folder = "/Airlift/Airlift 2026-01-01 00-00-00"
+        client._commit_batcher = _CommitBatcher(client._finish_batch)
+        client.attachment_cache = None
+        client._uploaded = {}
+        client._uploaded_lock = threading.Lock()
+        client._run_paths = {}
+        client._linked_folders = set()
+        client.main_folder = "/Airlift"
+        client.dbx = MagicMock()
+        clones = []
+
+        def clone(**kwargs):
+            dbx = MagicMock()
+            dbx.files_upload_session_start.return_value = MagicMock(session_id=f"s{len(clones)}")
+            dbx.files_upload_session_finish_batch_v2.side_effect = lambda entries: MagicMock(
+                entries=[MagicMock(**{"is_success.return_value": True}) for _ in entries]
+            )
+            dbx.files_get_temporary_link.return_value = MagicMock(link="https://link")
+            clones.append(dbx)
+            return dbx
+
+        client.dbx.clone.side_effect = clone
+        return client, clones
+
+    def test_upload_to_dropbox_runs_threads_concurrently(self):
+        """Test each upload thread uses its own Dropbox clone without a global lock."""
+        import threading
+
+        client, clones = self._upload_client()
+        both_uploading = threading.Barrier(2, timeout=5)
+        make_clone = client.dbx.clone.side_effect
+
+        def start(*args, **kwargs):
+            both_uploading.wait()
+            return MagicMock(session_id="s")
+
+        def clone(**kwargs):
+            dbx = make_clone(**kwargs)
+            dbx.files_upload_session_start.side_effect = start
+            return dbx
+
+        client.dbx.clone.side_effect = clone
+        urls = []
+        threads = [
+            threading.Thread(
+                target=lambda: urls.append(client.upload_to_dropbox(str(ASSETS_LOCAL_IMAGE)))
+            )
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert urls == ["https://link", "https://link"]
+        assert len(clones) == 2
+        assert not hasattr(client, "_api_lock")
+        client.dbx.files_upload.assert_not_called()
+
+    def test_upload_to_dropbox_commits_in_batches(self):
+        """Test concurrent uploads share finish_batch_v2 commits."""
+        import threading
+
+        client, clones = self._upload_client()
+        first_commit_started = threading.Event()
+        release_first_commit = threading.Event()
+        batch_sizes = []
+
+        def finish_batch(entries):
+            batch_sizes.append(len(entries))
+            if len(batch_sizes) == 1:
+                first_commit_started.set()
+                release_first_commit.wait(5)
+            return MagicMock(
+                entries=[MagicMock(**{"is_success.return_value": True}) for _ in entries]
+            )
+
+        urls = []
+
+        def upload():
+            clone = client._thread_dbx()
+            clone.files_upload_session_finish_batch_v2.side_effect = finish_batch
+            urls.append(client.upload_to_dropbox(str(ASSETS_LOCAL_IMAGE)))
+
+        leader = threading.Thread(target=upload)
+        leader.start()
+        assert first_commit_started.wait(5)
+        followers = [threading.Thread(target=upload) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        while len(client._commit_batcher._pending) < 4:
+            threading.Event().wait(0.01)
+        release_first_commit.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        assert batch_sizes == [1, 4]
+        assert urls == ["https://link"] * 5
+        for clone in clones:
+            assert clone.files_upload_session_start.call_args.kwargs == {"close": True}
+            clone.files_upload.assert_not_called()
+
+    def test_upload_to_dropbox_large_file_uses_session(self, tmp_path):
+        """Test large files are streamed in chunks and resume at the session offset."""
+        import dropbox
+
+        client, clones = self._upload_client()
+        dbx = client._thread_dbx()
+        offset_error = dropbox.exceptions.ApiError(
+            "req",
+            dropbox.files.UploadSessionAppendError.incorrect_offset(
+                dropbox.files.UploadSessionOffsetError(correct_offset=20)
+            ),
+            None,
+            None,
+        )
+        appended = []
+
+        def append(chunk, cursor, close):
+            appended.append((cursor.offset, bytes(chunk), close))
+            if len(appended) == 1:
+                # The first chunk landed but its response was lost
+                raise offset_error
+
+        dbx.files_upload_session_append_v2.side_effect = append
+        video = tmp_path / "clips" / "proxy.mov"
+        video.parent.mkdir()
+        video.write_bytes(bytes(range(25)))
+
+        with patch("airlift.dropbox_client.DROPBOX_SESSION_THRESHOLD", 16), \
+                patch("airlift.dropbox_client.DROPBOX_CHUNK_SIZE", 10):
+            url = client.upload_to_dropbox(str(video))
+
+        assert url == "https://link"
+        assert dbx.files_upload_session_start.call_args.args[0] == bytes(range(10))
+        assert appended == [
+            (10, bytes(range(10, 20)), False),
+            (20, bytes(range(20, 25)), True),
+        ]
+        (entry,) = dbx.files_upload_session_finish_batch_v2.call_args.args[0]
+        assert entry.cursor.offset == 25
+        assert entry.commit.path == f"{client.sub_folder}/clips/proxy.mov"
+
+    def test_dropbox_content_hash(self, tmp_path):
+        """Test the content hash is SHA-256 over per-block SHA-256 digests."""
+        import hashlib
+        from airlift.dropbox_client import dropbox_content_hash
+
+        path = tmp_path / "still.png"
+        path.write_bytes(b"abcdefghij")
+        with patch("airlift.dropbox_client.DROPBOX_HASH_BLOCK_SIZE", 4):
+            content_hash = dropbox_content_hash(str(path))
+
+        blocks = [b"abcd", b"efgh", b"ij"]
+        expected = hashlib.sha256(
+            b"".join(hashlib.sha256(block).digest() for block in blocks)
+        ).hexdigest()
+        assert content_hash == expected
+
+    def test_identical_attachments_upload_once(self, tmp_path):
+        """Test files with the same content share one upload in a run."""
+        client, clones = self._upload_client()
+        first = tmp_path / "a" / "marker.png"
+        second = tmp_path / "b" / "copy.png"
+        for path in (first, second):
+            path.parent.mkdir()
+            path.write_bytes(b"same pixels")
+
+        urls = [client.upload_to_dropbox(str(path)) for path in (first, second)]
+
+        assert urls == ["https://link", "https://link"]
+        assert clones[0].files_upload_session_start.call_count == 1
+
+    def test_attachment_cache_reused_across_runs(self, tmp_path):
+        """Test a file uploaded by an earlier run is linked instead of uploaded."""
+        from airlift.attachment_cache import AttachmentCache
+        from airlift.dropbox_client import dropbox_content_hash
+
+        image = tmp_path / "marker.png"
+        image.write_bytes(b"pixels")
+        content_hash = dropbox_content_hash(str(image))
+        cache = AttachmentCache(tmp_path / "attachments.sqlite")
+        cache.remember(content_hash, "/Airlift/old run/marker.png")
+
+        client, clones = self._upload_client()
+        client.attachment_cache = cache
+        dbx = client._thread_dbx()
+        dbx.files_get_temporary_link.return_value = MagicMock(
+            link="https://old-link", metadata=MagicMock(content_hash=content_hash)
+        )
+        assert client.upload_to_dropbox(str(image)) == "https://old-link"
+        dbx.files_upload_session_start.assert_not_called()
+
+        # The cached file changed in Dropbox: upload again and remember the new path
+        client._uploaded.clear()
+        dbx.files_get_temporary_link.return_value = MagicMock(
+            link="https://link", metadata=MagicMock(content_hash="other")
+        )
+        assert client.upload_to_dropbox(str(image)) == "https://link"
+        dbx.files_upload_session_start.assert_called_once()
+        relative = client._dropbox_relative_path(str(image))
+        assert cache.lookup(content_hash).dropbox_path == f"{client.sub_folder}/{relative}"
+        cache.close()
+
+    def test_manifest_skips_unchanged_files(self, tmp_path):
+        """Test an unchanged file with a live link costs no hashing or Dropbox call."""
+        import os
+        from airlift.attachment_cache import AttachmentCache
+
+        image = tmp_path / "marker.png"
+        image.write_bytes(b"pixels")
+        cache = AttachmentCache(tmp_path / "attachments.sqlite")
+        client, clones = self._upload_client()
+        client.attachment_cache = cache
+        assert client.cached_download_url(str(image)) is None
+        url = client.upload_to_dropbox(str(image))
+
+        # A later run: new client, same cache
+        client, clones = self._upload_client()
+        client.attachment_cache = cache
+        with patch("airlift.dropbox_client.dropbox_content_hash") as content_hash:
+            assert client.cached_download_url(str(image)) == url
+        content_hash.assert_not_called()
+        assert clones == []
+
+        # Touching the file invalidates its manifest entry
+        os.utime(image, ns=(0, 0))
+        with patch("airlift.dropbox_client.dropbox_content_hash", return_value="new") as content_hash:
+            assert client.cached_download_url(str(image)) is None
+        content_hash.assert_called_once()
+        cache.close()
+
+    def test_expired_temporary_link_is_refreshed(self, tmp_path):
+        """Test an expired temporary link is renewed with one files_get_temporary_link call."""
+        from airlift.attachment_cache import AttachmentCache, LINK_TEMPORARY
+        from airlift.dropbox_client import dropbox_content_hash
+
+        image = tmp_path / "marker.png"
+        image.write_bytes(b"pixels")
+        content_hash = dropbox_content_hash(str(image))
+        cache = AttachmentCache(tmp_path / "attachments.sqlite")
+        cache.remember(content_hash, "/Airlift/old/marker.png", "https://expired", LINK_TEMPORARY, 1.0)
+        client, clones = self._upload_client()
+        client.attachment_cache = cache
+
+        assert client.cached_download_url(str(image)) is None
+        dbx = client._thread_dbx()
+        dbx.files_get_temporary_link.return_value = MagicMock(
+            link="https://fresh", metadata=MagicMock(content_hash=content_hash)
+        )
+        assert client.upload_to_dropbox(str(image)) == "https://fresh"
+        dbx.files_upload_session_start.assert_not_called()
+        assert cache.lookup(content_hash).link == "https://fresh"
+        assert cache.valid_link(content_hash, time.time()) == "https://fresh"
+
+        cache.forget_folder("/airlift")
+        assert cache.lookup(content_hash) is None
+        cache.close()
+
+    def test_shared_link_checked_before_reuse(self, tmp_path):
+        """Test a cached shared link is only reused once Dropbox confirms the file."""
+        from airlift.attachment_cache import AttachmentCache, LINK_SHARED
+        from airlift.dropbox_client import dropbox_content_hash
+
+        image = tmp_path / "marker.png"
+        image.write_bytes(b"pixels")
+        content_hash = dropbox_content_hash(str(image))
+        cache = AttachmentCache(tmp_path / "attachments.sqlite")
+        cache.remember(content_hash, "/Airlift/old/marker.png", "https://shared", LINK_SHARED)
+        client, clones = self._upload_client()
+        client.attachment_cache = cache
+        client._use_temporary_links = False
+
+        assert client.cached_download_url(str(image)) is None
+        dbx = client._thread_dbx()
+        dbx.files_get_metadata.return_value = MagicMock(content_hash=content_hash)
+        assert client.upload_to_dropbox(str(image)) == "https://shared"
+        dbx.files_get_metadata.assert_called_once_with("/Airlift/old/marker.png")
+        dbx.files_upload_session_start.assert_not_called()
+
+        # The file at the shared link's path was replaced
+        client._uploaded.clear()
+        dbx.files_get_metadata.return_value = MagicMock(content_hash="other")
+        client._shared_link_url = MagicMock(return_value="https://new-shared")
+        client._download_link = MagicMock(return_value=("https://new-shared", LINK_SHARED, None))
+        assert client.upload_to_dropbox(str(image)) == "https://new-shared"
+        dbx.files_upload_session_start.assert_called_once()
+        cache.close()
+
+    def test_run_path_numbers_colliding_files(self):
+        """Test two local files with the same folder and name get separate paths."""
+        client, _clones = self._upload_client()
+        first = client.run_path(os.path.join("a", "shots", "marker.png"))
+        second = client.run_path(os.path.join("b", "shots", "marker.png"))
+
+        assert first == f"{client.sub_folder}/shots/marker.png"
+        assert second == f"{client.sub_folder}/shots/marker (2).png"
+        assert client.run_path(os.path.join("a", "shots", "marker.png")) == first
+
+    def test_attachment_cache_per_app_and_folder(self, tmp_path):
+        """Test each Dropbox app key and main folder gets its own cache file."""
+        from airlift.attachment_cache import AttachmentCache
+
+        log_file = tmp_path / "upload.log"
+        airlift = AttachmentCache.open_default("key/1", "/Airlift", log_file)
+        other_app = AttachmentCache.open_default("key2", "/Airlift", log_file)
+        marker = AttachmentCache.open_default("key/1", "/Marker Data", log_file)
+
+        assert airlift.path == tmp_path / "airlift-attachments-key_1-Airlift.sqlite"
+        assert marker.path == tmp_path / "airlift-attachments-key_1-Marker_Data.sqlite"
+        other_app.remember("hash", "/Airlift/run/marker.png")
+        airlift.forget_folder("/Airlift")
+        assert other_app.lookup("hash").dropbox_path == "/Airlift/run/marker.png"
+        for cache in (airlift, other_app, marker):
+            cache.close()
+
+    def test_commit_batch_failures_are_per_file(self):
+        """Test a failed entry in a batch only fails that upload."""
+        import dropbox
+
+        client, clones = self._upload_client()
+        dbx = client._thread_dbx()
+        failure = dropbox.files.UploadSessionFinishError.lookup_failed(
+            dropbox.files.UploadSessionLookupError.not_found
+        )
+        dbx.files_upload_session_finish_batch_v2.side_effect = None
+        dbx.files_upload_session_finish_batch_v2.return_value = MagicMock(
+            entries=[
+                MagicMock(**{"is_success.return_value": True}),
+                MagicMock(**{"is_success.return_value": False, "get_failure.return_value": failure}),
+            ]
+        )
+
+        entries = [
+            (
+                dropbox.files.UploadSessionCursor(session_id=f"s{i}", offset=1),
+                dropbox.files.CommitInfo(path=f"/Airlift/{i}.gif"),
+            )
+            for i in range(2)
+        ]
+        outcomes = client._finish_batch(entries)
+
+        assert not isinstance(outcomes[0], Exception)
+        assert isinstance(outcomes[1], dropbox.exceptions.ApiError)
+        assert outcomes[1].error is failure
+
     def test_attachment_local_path_joins_assets_directory(self):
         """Attachment path resolves next to tests/assets/airtable-upload-test.json."""
         from airlift.airtable_upload import Upload
@@ -803,7 +2032,11 @@ class TestDropboxClient:
         mock_args.attachment_columns_map = None
         mock_args.columns_copy = None
         mock_args.rename_key_column = None
+        mock_args.upsert_on = None
         mock_args.workers = 5
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
         mock_args.log = None
 
         upload = Upload(
@@ -869,6 +2102,152 @@ class TestDropboxClient:
             os.unlink(temp_path)
 
 
+    def test_empty_dropbox_folder_deletes_in_batches(self, tmp_path):
+        """Test folder contents are removed with files_delete_batch jobs."""
+        import dropbox
+        from airlift.dropbox_client import empty_dropbox_folder
+
+        token_file = tmp_path / "dropbox-token.json"
+        token_file.write_text(json.dumps({"app_key": "key", "refresh_token": "token"}))
+        entries = [MagicMock(path_display=f"/Airlift/Airlift run {i}") for i in range(25)]
+
+        with patch("airlift.dropbox_client.dropbox.Dropbox") as mock_dropbox, \
+                patch("airlift.dropbox_client.time.sleep") as sleep, \
+                patch("airlift.dropbox_client.DROPBOX_DELETE_BATCH_SIZE", 10):
+            dbx = mock_dropbox.return_value
+            dbx.files_list_folder.return_value = MagicMock(entries=entries, has_more=False)
+            dbx.files_delete_batch.side_effect = lambda args: MagicMock(
+                **{"is_complete.return_value": False, "get_async_job_id.return_value": str(len(args))}
+            )
+            busy = dropbox.files.DeleteBatchJobStatus.failed(
+                dropbox.files.DeleteBatchError.too_many_write_operations
+            )
+            checks = {"10": 0}
+
+            def check(job_id):
+                count = int(job_id)
+                if job_id == "10" and checks["10"] < 2:
+                    checks["10"] += 1
+                    if checks["10"] == 1:
+                        return MagicMock(**{"is_complete.return_value": False, "is_failed.return_value": False})
+                    return busy
+                failures = [
+                    MagicMock(**{"is_success.return_value": i != 0}) for i in range(count)
+                ]
+                return MagicMock(**{
+                    "is_complete.return_value": True,
+                    "get_complete.return_value": MagicMock(entries=failures),
+                })
+
+            dbx.files_delete_batch_check.side_effect = check
+            deleted = empty_dropbox_folder(str(token_file), md=False)
+
+        sizes = [len(c.args[0]) for c in dbx.files_delete_batch.call_args_list]
+        # The first job was started again after Dropbox reported it was busy
+        assert sizes == [10, 10, 10, 5]
+        assert deleted == 25 - 3
+        dbx.files_delete_v2.assert_not_called()
+        assert sleep.call_count == 2
+
+    @staticmethod
+    def _run_folder(name):
+        import dropbox
+        return dropbox.files.FolderMetadata(
+            name=name, id="id:1", path_lower=f"/airlift/{name.lower()}",
+            path_display=f"/Airlift/{name}",
+        )
+
+    def test_expired_run_folders_by_age_and_count(self):
+        """Test run folders past the retention limits are selected, newest kept."""
+        import dropbox
+        from datetime import datetime
+        from airlift.dropbox_client import _expired_run_folders
+
+        entries = [
+            self._run_folder("Airlift 2026-01-10 09-00-00"),
+            self._run_folder("Airlift 2026-01-01 09-00-00"),
+            self._run_folder("Airlift 2026-01-09 09-00-00"),
+            self._run_folder("Airlift 2025-12-01 09-00-00"),
+            self._run_folder("Keep me"),
+            dropbox.files.FileMetadata(
+                name="Airlift 2020-01-01 09-00-00", id="id:2",
+                client_modified=datetime(2020, 1, 1), server_modified=datetime(2020, 1, 1),
+                rev="0123456789", size=1, path_display="/Airlift/Airlift 2020-01-01 09-00-00",
+            ),
+        ]
+        now = datetime(2026, 1, 10, 12, 0, 0)
+
+        by_days = _expired_run_folders(entries, "/Airlift", 7, None, now=now)
+        assert by_days == [
+            "/Airlift/Airlift 2026-01-01 09-00-00",
+            "/Airlift/Airlift 2025-12-01 09-00-00",
+        ]
+        by_runs = _expired_run_folders(entries, "/Airlift", None, 1, now=now)
+        assert by_runs == [
+            "/Airlift/Airlift 2026-01-09 09-00-00",
+            "/Airlift/Airlift 2026-01-01 09-00-00",
+            "/Airlift/Airlift 2025-12-01 09-00-00",
+        ]
+        # Folders this run uploaded to or linked into survive past the limit
+        kept = _expired_run_folders(
+            entries, "/Airlift", None, 0,
+            keep=["/airlift/airlift 2026-01-10 09-00-00", "/Airlift/Airlift 2025-12-01 09-00-00"],
+            now=now,
+        )
+        assert kept == [
+            "/Airlift/Airlift 2026-01-09 09-00-00",
+            "/Airlift/Airlift 2026-01-01 09-00-00",
+        ]
+
+    def test_prune_run_folders_deletes_in_batch(self):
+        """Test expired run folders are listed page by page and deleted together."""
+        from airlift.dropbox_client import prune_run_folders
+
+        dbx = MagicMock()
+        dbx.files_list_folder.return_value = MagicMock(
+            entries=[self._run_folder("Airlift 2020-01-01 09-00-00")],
+            has_more=True, cursor="next",
+        )
+        dbx.files_list_folder_continue.return_value = MagicMock(
+            entries=[self._run_folder("Airlift 2020-01-02 09-00-00")], has_more=False,
+        )
+        with patch("airlift.dropbox_client.delete_paths", return_value=[]) as delete_paths:
+            deleted = prune_run_folders(dbx, "/Airlift", None, 1)
+
+        dbx.files_list_folder.assert_called_once_with("/Airlift")
+        delete_paths.assert_called_once_with(dbx, ["/Airlift/Airlift 2020-01-01 09-00-00"])
+        # Folders Dropbox failed to delete are not reported as removed
+        assert deleted == []
+
+        with pytest.raises(CriticalError):
+            prune_run_folders(dbx, "/Airlift", -1, None)
+
+
+    def test_apply_retention_keeps_linked_run_folders(self):
+        """Test run folders that links were handed out into this run are kept."""
+        import threading
+        from airlift.dropbox_client import dropbox_client
+
+        client = dropbox_client.__new__(dropbox_client)
+        client.dbx = MagicMock()
+        client.main_folder = "/Airlift"
+        client.sub_folder = "/Airlift/Airlift 2026-01-10 09-00-00"
+        client.attachment_cache = None
+        client._uploaded = {}
+        client._uploaded_lock = threading.Lock()
+        client._linked_folders = set()
+        client.finish_upload(
+            "hash", "/Airlift/Airlift 2026-01-01 09-00-00/shots/marker.png",
+            "https://link", "shared", None,
+        )
+        with patch("airlift.dropbox_client.prune_run_folders", return_value=[]) as prune:
+            client.apply_retention(None, 0)
+
+        assert prune.call_args.kwargs["keep"] == {
+            "/Airlift/Airlift 2026-01-10 09-00-00",
+            "/airlift/airlift 2026-01-01 09-00-00",
+        }
+
 # ============================================================================
 # 7. TestErrorHandling - Error Handling and Exceptions
 # ============================================================================
@@ -1231,6 +2610,901 @@ class TestCLIIntegration:
             cli([])
         # No NameError: getattr(args, "verbose", False) is used when args may be None
 
+    def test_cli_checks_upsert_on_before_touching_services(self, capsys):
+        """Test options that need --upsert-on fail before any client is created."""
+        from airlift.cli import cli
+
+        base = [
+            "--token", "pat_test_token", "--base", "appTestBase",
+            "--table", "tblTestTable", "--dropbox-token", "dropbox-token",
+        ]
+        with patch("airlift.cli.dropbox_client") as mock_dropbox, \
+                patch("airlift.cli.new_client") as mock_client:
+            for options in (
+                ["--delete-missing"],
+                ["--incremental"],
+                ["--upsert-on", "A", "B", "C", "D"],
+            ):
+                with pytest.raises(SystemExit) as exit_info:
+                    cli(*base, str(ASSETS_JSON), *options)
+                assert exit_info.value.code == 2
+            mock_dropbox.assert_not_called()
+            mock_client.assert_not_called()
+        errors = capsys.readouterr().out
+        assert "--delete-missing needs --upsert-on" in errors
+        assert "--incremental needs --upsert-on" in errors
+        assert "at most 3" in errors
+
+
+# ============================================================================
+# 12. TestRateLimiting - Airtable Request Pacing
+# ============================================================================
+class TestRateLimiting:
+    """Test the shared token-bucket limiter used for Airtable requests."""
+
+    def test_token_bucket_allows_burst_then_paces(self):
+        """Test burst tokens are immediate and later tokens follow the rate."""
+        import time
+        from airlift.rate_limiter import TokenBucket
+
+        bucket = TokenBucket(rate=50, burst=3)
+        start = time.monotonic()
+        for _ in range(3):
+            bucket.acquire()
+        assert time.monotonic() - start < 0.05
+
+        for _ in range(5):
+            bucket.acquire()
+        # Five more tokens at 50/s need roughly 0.1s
+        assert time.monotonic() - start >= 0.08
+
+    def test_token_bucket_rejects_invalid_settings(self):
+        """Test non-positive rate or burst raises CriticalError."""
+        from airlift.rate_limiter import TokenBucket
+
+        with pytest.raises(CriticalError, match="rate-limit"):
+            TokenBucket(rate=0, burst=1)
+        with pytest.raises(CriticalError, match="rate-burst"):
+            TokenBucket(rate=5, burst=0)
+
+    def test_rate_limiter_shared_per_base(self):
+        """Test clients of the same base share one limiter."""
+        from airlift.rate_limiter import get_rate_limiter
+
+        first = get_rate_limiter("appSharedBase", 5, 1)
+        assert get_rate_limiter("appSharedBase", 10, 10) is first
+        assert get_rate_limiter("appOtherBase", 5, 1) is not first
+
+    @patch('airlift.airtable_client.Api')
+    def test_client_sessions_use_rate_limiter(self, mock_api):
+        """Test Airtable sessions of a client go through its base limiter."""
+        from airlift.airtable_client import new_client
+        from airlift.rate_limiter import RateLimitedSession
+
+        client = new_client(
+            token="pat_test_token",
+            base="appLimitedBase",
+            table="tblTestTable"
+        )
+        assert isinstance(client.api_client.session, RateLimitedSession)
+        assert client.api_client.session.limiter is client.limiter
+
+    def test_session_honors_retry_after(self):
+        """Test a 429 pauses the limiter for Retry-After and retries."""
+        import requests
+        from airlift.rate_limiter import RateLimitedSession, TokenBucket
+
+        throttled = MagicMock(status_code=429, headers={"Retry-After": "0"})
+        ok = MagicMock(status_code=200, headers={})
+        bucket = TokenBucket(rate=100, burst=5)
+        session = RateLimitedSession(bucket)
+
+        with patch.object(
+            requests.Session, "request", side_effect=[throttled, ok]
+        ) as mock_request:
+            response = session.request("GET", "https://api.airtable.com/v0/x")
+
+        assert response is ok
+        assert mock_request.call_count == 2
+        assert bucket.throttle_count == 1
+
+    def test_session_retries_dropped_connections(self):
+        """Test transport errors are still retried while 429s go to the bucket."""
+        from airlift.rate_limiter import RateLimitedSession, TokenBucket
+
+        session = RateLimitedSession(TokenBucket(rate=100, burst=5))
+        retry = session.get_adapter("https://api.airtable.com/v0/x").max_retries
+
+        assert retry.total == 5
+        assert retry.allowed_methods is None  # POST/PATCH writes included
+        assert not retry.status_forcelist
+
+    def test_retry_after_parsing(self):
+        """Test Retry-After accepts seconds and ignores missing headers."""
+        from airlift.rate_limiter import retry_after_seconds
+
+        assert retry_after_seconds(MagicMock(headers={"Retry-After": "12"})) == 12.0
+        assert retry_after_seconds(MagicMock(headers={})) is None
+
+    def test_adaptive_concurrency_grows_when_healthy(self):
+        """Test the limit grows by one after a window of healthy requests."""
+        from airlift.rate_limiter import AdaptiveConcurrency
+
+        controller = AdaptiveConcurrency(maximum=4, initial=1)
+        for _ in range(3):
+            with controller.slot():
+                pass
+        assert controller.limit == 3
+
+        for _ in range(20):
+            with controller.slot():
+                pass
+        assert controller.limit == 4  # never above maximum
+
+    def test_adaptive_concurrency_halves_on_429(self):
+        """Test a throttling error cuts the limit in half."""
+        import requests
+        from airlift.rate_limiter import AdaptiveConcurrency
+
+        controller = AdaptiveConcurrency(maximum=16, initial=8)
+        response = MagicMock(status_code=429)
+        with pytest.raises(requests.exceptions.HTTPError):
+            with controller.slot():
+                raise requests.exceptions.HTTPError("429", response=response)
+        assert controller.limit == 4
+
+        with pytest.raises(ValueError):
+            with controller.slot():
+                raise ValueError("not a congestion error")
+        assert controller.limit == 4
+
+    def test_adaptive_concurrency_reacts_to_throttle_signal(self):
+        """Test 429s retried inside the session still reduce the limit."""
+        from airlift.rate_limiter import AdaptiveConcurrency
+
+        throttles = {"count": 0}
+        controller = AdaptiveConcurrency(
+            maximum=8, initial=8, throttle_count=lambda: throttles["count"]
+        )
+        with controller.slot():
+            throttles["count"] += 1
+        assert controller.limit == 4
+
+    def test_congestion_error_follows_cause(self):
+        """Test wrapped 5xx errors are recognised as congestion."""
+        from airlift.rate_limiter import is_congestion_error
+
+        response = MagicMock(status_code=503)
+        cause = Exception("server")
+        cause.response = response
+        wrapped = AirtableError("Unable to upload data!")
+        wrapped.__cause__ = cause
+        assert is_congestion_error(wrapped) is True
+        assert is_congestion_error(AirtableError("other")) is False
+
+    def test_upload_adaptive_concurrency_ceiling(self):
+        """Test --adaptive-concurrency makes --workers the controller ceiling."""
+        from airlift.airtable_upload import Upload, ADAPTIVE_MAX_WORKERS
+
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = None
+        mock_args.workers = None
+        mock_args.adaptive_concurrency = True
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+
+        upload = Upload(client=MagicMock(), new_data=[], dbx=None, args=mock_args)
+        assert upload.workers == ADAPTIVE_MAX_WORKERS
+        assert upload.dropbox_concurrency is not upload.airtable_concurrency
+        for controller in (upload.dropbox_concurrency, upload.airtable_concurrency):
+            assert controller.maximum == ADAPTIVE_MAX_WORKERS
+            assert controller.limit < ADAPTIVE_MAX_WORKERS
+
+    def test_adaptive_concurrency_ignores_token_wait(self):
+        """Test time spent waiting on the token bucket is not counted as latency."""
+        from airlift.rate_limiter import AdaptiveConcurrency, TokenBucket
+
+        bucket = TokenBucket(rate=20, burst=1)
+        controller = AdaptiveConcurrency(maximum=4, initial=1, wait_time=bucket.waited)
+        with controller.slot():
+            bucket.acquire()
+        with controller.slot():
+            bucket.acquire()  # waits ~50ms for a token
+
+        assert bucket.waited() > 0
+        assert controller._baseline < 0.02
+        assert controller.limit == 2
+
+    def test_rate_limit_arguments(self):
+        """Test --rate-limit and --rate-burst parsing."""
+        args = parse_args([
+            "--token", "pat_test_token_12345",
+            "--base", "appTestBaseId123",
+            "--table", "tblTestTableId456",
+            "--rate-limit", "4.5",
+            "--rate-burst", "3",
+            "data.csv"
+        ])
+
+        assert args.rate_limit == 4.5
+        assert args.rate_burst == 3
+
+
+# ============================================================================
+# 13. TestIncrementalSync - Diff-Based Uploads
+# ============================================================================
+class TestIncrementalSync:
+    """Test the remote index and change planning for --incremental."""
+
+    def _args(self, **overrides):
+        args = MagicMock()
+        args.attachment_columns = None
+        args.attachment_columns_map = [["Image Filename", "Attachments"]]
+        args.rename_key_column = None
+        args.upsert_on = ["ID"]
+        for key, value in overrides.items():
+            setattr(args, key, value)
+        return args
+
+    def test_content_hash_matches_typed_airtable_values(self):
+        """Test CSV strings hash like the typed values Airtable returns."""
+        from airlift.incremental_sync import content_hash
+
+        compare = ["Count", "Done", "Notes", "Tags"]
+        local = {"Count": "3", "Done": "", "Notes": " hi ", "Tags": "a, b"}
+        remote = {"Count": 3.0, "Notes": "hi", "Tags": ["a", "b"]}
+        assert content_hash(local, compare) == content_hash(remote, compare)
+        assert content_hash(local, compare) != content_hash(
+            {**remote, "Notes": "changed"}, compare
+        )
+
+    def test_compare_fields_skip_attachment_targets(self):
+        """Test attachment targets never count as changes."""
+        from airlift.incremental_sync import compare_fields_for
+
+        header = ["ID", "Image Filename", "Attachments"]
+        assert compare_fields_for(header, self._args()) == ["ID", "Image Filename"]
+
+    def test_plan_changes_sends_only_new_and_changed_rows(self):
+        """Test unchanged rows are skipped and changed rows become updates."""
+        from airlift.incremental_sync import content_hash, plan_changes
+
+        compare = ["ID", "Name"]
+        index = {
+            ("1",): ("rec1", content_hash({"ID": "1", "Name": "Lion"}, compare)),
+            ("2",): ("rec2", content_hash({"ID": "2", "Name": "Tiger"}, compare)),
+        }
+        rows = [
+            {"fields": {"ID": "1", "Name": "Lion"}},
+            {"fields": {"ID": "2", "Name": "Leopard"}},
+            {"fields": {"ID": "3", "Name": "Puma"}},
+            {"fields": {"ID": "3", "Name": "Puma again"}},
+            {"fields": {"ID": " ", "Name": "Nameless"}},
+        ]
+        changes, counts = plan_changes(rows, index, ["ID"], compare)
+
+        assert counts == {"new": 1, "changed": 1, "unchanged": 1, "skipped": 2}
+        assert [row["fields"]["ID"] for row in changes] == ["2", "3"]
+        assert changes[0]["id"] == "rec2"
+        assert "id" not in changes[1]
+
+    def test_incremental_rows_reads_table_once(self):
+        """Test the remote index is built from one paged scan of needed fields."""
+        from airlift.incremental_sync import incremental_rows
+
+        client = MagicMock()
+        client.table.iterate.return_value = iter([
+            [{"id": "rec1", "fields": {"ID": "1", "Name": "Lion"}}],
+            [{"id": "rec2", "fields": {"ID": "2", "Name": "Tiger"}}],
+        ])
+        rows = [
+            {"fields": {"ID": "1", "Name": "Lion"}},
+            {"fields": {"ID": "2", "Name": "Cheetah"}},
+        ]
+        changes = list(
+            incremental_rows(client, rows, self._args(attachment_columns_map=None))
+        )
+
+        client.table.iterate.assert_called_once_with(fields=["ID", "Name"])
+        assert len(changes) == 1
+        assert changes[0]["id"] == "rec2"
+        assert changes[0]["fields"] == {"ID": "2", "Name": "Cheetah"}
+
+    def test_incremental_requires_merge_keys(self):
+        """Test --incremental without --upsert-on fails early."""
+        from airlift.incremental_sync import incremental_rows
+
+        with pytest.raises(CriticalError, match="upsert-on"):
+            incremental_rows(MagicMock(), [], self._args(upsert_on=None))
+
+    def test_sync_state_round_trip(self, tmp_path):
+        """Test the SQLite state stores written rows and their column signature."""
+        from airlift.sync_state import SyncState
+
+        state = SyncState(tmp_path / "state.sqlite")
+        state.reset(["ID"], ["ID", "Name"], {("1",): ("rec1", "h1")})
+        state.record_rows([
+            {"id": "rec2", "sync": (("2",), "h2"), "fields": {}},
+            {"fields": {}},  # rows without id/sync are ignored
+        ])
+        state.close()
+
+        state = SyncState(tmp_path / "state.sqlite")
+        assert state.matches(["ID"], ["Name", "ID"]) is True
+        assert state.matches(["ID"], ["ID"]) is False
+        assert state.load_index() == {("1",): ("rec1", "h1"), ("2",): ("rec2", "h2")}
+        state.close()
+
+    def test_sync_state_lives_next_to_log(self, tmp_path):
+        """Test the state file is placed beside --log when given."""
+        from airlift.sync_state import SyncState
+
+        state = SyncState.for_table("appBase", "tbl/Table", tmp_path / "upload.log")
+        assert state.path == tmp_path / "airlift-sync-appBase-tbl_Table.sqlite"
+        state.close()
+
+    def test_incremental_rows_uses_state_without_table_scan(self, tmp_path):
+        """Test a matching sync state replaces the remote table scan."""
+        from airlift.incremental_sync import content_hash, incremental_rows
+        from airlift.sync_state import SyncState
+
+        state = SyncState(tmp_path / "state.sqlite")
+        compare = ["ID", "Name"]
+        state.reset(["ID"], compare, {
+            ("1",): ("rec1", content_hash({"ID": "1", "Name": "Lion"}, compare)),
+        })
+        client = MagicMock()
+        rows = [
+            {"fields": {"ID": "1", "Name": "Lion"}},
+            {"fields": {"ID": "2", "Name": "Tiger"}},
+        ]
+        args = self._args(attachment_columns_map=None, verify_state=False)
+        changes = list(incremental_rows(client, rows, args, state))
+
+        client.table.iterate.assert_not_called()
+        assert [row["fields"]["ID"] for row in changes] == ["2"]
+        state.close()
+
+    def test_verify_state_rereads_modified_records(self, caplog):
+        """Test --verify-state rereads only the records modified since the last sync."""
+        import logging
+        from datetime import datetime, timezone
+        from airlift.incremental_sync import content_hash, verify_index
+
+        compare = ["ID", "Name"]
+        lion = content_hash({"ID": "1", "Name": "Lion"}, compare)
+        client = MagicMock()
+        client.table.iterate.return_value = iter([
+            [
+                {"id": "rec1", "fields": {"ID": "1", "Name": "Lion"}},
+                {"id": "rec2", "fields": {"ID": "2", "Name": "Tiger"}},
+                {"id": "recNew", "fields": {"ID": "3", "Name": "Puma"}},
+            ],
+        ])
+        index = {
+            ("1",): ("rec1", lion),
+            ("2",): ("rec2", "h2"),
+            ("4",): ("rec4", "h4"),
+        }
+        synced_at = datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        with caplog.at_level(logging.WARNING, logger="airlift.incremental_sync"):
+            verified = verify_index(client, index, ["ID"], compare, synced_at)
+
+        client.table.iterate.assert_called_once_with(
+            fields=["ID", "Name"],
+            formula="IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('2026-01-02T03:03:05.000Z'))",
+        )
+        client.iter_record_ids.assert_not_called()
+        assert verified == {
+            ("1",): ("rec1", lion),
+            ("2",): ("rec2", content_hash({"ID": "2", "Name": "Tiger"}, compare)),
+            ("3",): ("recNew", content_hash({"ID": "3", "Name": "Puma"}, compare)),
+            ("4",): ("rec4", "h4"),
+        }
+        # rec1 is Airlift's own write and still matches its cached hash
+        assert "2 records modified" in caplog.text
+
+    def test_verify_state_without_sync_time_rebuilds_index(self):
+        """Test a state without a sync time is rebuilt from the whole table."""
+        from airlift.incremental_sync import verify_index
+
+        client = MagicMock()
+        client.table.iterate.return_value = iter([
+            [{"id": "rec1", "fields": {"ID": "1"}}],
+        ])
+        verified = verify_index(client, {("2",): ("rec2", "h2")}, ["ID"], ["ID"], None)
+
+        client.table.iterate.assert_called_once_with(fields=["ID"])
+        assert list(verified) == [("1",)]
+
+    def test_sync_state_remembers_sync_time(self, tmp_path):
+        """Test the time the index was read is stored with the state."""
+        from datetime import datetime, timezone
+        from airlift.sync_state import SyncState
+
+        state = SyncState(tmp_path / "state.sqlite")
+        assert state.synced_at() is None
+        synced_at = datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        state.reset(["ID"], ["ID"], {("1",): ("rec1", "h1")}, synced_at)
+        assert state.synced_at() == synced_at
+
+        later = datetime(2026, 1, 3, tzinfo=timezone.utc)
+        state.mark_synced(later)
+        assert state.synced_at() == later
+        assert state.load_index() == {("1",): ("rec1", "h1")}
+        state.close()
+
+    def test_upload_records_written_rows_in_state(self):
+        """Test successful batches are written to the sync state."""
+        from airlift.airtable_upload import Upload
+
+        mock_client = MagicMock()
+        bad = {"fields": {"ID": "2"}, "sync": (("2",), "h2")}
+        mock_client.batch_upsert.return_value = [(bad, ValueError("bad"))]
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = ["ID"]
+        mock_args.workers = 1
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+
+        good = {"fields": {"ID": "1"}, "sync": (("1",), "h1")}
+        state = MagicMock()
+        Upload(
+            client=mock_client, new_data=[good, bad], dbx=None,
+            args=mock_args, sync_state=state,
+        ).upload_data()
+
+        assert list(state.record_rows.call_args.args[0]) == [good]
+
+    def test_upload_sends_changed_rows_as_updates(self):
+        """Test rows carrying a record id are written with batch_update."""
+        from airlift.airtable_upload import Upload
+
+        mock_client = MagicMock()
+        mock_client.batch_update.return_value = []
+        mock_client.batch_upsert.return_value = []
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = ["ID"]
+        mock_args.workers = 1
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+
+        rows = [
+            {"id": "rec1", "fields": {"ID": "1"}},
+            {"fields": {"ID": "2"}},
+        ]
+        Upload(client=mock_client, new_data=rows, dbx=None, args=mock_args).upload_data()
+
+        mock_client.batch_update.assert_called_once_with([rows[0]])
+        mock_client.batch_upsert.assert_called_once_with([rows[1]], ["ID"])
+
+    def test_upload_recreates_rows_whose_record_was_deleted(self, tmp_path):
+        """Test an update refused for a deleted record is sent again as a create."""
+        from airlift.airtable_upload import Upload
+        from airlift.sync_state import SyncState
+
+        deleted = MagicMock()
+        deleted.response.status_code = 422
+        deleted.response.text = '{"error": {"type": "ROW_DOES_NOT_EXIST"}}'
+        rows = [
+            {"id": "recGone", "fields": {"ID": "1"}, "sync": (("1",), "h1")},
+            {"fields": {"ID": "2"}, "sync": (("2",), "h2")},
+        ]
+        mock_client = MagicMock()
+        mock_client.batch_update.return_value = [(rows[0], deleted)]
+
+        def upsert(records, key_fields):
+            for data in records:
+                data["id"] = "recNew" + data["fields"]["ID"]
+            return []
+
+        mock_client.batch_upsert.side_effect = upsert
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = ["ID"]
+        mock_args.workers = 1
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+
+        state = SyncState(tmp_path / "state.sqlite")
+        state.reset(["ID"], ["ID"], {("1",): ("recGone", "h0")})
+        Upload(
+            client=mock_client, new_data=rows, dbx=None,
+            args=mock_args, sync_state=state,
+        ).upload_data()
+
+        assert mock_client.batch_upsert.call_args.args[0] == [rows[1], rows[0]]
+        assert state.load_index() == {
+            ("1",): ("recNew1", "h1"),
+            ("2",): ("recNew2", "h2"),
+        }
+        state.close()
+
+    def test_delete_missing_records_matches_rows_by_record_id(self, tmp_path):
+        """Test --delete-missing keeps the records rows were written to or matched with."""
+        from airlift.incremental_sync import FileKeys, delete_missing_records
+        from airlift.sync_state import SyncState
+
+        file_keys = FileKeys(["ID"])
+        rows = [
+            {"fields": {"ID": "007"}},
+            {"fields": {"ID": "1.50"}},
+            {"fields": {"ID": "9"}},
+            {"fields": {"Name": "no key"}},
+        ]
+        assert list(file_keys.track(rows)) == rows
+        # "007" was written to a record Airtable stores as the number 7
+        rows[0]["id"] = "rec7"
+        rows[3]["id"] = "recNew"
+        file_keys.record_rows([rows[0], rows[2], rows[3]])
+        # --incremental skipped "1.50" as unchanged; "9" was refused by Airtable
+        file_keys.keep_record(("1.50",), "rec1")
+        assert file_keys.unmatched_keys == {("9",)}
+
+        client = MagicMock()
+        client.table.iterate.return_value = iter([
+            [
+                {"id": "rec7", "fields": {"ID": 7}},
+                {"id": "rec1", "fields": {"ID": 1.5}},
+                {"id": "rec3", "fields": {"ID": "3"}},
+                {"id": "recEmpty", "fields": {}},
+            ],
+            [
+                {"id": "rec9", "fields": {"ID": "9"}},
+                {"id": "recNew", "fields": {}},
+                {"id": "rec4", "fields": {"ID": "4"}},
+            ],
+        ])
+        scanned = []
+        client.delete_record_pages.side_effect = lambda scan, workers: (
+            scanned.extend(scan()) or sum(len(page) for page in scanned)
+        )
+        state = SyncState(tmp_path / "state.sqlite")
+        state.reset(["ID"], ["ID"], {
+            ("1.5",): ("rec1", "h1"), ("3",): ("rec3", "h3"), ("9",): ("rec9", "h9"),
+        })
+
+        assert delete_missing_records(client, file_keys, workers=2, state=state) == 2
+        client.table.iterate.assert_called_once_with(fields=["ID"])
+        assert scanned == [["rec3"], ["rec4"]]
+        assert state.load_index() == {("1.5",): ("rec1", "h1"), ("9",): ("rec9", "h9")}
+        state.close()
+
+    def test_written_and_unchanged_rows_are_matched_to_records(self):
+        """Test the upload and --incremental hand record ids to --delete-missing."""
+        from airlift.airtable_upload import Upload
+        from airlift.incremental_sync import FileKeys, incremental_rows
+
+        file_keys = FileKeys(["ID"])
+        client = MagicMock()
+        client.table.iterate.return_value = iter([[
+            {"id": "rec1", "fields": {"ID": "1", "Name": "Lion"}},
+        ]])
+
+        def upsert(records, key_fields):
+            for data in records:
+                data["id"] = "recNew"
+            return []
+
+        client.batch_upsert.side_effect = upsert
+        rows = file_keys.track(iter([
+            {"fields": {"ID": "1", "Name": "Lion"}},
+            {"fields": {"ID": "2", "Name": "Tiger"}},
+        ]))
+        args = self._args(attachment_columns_map=None)
+        data = incremental_rows(client, rows, args, file_keys=file_keys)
+        mock_args = MagicMock()
+        mock_args.csv_file = Path("tests/assets/test.csv")
+        mock_args.attachment_columns = None
+        mock_args.attachment_columns_map = None
+        mock_args.columns_copy = None
+        mock_args.rename_key_column = None
+        mock_args.upsert_on = ["ID"]
+        mock_args.workers = 1
+        mock_args.adaptive_concurrency = False
+        mock_args.attachment_workers = None
+        mock_args.writer_workers = None
+        mock_args.log = None
+        Upload(
+            client=client, new_data=data, dbx=None, args=mock_args, file_keys=file_keys
+        ).upload_data()
+
+        assert file_keys.complete is True
+        assert file_keys.record_ids == {"rec1", "recNew"}
+        assert file_keys.unmatched_keys == set()
+
+    def test_delete_missing_needs_the_whole_file(self):
+        """Test nothing is deleted when the file was not read to the end or had no keys."""
+        from airlift.incremental_sync import FileKeys, delete_missing_records
+
+        client = MagicMock()
+        file_keys = FileKeys(["ID"])
+        rows = file_keys.track(iter([{"fields": {"ID": "1"}}, {"fields": {"ID": "2"}}]))
+        next(rows)
+        with pytest.raises(CriticalError, match="read to the end"):
+            delete_missing_records(client, file_keys)
+
+        empty = FileKeys(["ID"])
+        list(empty.track([{"fields": {"Name": "no key"}}]))
+        with pytest.raises(CriticalError, match="upsert-on"):
+            delete_missing_records(client, empty)
+        client.delete_record_pages.assert_not_called()
+
+
+# ============================================================================
+# 14. TestAsyncEngine - asyncio Upload Engine
+# ============================================================================
+class TestAsyncEngine:
+    """Test the --engine async backend."""
+
+    @staticmethod
+    def _args(**overrides):
+        args = MagicMock()
+        args.csv_file = ASSETS_JSON.resolve()
+        args.attachment_columns = None
+        args.attachment_columns_map = None
+        args.columns_copy = None
+        args.rename_key_column = None
+        args.upsert_on = None
+        args.workers = 2
+        args.adaptive_concurrency = False
+        args.attachment_workers = None
+        args.writer_workers = None
+        args.log = None
+        for key, value in overrides.items():
+            setattr(args, key, value)
+        return args
+
+    @staticmethod
+    def _client():
+        from airlift.rate_limiter import TokenBucket
+        client = MagicMock()
+        client.api = "pat_test_token"
+        client.base_id = "appTestBase"
+        client.table_id = "tblTestTable"
+        client.limiter = TokenBucket(1000, 10)
+        return client
+
+    @staticmethod
+    def _mock_network(handler):
+        """Route every httpx.AsyncClient made by the engine through a handler."""
+        import functools
+        import httpx
+        return patch.object(
+            httpx, "AsyncClient",
+            functools.partial(httpx.AsyncClient, transport=httpx.MockTransport(handler)),
+        )
+
+    def test_async_engine_requires_httpx(self):
+        """Test --engine async fails clearly when httpx is not installed."""
+        import sys
+        from airlift.async_upload import AsyncUpload
+
+        with patch.dict(sys.modules, {"httpx": None}):
+            with pytest.raises(CriticalError, match="httpx"):
+                AsyncUpload(client=self._client(), new_data=[], dbx=None, args=self._args())
+
+    def test_engine_arg(self):
+        """Test --engine accepts thread or async only."""
+        assert parse_args(["--engine", "async", "data.csv"]).engine == "async"
+        assert parse_args(["data.csv"]).engine is None
+        with pytest.raises(SystemExit):
+            parse_args(["--engine", "fibers", "data.csv"])
+
+    def test_token_bucket_paces_coroutines(self):
+        """Test the shared limiter paces async callers without blocking the loop."""
+        import asyncio
+        from airlift.rate_limiter import TokenBucket
+
+        bucket = TokenBucket(rate=50, burst=1)
+
+        async def take_three():
+            start = time.monotonic()
+            await asyncio.gather(*(bucket.acquire_async() for _ in range(3)))
+            return time.monotonic() - start
+
+        assert asyncio.run(take_three()) >= 0.035
+
+    def test_async_upload_writes_batches_and_waits_out_429(self):
+        """Test rows are created in batches of ten and a 429 is retried."""
+        httpx = pytest.importorskip("httpx")
+        from airlift.async_upload import AsyncUpload
+
+        requests_seen = []
+
+        def handler(request):
+            body = json.loads(request.content)
+            requests_seen.append((request.method, len(body["records"])))
+            if len(requests_seen) == 1:
+                return httpx.Response(429, headers={"Retry-After": "0"})
+            return httpx.Response(200, json={"records": [
+                {"id": f"rec{record['fields']['Name']}"} for record in body["records"]
+            ]})
+
+        rows = [{"fields": {"Name": str(i)}} for i in range(25)]
+        upload = AsyncUpload(
+            client=self._client(), new_data=iter(rows), dbx=None,
+            args=self._args(writer_workers=1),
+        )
+        with self._mock_network(handler):
+            upload.upload_data()
+
+        assert requests_seen == [("POST", 10), ("POST", 10), ("POST", 10), ("POST", 5)]
+        assert all(row["id"] == f"rec{row['fields']['Name']}" for row in rows)
+
+    def test_async_upload_retries_dropped_airtable_connections(self):
+        """Test a dropped connection to Airtable is sent again instead of aborting."""
+        httpx = pytest.importorskip("httpx")
+        from airlift.async_upload import AsyncUpload
+
+        requests_seen = []
+
+        def handler(request):
+            requests_seen.append(request.method)
+            if len(requests_seen) == 1:
+                raise httpx.ConnectError("connection reset", request=request)
+            body = json.loads(request.content)
+            return httpx.Response(200, json={"records": [
+                {"id": f"rec{record['fields']['Name']}"} for record in body["records"]
+            ]})
+
+        rows = [{"fields": {"Name": str(i)}} for i in range(3)]
+        upload = AsyncUpload(
+            client=self._client(), new_data=iter(rows), dbx=None,
+            args=self._args(writer_workers=1),
+        )
+        with self._mock_network(handler):
+            upload.upload_data()
+
+        assert requests_seen == ["POST", "POST"]
+        assert [row["id"] for row in rows] == ["rec0", "rec1", "rec2"]
+        assert not upload.stop_event.is_set()
+
+    def test_async_upload_isolates_refused_rows(self):
+        """Test a batch refused with 422 is resent row by row like the threaded engine."""
+        httpx = pytest.importorskip("httpx")
+        from airlift.async_upload import AsyncUpload
+
+        requests_seen = []
+
+        def handler(request):
+            names = [record["fields"]["Name"] for record in json.loads(request.content)["records"]]
+            requests_seen.append(names)
+            if "bad" in names:
+                return httpx.Response(422, json={"error": {"type": "INVALID_VALUE"}})
+            return httpx.Response(200, json={"records": [{"id": f"rec{name}"} for name in names]})
+
+        rows = [{"fields": {"Name": name}} for name in ("a", "bad", "c")]
+        upload = AsyncUpload(
+            client=self._client(), new_data=iter(rows), dbx=None,
+            args=self._args(writer_workers=1),
+        )
+        with self._mock_network(handler):
+            upload.upload_data()
+
+        assert requests_seen == [["a", "bad", "c"], ["a"], ["bad"], ["c"]]
+        assert rows[0]["id"] == "reca" and rows[2]["id"] == "recc"
+        assert "id" not in rows[1]
+        assert not upload.stop_event.is_set()
+
+    def test_async_upload_sends_attachment_once_over_http(self):
+        """Test one file referenced by several rows is sent to Dropbox once."""
+        httpx = pytest.importorskip("httpx")
+        from airlift.async_upload import AsyncUpload
+
+        dbx = MagicMock()
+        dbx.cached_download_url.return_value = None
+        dbx.prepare_upload.side_effect = lambda path: (path, "hash", None)
+        dbx.run_path.return_value = ASSETS_DROPBOX_FILE_PATH
+        dbx.temporary_links = True
+        dbx.access_token.return_value = "dropbox-token"
+        dbx.temporary_link_expiry.return_value = 123.0
+        dbx.finish_upload.side_effect = lambda content_hash, path, url, kind, expires: url
+        dropbox_uploads = []
+        commits = []
+        written = []
+
+        def handler(request):
+            if request.url.path == "/2/files/upload_session/start":
+                dropbox_uploads.append(json.loads(request.headers["Dropbox-API-Arg"]))
+                assert request.headers["Authorization"] == "Bearer dropbox-token"
+                assert request.content == ASSETS_LOCAL_IMAGE.read_bytes()
+                return httpx.Response(200, json={"session_id": "s1"})
+            if request.url.path == "/2/files/upload_session/finish_batch_v2":
+                entries = json.loads(request.content)["entries"]
+                commits.append(entries)
+                return httpx.Response(200, json={"entries": [
+                    {".tag": "success", "path_display": entry["commit"]["path"]}
+                    for entry in entries
+                ]})
+            if request.url.path == "/2/files/get_temporary_link":
+                return httpx.Response(200, json={"link": "https://dl.dropbox/test.gif"})
+            records = json.loads(request.content)["records"]
+            written.extend(records)
+            return httpx.Response(200, json={"records": [{"id": "rec"} for _ in records]})
+
+        rows = [
+            {"fields": {"Image Filename": ASSETS_IMAGE, "Attachments": None}}
+            for _ in range(3)
+        ]
+        upload = AsyncUpload(
+            client=self._client(), new_data=rows, dbx=dbx,
+            args=self._args(attachment_columns_map=[["Image Filename", "Attachments"]]),
+        )
+        with self._mock_network(handler):
+            upload.upload_data()
+
+        assert dropbox_uploads == [{"close": True}]
+        assert commits == [[{
+            "cursor": {"session_id": "s1", "offset": ASSETS_LOCAL_IMAGE.stat().st_size},
+            "commit": {"path": ASSETS_DROPBOX_FILE_PATH, "mode": "overwrite", "mute": True},
+        }]]
+        dbx.finish_upload.assert_called_once_with(
+            "hash", ASSETS_DROPBOX_FILE_PATH, "https://dl.dropbox/test.gif", "temporary", 123.0
+        )
+        assert len(written) == 3
+        assert all(
+            record["fields"]["Attachments"] == [
+                {"url": "https://dl.dropbox/test.gif", "filename": ASSETS_IMAGE}
+            ]
+            for record in written
+        )
+
+
+    def test_async_commits_are_grouped(self):
+        """Test uploads waiting together share one finish_batch_v2 call."""
+        import asyncio
+        from airlift.async_upload import _AsyncCommitBatcher, _DropboxCommitError
+
+        calls = []
+
+        async def finish_batch(entries):
+            calls.append(entries)
+            await asyncio.sleep(0)
+            return [
+                _DropboxCommitError({".tag": "too_many_write_operations"})
+                if entry == "busy" else {"committed": entry}
+                for entry in entries
+            ]
+
+        async def commit_all():
+            batcher = _AsyncCommitBatcher(finish_batch)
+            return await asyncio.gather(
+                *(batcher.commit(entry) for entry in ["a", "b", "busy"]),
+                return_exceptions=True,
+            )
+
+        results = asyncio.run(commit_all())
+        assert calls == [["a", "b", "busy"]]
+        assert results[:2] == [{"committed": "a"}, {"committed": "b"}]
+        assert isinstance(results[2], _DropboxCommitError)
+        assert results[2].retryable is True
 
 # ============================================================================
 # Main Entry Point